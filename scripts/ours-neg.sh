@@ -13,12 +13,9 @@ prev_num=$((num - 1))
 
 echo "Running negative-sample pipeline: iteration ${num}, domain '${domain}', using model from iteration ${prev_num}"
 
-# Step 1: Generate negative prompts from correct extractions
-echo "Step 1: Create negative prompts from correct extractions of current iteration."
-python stl/neg_prompts.py \
-  --extractions_file ./${domain}/ours/correct_train_it${num}.json \
-  --questions_file playground/data/folder/questions_train_${domain}.jsonl \
-  --output_file ./${domain}/ours/neg_from_correct_prompts_it${num}.jsonl
+# Step 1: Negative prompts from correct extractions are written by the 'pos'
+# pipeline stage in ours-part1.sh
+echo "Step 1: Using negative prompts from ./${domain}/ours/neg_from_correct_prompts_it${num}.jsonl"
 
 # Step 2: Use model from previous iteration to generate answers to the negative prompts
 echo "Step 2: Run model from previous iteration on the generated negative prompts."
@@ -28,25 +25,10 @@ python llava/eval/model_vqa.py \
   --image-folder . \
   --answers-file ./${domain}/ours/response_neg_train_it${num}.jsonl
 
-# Step 3: Extract caption, explanation, and incorrect choice from responses
-echo "Step 3: Extract training signals (caption, explanation, incorrect choice) from model responses."
-python stl/extraction_neg.py \
-  -i ./${domain}/ours/response_neg_train_it${num}.jsonl \
-  -e ./${domain}/ours/extracted_train_neg_it${num}.jsonl \
-  -s ./${domain}/ours/skipped_train_neg_it${num}.json
-
-# Step 4: Generate final negative samples using those extractions
-echo "Step 4: Construct negative training samples from extracted responses."
-python stl/neg_samples.py \
-  --extractions_file ./${domain}/ours/extracted_train_neg_it${num}.jsonl \
-  --questions_file playground/data/folder/questions_train_${domain}.jsonl \
-  --output_file ./${domain}/ours/neg_train_samples_it${num}.json
-
-# Step 5: Merge positive and negative samples into final training set
-echo "Step 5: Merge positive and negative samples into final training set for this iteration."
-python stl/final_training_set.py \
-  --input_files ./${domain}/ours/pos_samples_train_it${num}.json ./${domain}/ours/neg_train_samples_it${num}.json \
-  --output_file ./${domain}/ours/training_set_it${num}.json
+# Steps 3-5: Extract caption, explanation and incorrect choice, construct negative
+# samples and merge them with the positive samples, in one process
+echo "Step 3: Extract training signals, build negative samples and merge the final training set."
+python stl/pipeline.py --domain ${domain} --num ${num} --stage neg merge --keep_intermediates
 
 echo "Iteration ${num} for domain '${domain}' completed successfully ✅"
 
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the stl stages on synthetic M3CoT-scale data.
+
+For every --scales factor a synthetic domain with scale x 2786 questions
+(the size of questions_train_science_natural.jsonl) is generated with its
+correct answers and model responses, then each stage script is run as a
+child process and timed. Peak RSS comes from os.wait4 on the child.
+
+The responses mix well-formed answers with the failure modes seen in real
+model_vqa.py output: missing sections, lower-case section names, huge
+zero-filled rationales, ambiguous and choice-text conclusions. Negative
+responses are generated for the prompts neg_prompts.py actually wrote.
+The question index (.qidx) is built while generating the data, so stages
+are timed against a warm index.
+
+Usage:
+  python stl/benchmark.py --scales 1 10 --output_file bench.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pos_prompts import format_prompt
+from question_store import open_question_store
+from record_io import iter_records
+
+STL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Number of questions in questions_train_science_natural.jsonl
+BASE_QUESTIONS = 2786
+
+DOMAIN = 'synthetic'
+
+CATEGORIES = ('physics-Density', 'physics-Magnets', 'biology-Scientific names', 'biology-Genes to traits',
+              'chemistry-Atoms and Molecules Recognize', 'physics-Gas Condensation')
+
+WORDS = ('sample', 'density', 'magnet', 'organism', 'gas', 'liquid', 'solid', 'north', 'south', 'pole',
+         'molecule', 'atom', 'trait', 'gene', 'higher', 'lower', 'pressure', 'temperature', 'force', 'image',
+         'left', 'right', 'figure', 'container', 'particle', 'energy', 'motion', 'species', 'habitat', 'same')
+
+# Share of positive responses per failure mode; the rest are well formed
+POS_FAILURES = (
+    ('missing_caption', 0.05),
+    ('missing_conclusion', 0.04),
+    ('zero_rationale', 0.03),
+    ('ambiguous', 0.04),
+    ('choice_text', 0.05),
+    ('lowercase', 0.04),
+)
+NEG_FAILURES = (
+    ('missing_explanation', 0.08),
+    ('zero_explanation', 0.03),
+    ('no_markers', 0.03),
+)
+
+ACCURACY = 0.6
+
+
+def _phrase(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def _failure(rng, failures):
+    r = rng.random()
+    for name, share in failures:
+        if r < share:
+            return name
+        r -= share
+    return None
+
+
+def generate_questions(out_dir, scale, seed=0):
+    """Write questions_train_<DOMAIN>.jsonl and correct_answers_train.json; return their paths."""
+    rng = random.Random(seed)
+    questions_file = os.path.join(out_dir, f'questions_train_{DOMAIN}.jsonl')
+    answers_file = os.path.join(out_dir, 'correct_answers_train.json')
+    answers = {}
+    with open(questions_file, 'w', encoding='utf-8') as f:
+        for i in range(int(BASE_QUESTIONS * scale)):
+            qid = f'synthetic-{i}'
+            n_choices = rng.choice((2, 2, 3, 4, 4, 5))
+            choices = '\n'.join(f"({chr(97 + c)}) {_phrase(rng, rng.randint(1, 4))}" for c in range(n_choices))
+            text = (f"Which {_phrase(rng, 2)} has a {_phrase(rng, 3)}?\n"
+                    f"Select the correct answer from the following choices:\n{choices}")
+            f.write(json.dumps({"question_id": qid, "image": f"playground/data/m3cot/images/{qid}.png",
+                                "text": text, "category": rng.choice(CATEGORIES)}) + '\n')
+            answers[qid] = f"({chr(97 + rng.randrange(n_choices))})"
+    with open(answers_file, 'w', encoding='utf-8') as f:
+        json.dump(answers, f)
+    return questions_file, answers_file
+
+
+def _answer(record, text):
+    return json.dumps({"question_id": record['question_id'], "prompt": record['text'], "text": text,
+                       "answer_id": record['question_id'], "model_id": "synthetic", "metadata": {}}) + '\n'
+
+
+def pos_response(rng, question, choices, gold):
+    """A positive response for a question, or one of the POS_FAILURES."""
+    letters = [letter for letter, _ in choices]
+    choice = gold if rng.random() < ACCURACY else rng.choice(letters)
+    caption = f"The image shows a {_phrase(rng, 12)}."
+    rationale = f"Looking at the {_phrase(rng, 20)}, the answer follows."
+    failure = _failure(rng, POS_FAILURES)
+    if failure == 'missing_caption':
+        return f"REASONING: {rationale}\n\nCONCLUSION: {choice}"
+    if failure == 'missing_conclusion':
+        return f"CAPTION: {caption}\n\nREASONING: {rationale}"
+    if failure == 'zero_rationale':
+        return f"CAPTION: {caption}\n\nREASONING: {'0' * 20000}\n\nCONCLUSION: {choice}"
+    if failure == 'ambiguous':
+        return f"CAPTION: {caption}\n\nREASONING: {rationale}\n\nCONCLUSION: {' or '.join(letters[:2])}"
+    if failure == 'choice_text':
+        return f"CAPTION: {caption}\n\nREASONING: {rationale}\n\nCONCLUSION: The answer is {dict(choices)[choice]}."
+    if failure == 'lowercase':
+        return f"caption: {caption}\nreasoning: {rationale}\nconclusion: {choice}"
+    return f"CAPTION: {caption}\n\nREASONING: {rationale}\n\nCONCLUSION: {choice}"
+
+
+def neg_response(rng, incorrect_choice):
+    caption = f"The image shows a {_phrase(rng, 12)}."
+    explanation = f"{incorrect_choice} is wrong because the {_phrase(rng, 15)} does not match."
+    failure = _failure(rng, NEG_FAILURES)
+    if failure == 'missing_explanation':
+        return f"CAPTION: {caption}"
+    if failure == 'zero_explanation':
+        return f"CAPTION: {caption}\n\nEXPLANATION: {'0' * 20000}"
+    if failure == 'no_markers':
+        return f"{caption} {explanation}"
+    return f"CAPTION: {caption}\n\nEXPLANATION: {explanation}"
+
+
+def generate_pos_responses(path, questions_file, answers_file, seed=0):
+    rng = random.Random(seed + 1)
+    store = open_question_store(questions_file)
+    with open(answers_file, 'r', encoding='utf-8') as f:
+        answers = json.load(f)
+    with open(path, 'w', encoding='utf-8') as out:
+        for qid in store:
+            question = store[qid]
+            out.write(_answer(format_prompt(question), pos_response(rng, question, store.choices(qid), answers[qid])))
+
+
+def generate_neg_responses(path, neg_prompts_file, seed=0):
+    rng = random.Random(seed + 2)
+    marker = 'Explain why this answer is wrong: '
+    with open(path, 'w', encoding='utf-8') as out:
+        for record in iter_records(neg_prompts_file):
+            text = record['text']
+            start = text.rindex(marker) + len(marker)
+            out.write(_answer(record, neg_response(rng, text[start:text.index('\n', start)])))
+
+
+def count_records(path):
+    return sum(1 for _ in iter_records(path))
+
+
+def run_stage(cmd, log):
+    """Run a stage script and return (seconds, max RSS in MB, exit code)."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024, proc.returncode
+
+
+def stage_commands(d, questions_file, answers_file):
+    """(stage, argv, file whose records count as the stage input) in pipeline order."""
+    py = [sys.executable]
+    s = lambda name: os.path.join(STL_DIR, name)
+    p = lambda name: os.path.join(d, name)
+    return [
+        ('extraction', py + [s('extraction.py'), '-i', p('response_pos.jsonl'), '-e', p('extracted.json'),
+                             '-s', p('skipped.json')], p('response_pos.jsonl')),
+        ('correct_incorrect', py + [s('correct_incorrect.py'), '--extracted_file', p('extracted.json'),
+                                    '--correct_answers_file', answers_file, '--correct_output_file', p('correct.json'),
+                                    '--incorrect_output_file', p('incorrect.json')], p('extracted.json')),
+        ('pos_samples', py + [s('pos_samples.py'), '-q', questions_file, '-e', p('correct.json'),
+                              '-o', p('pos_samples.json')], p('correct.json')),
+        ('neg_prompts', py + [s('neg_prompts.py'), '-c', p('correct.json'), '-q', questions_file,
+                              '-o', p('neg_prompts.jsonl')], p('correct.json')),
+        ('extraction_neg', py + [s('extraction_neg.py'), '-i', p('response_neg.jsonl'),
+                                 '-e', p('extracted_neg.json'), '-s', p('skipped_neg.json')], p('response_neg.jsonl')),
+        ('neg_samples', py + [s('neg_samples.py'), '-q', questions_file, '-e', p('extracted_neg.json'),
+                              '-o', p('neg_samples.json')], p('extracted_neg.json')),
+        ('final_training_set', py + [s('final_training_set.py'), '--input_files', p('pos_samples.json'),
+                                     p('neg_samples.json'), '--output_file', p('training_set.json')], None),
+        ('accuracy', py + [s('accuracy.py'), '--extracted_file', p('extracted.json'),
+                           '--correct_answers_file', answers_file], p('extracted.json')),
+    ]
+
+
+def benchmark_scale(work_dir, scale, seed=0, repeat=1):
+    """Generate data for one scale, run every stage and return one result dict per stage."""
+    d = os.path.join(work_dir, f'scale_{scale}')
+    os.makedirs(d, exist_ok=True)
+    questions_file, answers_file = generate_questions(d, scale, seed)
+    generate_pos_responses(os.path.join(d, 'response_pos.jsonl'), questions_file, answers_file, seed)
+
+    results = []
+    with open(os.path.join(d, 'stages.log'), 'w', encoding='utf-8') as log:
+        for stage, cmd, input_file in stage_commands(d, questions_file, answers_file):
+            if stage == 'extraction_neg':
+                # Responses to the prompts written by the neg_prompts stage
+                generate_neg_responses(os.path.join(d, 'response_neg.jsonl'), os.path.join(d, 'neg_prompts.jsonl'), seed)
+            runs = [run_stage(cmd, log) for _ in range(repeat)]
+            seconds = min(r[0] for r in runs)
+            if input_file:
+                records = count_records(input_file)
+            else:
+                records = count_records(os.path.join(d, 'pos_samples.json')) + \
+                    count_records(os.path.join(d, 'neg_samples.json'))
+            results.append({
+                'scale': scale,
+                'stage': stage,
+                'records': records,
+                'seconds': round(seconds, 3),
+                'records_per_s': round(records / seconds, 1) if seconds else None,
+                'max_rss_mb': round(max(r[1] for r in runs), 1),
+                'returncode': max(r[2] for r in runs),
+            })
+    return results
+
+
+def print_results(results):
+    print(f"{'scale':>5}  {'stage':<20} {'records':>9} {'seconds':>8} {'rec/s':>10} {'rss MB':>8}")
+    for r in results:
+        rate = '-' if r['records_per_s'] is None else f"{r['records_per_s']:.0f}"
+        flag = '' if r['returncode'] == 0 else f"  (exit {r['returncode']})"
+        print(f"{r['scale']:>5}  {r['stage']:<20} {r['records']:>9} {r['seconds']:>8.2f} {rate:>10} "
+              f"{r['max_rss_mb']:>8.1f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stl stages on synthetic data.")
+    parser.add_argument('--scales', nargs='+', type=float, default=[1],
+                        help=f'Dataset sizes as multiples of {BASE_QUESTIONS} questions')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per stage; the fastest is reported')
+    parser.add_argument('--work_dir', help='Directory for the generated data (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated data')
+    parser.add_argument('--output_file', help='Optional path to write the results as JSON')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='stl_bench_')
+    results = []
+    try:
+        for scale in args.scales:
+            scale = int(scale) if float(scale).is_integer() else scale
+            results += benchmark_scale(work_dir, scale, args.seed, args.repeat)
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.output_file:
+        with open(args.output_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if any(r['returncode'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, template-interned training-set format.
+
+Every conversation turn written by pos_samples.py and neg_samples.py is
+one of a few prompt/response templates with a handful of slot values
+filled in. The compact file stores each turn as a template id plus the
+slot values, and every distinct string (slot values, images, ids) once in
+a shared string table, so the instruction preambles are not repeated per
+record and a question shared by several samples is stored once.
+
+CompactDataset opens the file with mmap and expands one record per
+access into the usual LLaVA layout:
+
+  {"id": ..., "image": ..., "conversations": [{"from": ..., "value": ...}, ...], "type": ...}
+
+It can stand in for the list of dicts a training script loads, and no
+per-record Python objects are held, so DataLoader workers forked from the
+main process share the pages instead of each copying the parsed JSON.
+Records that do not fit the layout are stored as raw JSON.
+
+Layout (little-endian):
+  header   magic, version, record count, string count, string index offset
+  records  (record count + 1) x u64 offsets, then u32 string ids per record:
+           id, image, type, turn count, then per turn from, template, slots
+  strings  (string count + 1) x u64 offsets into the UTF-8 blob
+String 0 holds the template table as JSON.
+"""
+import argparse
+import json
+import mmap
+import re
+import string
+import struct
+from collections.abc import Sequence
+
+import neg_samples
+import pos_samples
+from record_io import iter_records, write_records
+from records import to_json
+
+MAGIC = b'STLD'
+VERSION = 1
+
+_header = struct.Struct('<4sIIIQ')
+_u64 = struct.Struct('<Q')
+_offsets = struct.Struct('<QQ')
+# Template id of a turn stored verbatim, and marker of a record stored as raw JSON
+_LITERAL = 0xFFFFFFFF
+_RAW = 0xFFFFFFFF
+
+RECORD_KEYS = ('id', 'image', 'conversations', 'type')
+
+# Templates tried in order when compacting a conversation turn
+TEMPLATES = {
+    'pos_human': "<image>\n" + pos_samples.prompt_template,
+    'pos_gpt': pos_samples.response_template,
+    'neg_human': neg_samples.prompt_template,
+    'neg_gpt': neg_samples.response_template,
+}
+
+
+class Template:
+    """A str.format style template split into literal parts, matched with a regex."""
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.literals = []
+        self.slots = []
+        pattern = []
+        for literal, field, _, _ in string.Formatter().parse(text):
+            self.literals.append(literal)
+            pattern.append(re.escape(literal))
+            if field is not None:
+                self.slots.append(field)
+                pattern.append('(.*?)')
+        if len(self.literals) == len(self.slots):
+            self.literals.append('')
+        self.pattern = re.compile(''.join(pattern), re.DOTALL)
+
+    def match(self, value):
+        """Return the slot values that rebuild value exactly, or None."""
+        m = self.pattern.fullmatch(value)
+        return m.groups() if m else None
+
+    def expand(self, values):
+        parts = [self.literals[0]]
+        for value, literal in zip(values, self.literals[1:]):
+            parts.append(value)
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def is_compact(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def add(self, value):
+        sid = self.ids.get(value)
+        if sid is None:
+            sid = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return sid
+
+
+def _compact_record(record, templates, strings):
+    """Return the u32 string ids of one record."""
+    turns = record.get('conversations')
+    if tuple(record) != RECORD_KEYS or not isinstance(turns, list) \
+            or not all(isinstance(turn, dict) and tuple(turn) == ('from', 'value') for turn in turns):
+        return [_RAW, strings.add(json.dumps(record, ensure_ascii=False, default=to_json))]
+
+    ids = [strings.add(json.dumps(record['id'])), strings.add(json.dumps(record['image'])),
+           strings.add(json.dumps(record['type'])), len(turns)]
+    for turn in turns:
+        ids.append(strings.add(turn['from']))
+        value = turn['value']
+        for index, template in enumerate(templates):
+            values = template.match(value) if isinstance(value, str) else None
+            if values is not None:
+                ids.append(index)
+                ids.extend(strings.add(v) for v in values)
+                break
+        else:
+            ids.append(_LITERAL)
+            ids.append(strings.add(json.dumps(value, ensure_ascii=False)))
+    return ids
+
+
+def write_compact(output_file, records, templates=None):
+    """Write records in the compact format and return how many were written."""
+    templates = [Template(name, text) for name, text in (templates or TEMPLATES).items()]
+    strings = _StringTable()
+    strings.add(json.dumps([[t.name, t.text] for t in templates], ensure_ascii=False))
+
+    record_offsets = []
+    body = bytearray()
+    for record in records:
+        ids = _compact_record(record, templates, strings)
+        record_offsets.append(len(body))
+        body += struct.pack(f'<{len(ids)}I', *ids)
+    record_offsets.append(len(body))
+
+    blob = [value.encode('utf-8') for value in strings.values]
+    records_start = _header.size + len(record_offsets) * _u64.size
+    strings_start = records_start + len(body)
+    blob_start = strings_start + (len(blob) + 1) * _u64.size
+
+    with open(output_file, 'wb') as out:
+        out.write(_header.pack(MAGIC, VERSION, len(record_offsets) - 1, len(blob), strings_start))
+        out.write(b''.join(_u64.pack(records_start + off) for off in record_offsets))
+        out.write(body)
+        pos = blob_start
+        for data in blob:
+            out.write(_u64.pack(pos))
+            pos += len(data)
+        out.write(_u64.pack(pos))
+        out.writelines(blob)
+    return len(record_offsets) - 1
+
+
+class CompactDataset(Sequence):
+    """Read-only sequence of training records expanded lazily from a compact file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self._nstrings, self._strings_start = _header.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a compact training set (version {VERSION})")
+        self.templates = [Template(name, text) for name, text in json.loads(self._string(0))]
+
+    def _string(self, sid):
+        start, end = _offsets.unpack_from(self._mm, self._strings_start + sid * _u64.size)
+        return self._mm[start:end].decode('utf-8')
+
+    def _expand(self, ids):
+        if ids[0] == _RAW:
+            return json.loads(self._string(ids[1]))
+        conversations = []
+        pos = 4
+        for _ in range(ids[3]):
+            speaker, index = ids[pos], ids[pos + 1]
+            pos += 2
+            if index == _LITERAL:
+                value = json.loads(self._string(ids[pos]))
+                pos += 1
+            else:
+                template = self.templates[index]
+                n = len(template.slots)
+                value = template.expand([self._string(sid) for sid in ids[pos:pos + n]])
+                pos += n
+            conversations.append({"from": self._string(speaker), "value": value})
+        return {
+            "id": json.loads(self._string(ids[0])),
+            "image": json.loads(self._string(ids[1])),
+            "conversations": conversations,
+            "type": json.loads(self._string(ids[2])),
+        }
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        start, end = _offsets.unpack_from(self._mm, _header.size + index * _u64.size)
+        return self._expand(struct.unpack_from(f'<{(end - start) // 4}I', self._mm, start))
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mm.close()
+
+
+def iter_training_records(path):
+    """Yield the records of a compact file, a JSON array file or a JSONL file."""
+    if is_compact(path):
+        dataset = CompactDataset(path)
+        try:
+            yield from dataset
+        finally:
+            dataset.close()
+    else:
+        yield from iter_records(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert a training set between the LLaVA JSON layout and the compact format. "
+                    "A compact input is expanded, anything else is compacted."
+    )
+    parser.add_argument('--input_file', '-i', required=True, help='Compact file, JSON array file or JSONL file')
+    parser.add_argument('--output_file', '-o', required=True,
+                        help='Output path (JSON array, or JSONL if it ends in .jsonl, when expanding)')
+    args = parser.parse_args()
+
+    if is_compact(args.input_file):
+        total = write_records(args.output_file, iter_training_records(args.input_file), indent=4)
+        print(f"Expanded {total} records into {args.output_file}")
+    else:
+        total = write_compact(args.output_file, iter_records(args.input_file))
+        print(f"Compacted {total} records into {args.output_file}")
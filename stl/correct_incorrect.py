@@ -2,41 +2,103 @@
 import json
 import argparse
 
-def main(args):
-    # Load extracted responses
-    with open(args.extracted_file, "r", encoding="utf-8") as f:
-        extracted_data = json.load(f)
-
-    # Load correct answers
-    with open(args.correct_answers_file, "r", encoding="utf-8") as f:
-        correct_answers = json.load(f)
-
-    correct_extractions = []
-    incorrect_extractions = []
+from gold_answers import load_gold_answers
+from instrument import StageMetrics, add_metrics_args
+from record_io import RecordWriter, iter_records, open_text
 
+def split_extractions(extracted_data, correct_answers, stats=None):
+    """Yield (is_correct, entry) for each extracted response; ids without a gold answer are counted in stats."""
     # Compare each extracted response with the correct answer
     for entry in extracted_data:
         # Ensure the question id is a string so it matches the keys in correct_answers
-        qid = str(entry.get("question_id"))
-        generated_choice = entry.get("generated_choice")
-        correct_choice = correct_answers.get(qid)
+        correct_choice = correct_answers.get(str(entry.get("question_id")))
+        if not correct_choice and stats is not None:
+            stats["no_gold_answer"] += 1
+
+        yield bool(correct_choice) and entry.get("generated_choice") == correct_choice, entry
+
+def write_partition(results, output_format, correct_output_file, incorrect_output_file=None):
+    """
+    Write split results and return (correct_count, incorrect_count).
+      split   correct and incorrect records copied into two files
+      ids     two JSONL files of row numbers into the extracted file
+      column  one JSONL file with a true/false line per extracted row
+    """
+    correct_count = incorrect_count = 0
+    if output_format == "split":
+        with RecordWriter(correct_output_file, indent=4) as correct_out, \
+             RecordWriter(incorrect_output_file, indent=4) as incorrect_out:
+            for is_correct, entry in results:
+                (correct_out if is_correct else incorrect_out).write(entry)
+        return correct_out.count, incorrect_out.count
+
+    if output_format == "ids":
+        with open_text(correct_output_file, "w") as correct_out, \
+             open_text(incorrect_output_file, "w") as incorrect_out:
+            for row, (is_correct, _) in enumerate(results):
+                if is_correct:
+                    correct_out.write(f"{row}\n")
+                    correct_count += 1
+                else:
+                    incorrect_out.write(f"{row}\n")
+                    incorrect_count += 1
+        return correct_count, incorrect_count
+
+    with open_text(correct_output_file, "w") as out:
+        for is_correct, _ in results:
+            out.write("true\n" if is_correct else "false\n")
+            if is_correct:
+                correct_count += 1
+            else:
+                incorrect_count += 1
+    return correct_count, incorrect_count
+
+def _iter_partition_lines(partition_file):
+    with open_text(partition_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
 
-        if correct_choice and generated_choice == correct_choice:
-            correct_extractions.append(entry)
-        else:
-            incorrect_extractions.append(entry)
+def iter_partition(extracted_file, partition_file, output_format, correct=True):
+    """
+    Yield the extracted records selected by an ids or column partition file.
+    For ids, partition_file is the correct or incorrect row list; for column,
+    correct picks which side of the boolean column to return.
+    """
+    rows = iter_records(extracted_file)
+    if output_format == "column":
+        for entry, flag in zip(rows, _iter_partition_lines(partition_file)):
+            if flag == correct:
+                yield entry
+        return
 
-    # Write correct extractions to a JSON file
-    with open(args.correct_output_file, "w", encoding="utf-8") as f:
-        json.dump(correct_extractions, f, indent=4)
+    # Row ids are written in ascending order, so a single merge pass suffices
+    wanted = _iter_partition_lines(partition_file)
+    next_row = next(wanted, None)
+    for row, entry in enumerate(rows):
+        if next_row is None:
+            break
+        if row == next_row:
+            yield entry
+            next_row = next(wanted, None)
 
-    # Write incorrect extractions to a JSON file
-    with open(args.incorrect_output_file, "w", encoding="utf-8") as f:
-        json.dump(incorrect_extractions, f, indent=4)
+def main(args):
+    with StageMetrics.from_args("correct_incorrect", args, input_file=args.extracted_file) as metrics:
+        # Load the gold answers for this domain from the cache
+        correct_answers = load_gold_answers(args.correct_answers_file, args.questions_file)
+
+        # Stream extracted responses into the correct and incorrect outputs
+        results = split_extractions(iter_records(args.extracted_file), correct_answers, metrics.skipped)
+        correct_count, incorrect_count = write_partition(
+            results, args.output_format, args.correct_output_file, args.incorrect_output_file
+        )
+        metrics.records_in = correct_count + incorrect_count
+        metrics.records_out = correct_count
 
     # Print counts for correct and incorrect answers
-    print(f"Correct extractions count: {len(correct_extractions)}")
-    print(f"Incorrect extractions count: {len(incorrect_extractions)}")
+    print(f"Correct extractions count: {correct_count}")
+    print(f"Incorrect extractions count: {incorrect_count}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -47,7 +109,7 @@ if __name__ == "__main__":
         "--extracted_file",
         type=str,
         required=True,
-        help="Path to the JSON file with extracted responses"
+        help="Path to the JSON or JSONL file with extracted responses"
     )
     parser.add_argument(
         "--correct_answers_file",
@@ -59,15 +121,30 @@ if __name__ == "__main__":
         "--correct_output_file",
         type=str,
         required=True,
-        help="Path to the JSON file to write the correct extractions"
+        help="Path to the JSON (or .jsonl) file to write the correct extractions"
     )
     parser.add_argument(
         "--incorrect_output_file",
         type=str,
-        required=True,
-        help="Path to the JSON file to write the incorrect extractions"
+        required=False,
+        help="Path to the JSON (or .jsonl) file to write the incorrect extractions (not used with --output_format column)"
+    )
+    parser.add_argument(
+        "--questions_file",
+        type=str,
+        required=False,
+        help="Questions JSONL of the domain; restricts and caches the gold answers to that domain"
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["split", "ids", "column"],
+        default="split",
+        help="split: copy records into two files; ids: two row-id lists; column: one true/false line per row"
     )
+    add_metrics_args(parser)
     args = parser.parse_args()
+    if args.output_format != "column" and not args.incorrect_output_file:
+        parser.error("--incorrect_output_file is required unless --output_format is column")
     main(args)
 
 
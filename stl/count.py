@@ -1,25 +1,26 @@
 # -*- coding: utf-8 -*-
 import json
 import argparse
-import os
 import sys
 
+from record_io import is_jsonl, open_text
+
 def count_entries(file_path):
     """
     Count entries in a JSON or JSONL file.
     - For .jsonl/.ndjson: each line is one entry.
     - For .json: if top-level is list or dict, count elements or keys.
+    Either may be compressed (.gz/.zst).
     """
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext in ['.jsonl', '.ndjson']:
+    if is_jsonl(file_path):
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
+            with open_text(file_path) as f:
                 return sum(1 for _ in f)
         except FileNotFoundError:
             raise
     else:
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
+            with open_text(file_path) as f:
                 data = json.load(f)
         except json.JSONDecodeError as e:
             raise ValueError(f"Failed to parse JSON: {e}")
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+Make-style DAG runner for the STL loop with a content-addressed cache.
+
+Every step of scripts/ours.sh (prompt generation, model_vqa.py runs, the
+CPU pipeline stages, training, LoRA merging and evaluation) is declared as
+a Node with its input and output paths, stage parameters and a resource
+tag ('cpu' or 'gpu'). A node's key hashes its kind, parameters and the
+content of its inputs; output paths and the iteration number are not part
+of the key, so identical work in another iteration (e.g. pos_prompts) has
+the same key.
+
+Before running a node the runner looks its key up in the cache
+(.stl_cache/ under the root):
+
+  fresh     outputs on disk already match the cached manifest
+  restored  file outputs are copied back from the cache objects
+  stale     the command runs, then file outputs are stored in the cache
+
+Files are cached by content hash. Directories (model checkpoints) are too
+large to copy and are fingerprinted by the stat of their files instead, so
+they are only ever fresh or stale; nodes producing them carry the output
+path in their parameters. Nodes run in dependency order and a
+failed command stops the run, so running again resumes at the first stale
+node.
+
+With --sequential_eval, the test evaluation of every iteration but the
+last is a single GPU node running sequential_eval.py, which stops once the
+accuracy estimate is tight enough or clearly below the previous iteration.
+It answers through the llava: backend of inference.py, so the merged model
+is loaded once per evaluation rather than once per batch.
+
+Usage:
+  python stl/dag.py --domain commonsense --max_iter 5
+  python stl/dag.py --domain commonsense --max_iter 5 --dry_run
+  python stl/dag.py --domain commonsense --max_iter 2 --targets commonsense/pos_it2
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+from pipeline import artifact_paths
+
+CACHE_DIR = '.stl_cache'
+CACHE_VERSION = 1
+
+STL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Training arguments of scripts/ours-part2.sh, minus the paths set per iteration
+TRAIN_ARGS = (
+    '--lora_enable', 'True', '--lora_r', '128', '--lora_alpha', '256', '--mm_projector_lr', '2e-5',
+    '--deepspeed', './scripts/zero3.json',
+    '--version', 'v1',
+    '--image_folder', '.',
+    '--vision_tower', 'openai/clip-vit-large-patch14-336',
+    '--mm_projector_type', 'mlp2x_gelu',
+    '--mm_vision_select_layer', '-2',
+    '--mm_use_im_start_end', 'False',
+    '--mm_use_im_patch_token', 'False',
+    '--image_aspect_ratio', 'pad',
+    '--group_by_modality_length', 'True',
+    '--bf16', 'False',
+    '--num_train_epochs', '1',
+    '--per_device_train_batch_size', '1',
+    '--per_device_eval_batch_size', '1',
+    '--gradient_accumulation_steps', '16',
+    '--evaluation_strategy', 'no',
+    '--save_strategy', 'steps',
+    '--save_steps', '1000',
+    '--save_total_limit', '1',
+    '--learning_rate', '2e-4',
+    '--weight_decay', '0.',
+    '--warmup_ratio', '0.03',
+    '--lr_scheduler_type', 'cosine',
+    '--logging_steps', '1',
+    '--tf32', 'False',
+    '--model_max_length', '1024',
+    '--gradient_checkpointing', 'True',
+    '--dataloader_num_workers', '4',
+    '--lazy_preprocess', 'True',
+    '--report_to', 'wandb',
+)
+
+
+class Node:
+    """
+    One step of the loop. cmds is a list of argv lists run in order from the
+    root directory; params are the settings that determine the outputs.
+    """
+
+    def __init__(self, name, kind, cmds, inputs=(), outputs=(), params=None, resource='cpu', env=None):
+        self.name = name
+        self.kind = kind
+        self.cmds = cmds
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.resource = resource
+        self.env = env or {}
+
+    def __repr__(self):
+        return f"Node({self.name!r}, resource={self.resource!r})"
+
+
+def _file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def dir_fingerprint(path):
+    """Hash the relative path, size and mtime of every file under a directory."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        for name in sorted(filenames):
+            if name.endswith('.pyc'):
+                continue
+            full = os.path.join(dirpath, name)
+            stat = os.stat(full)
+            entries.append(f"{os.path.relpath(full, path)}\0{stat.st_size}\0{stat.st_mtime_ns}")
+    return hashlib.blake2b('\n'.join(entries).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ArtifactCache:
+    """
+    Content-addressed store under <root>/.stl_cache:
+      objects/<hash>     cached file outputs
+      nodes/<key>.json   output manifest per node key
+      fingerprints.json  file hashes memoized by (size, mtime)
+    """
+
+    def __init__(self, root='.'):
+        self.dir = os.path.join(root, CACHE_DIR)
+        os.makedirs(os.path.join(self.dir, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(self.dir, 'nodes'), exist_ok=True)
+        self._memo_file = os.path.join(self.dir, 'fingerprints.json')
+        self._lock = threading.Lock()
+        try:
+            with open(self._memo_file, 'r', encoding='utf-8') as f:
+                self._memo = json.load(f)
+        except (OSError, ValueError):
+            self._memo = {}
+
+    def fingerprint(self, path):
+        """Return ('file', content hash), ('dir', stat hash) or None if path does not exist."""
+        if os.path.isdir(path):
+            return 'dir', dir_fingerprint(path)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            memo = self._memo.get(key)
+        if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return 'file', memo[2]
+        digest = _file_hash(path)
+        with self._lock:
+            self._memo[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return 'file', digest
+
+    def node_key(self, node):
+        """Hash the node kind, parameters and input fingerprints; None if an input is missing."""
+        parts = [CACHE_VERSION, node.kind, node.params]
+        for path in node.inputs:
+            fp = self.fingerprint(path)
+            if fp is None:
+                return None
+            parts.append(fp)
+        return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.dir, 'objects', digest[:2], digest[2:])
+
+    def _manifest_path(self, key):
+        return os.path.join(self.dir, 'nodes', f'{key}.json')
+
+    def load_manifest(self, key):
+        try:
+            with open(self._manifest_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def status(self, node, key):
+        """Return 'fresh', 'restorable' or 'stale' for a node whose key is known."""
+        manifest = self.load_manifest(key)
+        if manifest is None or len(manifest['outputs']) != len(node.outputs):
+            return 'stale'
+        restorable = False
+        for path, (kind, digest) in zip(node.outputs, manifest['outputs']):
+            if self.fingerprint(path) == (kind, digest):
+                continue
+            if kind == 'file' and os.path.exists(self._object_path(digest)):
+                restorable = True
+                continue
+            return 'stale'
+        return 'restorable' if restorable else 'fresh'
+
+    def restore(self, node, key):
+        manifest = self.load_manifest(key)
+        for path, (kind, digest) in zip(node.outputs, manifest['outputs']):
+            if kind == 'file' and self.fingerprint(path) != (kind, digest):
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                # Copy rather than link: stages rewrite their outputs in place
+                shutil.copyfile(self._object_path(digest), path)
+
+    def store(self, node, key):
+        outputs = []
+        for path in node.outputs:
+            fp = self.fingerprint(path)
+            if fp is None:
+                raise RuntimeError(f"Node {node.name} did not produce {path}")
+            kind, digest = fp
+            if kind == 'file':
+                obj = self._object_path(digest)
+                if not os.path.exists(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    tmp = f"{obj}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    shutil.copyfile(path, tmp)
+                    os.replace(tmp, obj)
+            outputs.append([kind, digest])
+        self._write_json(self._manifest_path(key), {'node': node.name, 'outputs': outputs})
+        self.save()
+
+    def save(self):
+        with self._lock:
+            self._write_json(self._memo_file, self._memo)
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+
+def run_commands(node, root='.', stdout=None):
+    """Run the commands of a node from the root directory, raising CalledProcessError on failure."""
+    env = dict(os.environ, **node.env)
+    for cmd in node.cmds:
+        subprocess.run(cmd, cwd=root, env=env, check=True, stdout=stdout,
+                       stderr=subprocess.STDOUT if stdout else None)
+
+
+def execute_node(node, cache, root='.', run=run_commands):
+    """Bring one node up to date and return 'fresh', 'restored' or 'ran'."""
+    key = cache.node_key(node)
+    if key is None:
+        missing = [path for path in node.inputs if not os.path.exists(path)]
+        raise FileNotFoundError(f"Node {node.name} is missing inputs: {', '.join(missing)}")
+    status = cache.status(node, key)
+    if status == 'fresh':
+        return 'fresh'
+    if status == 'restorable':
+        cache.restore(node, key)
+        return 'restored'
+    for path in node.outputs:
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+    run(node, root)
+    cache.store(node, key)
+    return 'ran'
+
+
+def topological_order(nodes):
+    """Order nodes so that every node comes after the producers of its inputs."""
+    producer = {os.path.abspath(path): node for node in nodes for path in node.outputs}
+    order, state = [], {}
+
+    def visit(node):
+        if state.get(node.name) == 'done':
+            return
+        if state.get(node.name) == 'visiting':
+            raise ValueError(f"Dependency cycle through {node.name}")
+        state[node.name] = 'visiting'
+        for path in node.inputs:
+            dep = producer.get(os.path.abspath(path))
+            if dep is not None and dep is not node:
+                visit(dep)
+        state[node.name] = 'done'
+        order.append(node)
+
+    for node in nodes:
+        visit(node)
+    return order
+
+
+def dependencies(nodes):
+    """Map node name -> names of the nodes producing its inputs."""
+    producer = {os.path.abspath(path): node.name for node in nodes for path in node.outputs}
+    return {node.name: {producer[p] for p in map(os.path.abspath, node.inputs) if p in producer} for node in nodes}
+
+
+def select_targets(nodes, targets):
+    """Keep only the target nodes and everything they depend on, in topological order."""
+    deps = dependencies(nodes)
+    unknown = set(targets) - set(deps)
+    if unknown:
+        raise ValueError(f"Unknown targets: {', '.join(sorted(unknown))}")
+    wanted, stack = set(), list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in wanted:
+            wanted.add(name)
+            stack.extend(deps[name])
+    return [node for node in topological_order(nodes) if node.name in wanted]
+
+
+def stl_loop_graph(domain, max_iter, root='.', data_dir='playground/data/folder',
+                   base_model='models/llava-v1.5-7b', python=sys.executable, sequential_eval=False):
+    """
+    Declare the nodes of scripts/ours.sh for one domain and iterations 1..max_iter.
+    With sequential_eval, iterations before the last are evaluated with
+    sequential_eval.py, which stops answering test questions early.
+    """
+    root = os.path.abspath(root)
+    data_dir = os.path.join(root, data_dir)
+    base_model = os.path.join(root, base_model)
+    model_dir = os.path.join(root, 'models', domain, 'ours')
+    stl_code = STL_DIR
+    pipeline = [python, os.path.join(STL_DIR, 'pipeline.py'), '--domain', domain,
+                '--root', root, '--data_dir', data_dir]
+    hf_env = {'HF_HOME': '.'}
+
+    def model(num):
+        return os.path.join(model_dir, f'llava-v1.5-7b-lora-oursit{num}')
+
+    def vqa(name, num, model_path, question_file, answers_file):
+        return Node(f'{domain}/{name}_it{num}', 'model_vqa',
+                    [[python, 'llava/eval/model_vqa.py', '--model-path', model_path,
+                      '--question-file', question_file, '--image-folder', '.', '--answers-file', answers_file]],
+                    inputs=[model_path, question_file], outputs=[answers_file], resource='gpu')
+
+    def if_present(path):
+        # pipeline.py reads the retry.py responses of an iteration only when they exist
+        return [path] if os.path.exists(path) else []
+
+    # Remove a stale copy first: cp -r into an existing directory would nest the model inside it
+    nodes = [Node(f'{domain}/init', 'copy_model', [['rm', '-rf', model(0)], ['cp', '-r', base_model, model(0)]],
+                  inputs=[base_model], outputs=[model(0)], params={'output': model(0)})]
+    for num in range(1, max_iter + 1):
+        paths = artifact_paths(domain, num, root, data_dir)
+        out_dir = os.path.dirname(paths['training_set'])
+        results_dir = os.path.join(root, 'results', domain, 'ours', f'llava-v1.5-7b-lora-oursit{num}')
+        test_questions = os.path.join(data_dir, f'formatted_questions_test_{domain}.jsonl')
+        response_test = os.path.join(out_dir, f'response_test_it{num}.jsonl')
+        extracted_test = os.path.join(out_dir, f'extracted_test_it{num}.json')
+        skipped_test = os.path.join(out_dir, f'skipped_test_it{num}.json')
+        test_answers = os.path.join(data_dir, 'correct_answers_test.json')
+        summary = os.path.join(out_dir, f'eval_it{num}.json')
+
+        nodes += [
+            Node(f'{domain}/prompts_it{num}', 'pipeline', [pipeline + ['--num', str(num), '--stage', 'prompts']],
+                 inputs=[stl_code, paths['questions']], outputs=[paths['pos_prompts']],
+                 params={'stage': 'prompts'}),
+            vqa('infer_pos', num, model(num - 1), paths['pos_prompts'], paths['response_pos']),
+            Node(f'{domain}/pos_it{num}', 'pipeline',
+                 [pipeline + ['--num', str(num), '--stage', 'pos', '--keep_intermediates']],
+                 inputs=[stl_code, paths['questions'], paths['correct_answers'], paths['response_pos'],
+                         *if_present(paths['retry_pos'])],
+                 outputs=[paths[name] for name in
+                          ('pos_samples', 'neg_prompts', 'extracted', 'skipped', 'correct', 'incorrect')],
+                 params={'stage': 'pos'}),
+            vqa('infer_neg', num, model(num - 1), paths['neg_prompts'], paths['response_neg']),
+            Node(f'{domain}/neg_it{num}', 'pipeline',
+                 [pipeline + ['--num', str(num), '--stage', 'neg', 'merge', '--keep_intermediates']],
+                 inputs=[stl_code, paths['questions'], paths['response_neg'], paths['pos_samples'],
+                         *if_present(paths['retry_neg'])],
+                 outputs=[paths[name] for name in ('neg_samples', 'extracted_neg', 'skipped_neg', 'training_set')],
+                 params={'stage': 'neg merge'}),
+            Node(f'{domain}/train_it{num}', 'train',
+                 [['deepspeed', 'llava/train/train_xformers.py', *TRAIN_ARGS,
+                   '--model_name_or_path', base_model, '--data_path', paths['training_set'],
+                   '--output_dir', results_dir]],
+                 inputs=[base_model, paths['training_set']], outputs=[results_dir],
+                 params={'args': TRAIN_ARGS, 'output': results_dir}, resource='gpu', env=hf_env),
+            Node(f'{domain}/merge_lora_it{num}', 'merge_lora',
+                 [[python, 'scripts/merge_lora_weights.py', '--model-path', results_dir,
+                   '--model-base', base_model, '--save-model-path', model(num)]],
+                 inputs=[results_dir, base_model], outputs=[model(num)], params={'output': model(num)},
+                 resource='gpu', env=hf_env),
+        ]
+        if sequential_eval and num < max_iter:
+            # The model is loaded once in the sequential_eval.py process and answers every batch
+            backend = 'llava:' + model(num)
+            baseline = os.path.join(out_dir, f'eval_it{num - 1}.json')
+            cmd = [python, os.path.join(STL_DIR, 'sequential_eval.py'), '--questions_file', test_questions,
+                   '--correct_answers_file', test_answers, '--backend', backend,
+                   '--model_id', os.path.basename(model(num)), '--answers_file', response_test,
+                   '--extracted_file', extracted_test, '--skipped_file', skipped_test, '--summary_file', summary]
+            inputs = [stl_code, model(num), test_questions, test_answers]
+            if num > 1:
+                cmd += ['--baseline', baseline]
+                inputs.append(baseline)
+            nodes.append(Node(f'{domain}/eval_it{num}', 'sequential_eval', [cmd], inputs=inputs,
+                              outputs=[response_test, extracted_test, skipped_test, summary], resource='gpu'))
+            continue
+        nodes += [
+            vqa('infer_test', num, model(num), test_questions, response_test),
+            Node(f'{domain}/eval_it{num}', 'evaluate',
+                 [[python, os.path.join(STL_DIR, 'extraction.py'), '--input_file', response_test,
+                   '--extracted_output_file', extracted_test, '--skipped_output_file', skipped_test],
+                  [python, os.path.join(STL_DIR, 'accuracy.py'), '--extracted_file', extracted_test,
+                   '--correct_answers_file', test_answers]],
+                 inputs=[stl_code, response_test, test_answers], outputs=[extracted_test, skipped_test]),
+        ]
+    return nodes
+
+
+def run_graph(nodes, cache, root='.', dry_run=False):
+    """Run the nodes in dependency order, skipping those already up to date."""
+    for node in topological_order(nodes):
+        if dry_run:
+            key = cache.node_key(node)
+            status = 'waiting on inputs' if key is None else cache.status(node, key)
+            print(f"{node.name:<32} {node.resource:<4} {status}")
+            continue
+        print(f"[{node.resource}] {node.name}", flush=True)
+        result = execute_node(node, cache, root)
+        print(f"[{node.resource}] {node.name}: {result}", flush=True)
+    cache.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the STL loop as a cached dependency graph.")
+    parser.add_argument('--domain', required=True, help='Domain name, e.g. commonsense')
+    parser.add_argument('--max_iter', type=int, required=True, help='Number of STL iterations')
+    parser.add_argument('--root', default='.', help='Repository root holding models/, llava/ and <domain>/ours/')
+    parser.add_argument('--data_dir', default='playground/data/folder', help='Directory with the question and answer files')
+    parser.add_argument('--targets', nargs='+', help='Only bring these nodes and their dependencies up to date')
+    parser.add_argument('--dry_run', action='store_true', help='Print the status of every node without running anything')
+    parser.add_argument('--sequential_eval', action='store_true',
+                        help='Evaluate iterations before the last with early-stopping sequential_eval.py')
+    args = parser.parse_args()
+
+    nodes = stl_loop_graph(args.domain, args.max_iter, args.root, args.data_dir,
+                           sequential_eval=args.sequential_eval)
+    if args.targets:
+        nodes = select_targets(nodes, args.targets)
+    cache = ArtifactCache(args.root)
+    try:
+        run_graph(nodes, cache, args.root, args.dry_run)
+    except (subprocess.CalledProcessError, FileNotFoundError, RuntimeError) as e:
+        cache.save()
+        sys.exit(f"Stopped: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Near-duplicate deduplication of training samples.
+
+Later iterations regenerate near-identical rationales for the same image,
+and the model often repeats one line of reasoning across the questions or
+distractors of an image. This stage runs between the samples files and
+final_training_set.py and finds those near-duplicates without comparing
+every pair:
+
+  signature  the compared text (--section: by default the REASONING of a
+             positive sample and the EXPLANATION of a negative one, as the
+             CAPTION shared by every distractor of an image would make
+             their samples look alike) is lowercased, whitespace-collapsed
+             and cut into overlapping --shingle byte shingles; --num_perm
+             multiply-shift hashes of the shingles give a MinHash signature
+             whose agreement estimates Jaccard similarity
+  index      signatures are split into bands (chosen from --threshold) and
+             each band is a bucket key, scoped to the image with --scope
+             image; a sample is a near-duplicate of the first kept sample
+             that shares a bucket and whose estimated similarity reaches
+             --threshold
+
+With --mode drop near-duplicates are removed; with --mode weight every
+sample of a cluster is kept with "weight": 1/cluster size, which
+final_training_set.py uses as a per-record sampling weight.
+
+Across iterations samples are only down-weighted, never dropped: every
+iteration trains from the base model on its own training set, so a sample
+already seen in iteration N-1 is still needed in iteration N. --index_file
+writes the signatures of this run's samples (a .npz), and --prior_index
+reads the ones of earlier iterations; a sample matching one of them gets
+its weight multiplied by --prior_weight. The two are separate files, so
+rerunning an iteration gives the same output.
+
+Usage:
+  python stl/dedup.py -i science_natural/ours/pos_samples_train_it2.jsonl science_natural/ours/neg_train_samples_it2.jsonl \\
+      -o science_natural/ours/pos_samples_dedup_it2.jsonl science_natural/ours/neg_samples_dedup_it2.jsonl \\
+      --index_file science_natural/ours/dedup_index_it2.npz --prior_index science_natural/ours/dedup_index_it1.npz
+"""
+import argparse
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from instrument import StageMetrics, add_metrics_args
+from record_io import RecordWriter, iter_records
+from records import WEIGHT_KEY
+from response_parser import NEG_LAYOUT, POS_LAYOUT, split_sections
+
+NUM_PERM = 128
+SHINGLE = 5
+THRESHOLD = 0.8
+# Weight factor of samples matching an earlier iteration
+PRIOR_WEIGHT = 0.5
+
+space_pattern = re.compile(r'\s+')
+
+
+def sample_text(record, section='rationale'):
+    """
+    The compared text of a training record: one section of its gpt turn
+    ('' when missing), the REASONING or EXPLANATION for 'rationale', or the
+    whole turn for 'all'.
+    """
+    text = next((turn['value'] for turn in record.get('conversations', []) if turn.get('from') == 'gpt'), '')
+    if section == 'all':
+        return text
+    negative = record.get('type') == '2'
+    if section == 'rationale':
+        section = 'EXPLANATION' if negative else 'REASONING'
+    return split_sections(text, NEG_LAYOUT if negative else POS_LAYOUT).get(section) or ''
+
+
+def shingle_hashes(text, shingle=SHINGLE):
+    """Distinct uint64 values of the byte shingles of normalized text (at most 8 bytes, so exact)."""
+    data = np.frombuffer(space_pattern.sub(' ', text.lower()).strip().encode('utf-8'), dtype=np.uint8)
+    if data.size == 0:
+        return data.astype(np.uint64)
+    if data.size < shingle:
+        data = np.concatenate([data, np.zeros(shingle - data.size, dtype=np.uint8)])
+    count = data.size - shingle + 1
+    values = np.zeros(count, dtype=np.uint64)
+    for j in range(shingle):
+        values |= data[j:j + count].astype(np.uint64) << np.uint64(8 * j)
+    return np.unique(values)
+
+
+def lsh_params(num_perm, threshold):
+    """(bands, rows) with bands * rows == num_perm whose S-curve midpoint is closest to threshold."""
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+
+class MinHasher:
+    """MinHash signatures from num_perm seeded multiply-shift hashes."""
+
+    def __init__(self, num_perm=NUM_PERM, shingle=SHINGLE, seed=1):
+        if not 1 <= shingle <= 8:
+            raise ValueError("shingle must be between 1 and 8 bytes")
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.seed = seed
+        # Odd multipliers make x -> a * x mod 2^64 a permutation
+        self.a = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        """uint32 signature of text, or None when it has no shingles."""
+        values = shingle_hashes(text, self.shingle)
+        if values.size == 0:
+            return None
+        # uint64 arithmetic wraps, which is the mod 2^64 of multiply-shift hashing
+        hashed = (self.a[:, None] * values[None, :] + self.b[:, None]) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+class LSHIndex:
+    """Banded LSH over the signatures of kept samples, with the size of each one's cluster."""
+
+    def __init__(self, num_perm=NUM_PERM, threshold=THRESHOLD):
+        self.num_perm = num_perm
+        self.threshold = threshold
+        self.bands, self.rows = lsh_params(num_perm, threshold)
+        self.signatures = []
+        self.scopes = []
+        self.sizes = []
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _keys(self, signature, scope):
+        for band in range(self.bands):
+            yield scope, band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def query(self, signature, scope=''):
+        """Entry of the first kept signature in scope similar to signature, or None."""
+        seen = set()
+        for key in self._keys(signature, scope):
+            for entry in self._buckets.get(key, ()):
+                if entry in seen:
+                    continue
+                seen.add(entry)
+                if np.count_nonzero(self.signatures[entry] == signature) >= self.threshold * self.num_perm:
+                    return entry
+        return None
+
+    def add(self, signature, scope='', size=1):
+        entry = len(self.signatures)
+        self.signatures.append(signature)
+        self.scopes.append(scope)
+        self.sizes.append(size)
+        for key in self._keys(signature, scope):
+            self._buckets.setdefault(key, []).append(entry)
+        return entry
+
+    def save(self, path, hasher, section):
+        # Write through a temporary file so an interrupted run keeps the old index
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(
+                f,
+                signatures=np.array(self.signatures, dtype=np.uint32).reshape(-1, self.num_perm),
+                scopes=np.array(self.scopes, dtype=str),
+                sizes=np.array(self.sizes, dtype=np.int64),
+                params=np.array([self.num_perm, hasher.shingle, hasher.seed, self.threshold]),
+                section=np.array(section),
+            )
+        os.replace(tmp, path)
+
+    def load(self, path, hasher, section):
+        """Add the entries of a saved index, which must use the same parameters and section."""
+        with np.load(path, allow_pickle=False) as data:
+            num_perm, shingle, seed, threshold = data['params']
+            params = (int(num_perm), int(shingle), int(seed), float(threshold))
+            if params != (self.num_perm, hasher.shingle, hasher.seed, self.threshold):
+                raise ValueError(f"{path} was built with num_perm, shingle, seed, threshold = {params}")
+            # Indexes written before --section had a default compared the whole response
+            saved = str(data['section']) if 'section' in data else 'all'
+            if saved != section:
+                raise ValueError(f"{path} was built with --section {saved}")
+            for signature, scope, size in zip(data['signatures'], data['scopes'], data['sizes']):
+                self.add(signature, str(scope), int(size))
+
+
+class Deduplicator:
+    """
+    Assign training records to near-duplicate clusters, keeping the first
+    record of each. Signatures of earlier iterations loaded with load_prior
+    are kept apart: they only mark records as seen before.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, shingle=SHINGLE, threshold=THRESHOLD, section='rationale', scope='image',
+                 seed=1, prior_weight=PRIOR_WEIGHT):
+        self.hasher = MinHasher(num_perm, shingle, seed)
+        self.index = LSHIndex(num_perm, threshold)
+        self.prior = LSHIndex(num_perm, threshold)
+        self.section = section
+        self.scope = scope
+        self.prior_weight = prior_weight
+
+    def load_prior(self, path):
+        self.prior.load(path, self.hasher, self.section)
+
+    def save(self, path):
+        self.index.save(path, self.hasher, self.section)
+
+    def assign(self, record):
+        """
+        Return (entry, is_duplicate, seen_before) for a record: the index entry
+        of its cluster in this run (None for a record without text, which is
+        never a duplicate), whether an earlier record of this run is in the
+        cluster, and whether it matches a sample of an earlier iteration.
+        """
+        signature = self.hasher.signature(sample_text(record, self.section))
+        if signature is None:
+            return None, False, False
+        scope = str(record.get('image', '')) if self.scope == 'image' else ''
+        seen_before = len(self.prior) > 0 and self.prior.query(signature, scope) is not None
+        entry = self.index.query(signature, scope)
+        if entry is None:
+            return self.index.add(signature, scope), False, seen_before
+        self.index.sizes[entry] += 1
+        return entry, True, seen_before
+
+    def drop_duplicates(self, records, stats=None):
+        """
+        Yield the records that are not near-duplicates of an earlier one of
+        this run; those seen in an earlier iteration carry the prior weight.
+        stats counts 'near_duplicate' (dropped) and 'seen_before' records.
+        """
+        for record in records:
+            _, is_duplicate, seen_before = self.assign(record)
+            if is_duplicate:
+                if stats is not None:
+                    stats['near_duplicate'] += 1
+                continue
+            if seen_before and stats is not None:
+                stats['seen_before'] += 1
+            yield with_weight(record, self.prior_weight if seen_before else 1.0)
+
+    def weight(self, entry, seen_before=False):
+        weight = 1.0 if entry is None else 1.0 / self.index.sizes[entry]
+        return weight * self.prior_weight if seen_before else weight
+
+
+def with_weight(record, weight):
+    """The record with its WEIGHT_KEY set, or unchanged for a full weight."""
+    return dict(record, **{WEIGHT_KEY: round(weight, 6)}) if weight < 1.0 else record
+
+
+def dedup_files(input_files, output_files, deduplicator, mode='drop', stats=None):
+    """
+    Deduplicate samples files into output_files; return the records written
+    per file. stats counts 'near_duplicate' records (dropped, or down-weighted
+    in weight mode) and 'seen_before' ones.
+    """
+    totals = []
+    if mode == 'drop':
+        for input_file, output_file in zip(input_files, output_files):
+            with RecordWriter(output_file, indent=2, ensure_ascii=False) as writer:
+                for record in deduplicator.drop_duplicates(iter_records(input_file), stats):
+                    writer.write(record)
+            totals.append(writer.count)
+        return totals
+
+    # Cluster sizes are only final once every file has been read, so weights are written in a second pass
+    entries = []
+    for input_file in input_files:
+        file_entries = []
+        for record in iter_records(input_file):
+            entry, is_duplicate, seen_before = deduplicator.assign(record)
+            file_entries.append((entry, seen_before))
+            if stats is not None:
+                if is_duplicate:
+                    stats['near_duplicate'] += 1
+                if seen_before:
+                    stats['seen_before'] += 1
+        entries.append(file_entries)
+    for input_file, output_file, file_entries in zip(input_files, output_files, entries):
+        with RecordWriter(output_file, indent=2, ensure_ascii=False) as writer:
+            for record, (entry, seen_before) in zip(iter_records(input_file), file_entries):
+                writer.write(with_weight(record, deduplicator.weight(entry, seen_before)))
+        totals.append(writer.count)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drop or down-weight near-duplicate training samples.")
+    parser.add_argument('--input_files', '-i', nargs='+', required=True, help='Samples files (JSON or JSONL)')
+    parser.add_argument('--output_files', '-o', nargs='+', required=True, help='One output file per input file')
+    parser.add_argument('--index_file', default=None,
+                        help="Write this run's signatures to this .npz, the --prior_index of the next iteration")
+    parser.add_argument('--prior_index', nargs='+', default=None,
+                        help='.npz indexes of earlier iterations; samples matching them are down-weighted, never dropped')
+    parser.add_argument('--prior_weight', type=float, default=PRIOR_WEIGHT,
+                        help='Weight factor of samples matching a --prior_index')
+    parser.add_argument('--mode', choices=('drop', 'weight'), default='drop',
+                        help='Drop near-duplicates, or keep them with "weight": 1/cluster size')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Estimated Jaccard similarity of near-duplicates')
+    parser.add_argument('--num_perm', type=int, default=NUM_PERM, help='MinHash signature length')
+    parser.add_argument('--shingle', type=int, default=SHINGLE, help='Shingle length in bytes (1-8)')
+    parser.add_argument('--section', choices=('rationale', 'all', 'CAPTION', 'REASONING', 'EXPLANATION'),
+                        default='rationale',
+                        help='Text compared: the REASONING or EXPLANATION of each sample (rationale), the whole '
+                             'response (all) or one section')
+    parser.add_argument('--scope', choices=('image', 'global'), default='image',
+                        help='Only samples of the same image are duplicates (image), or any two samples (global)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the MinHash functions')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    if len(args.output_files) != len(args.input_files):
+        parser.error(f"--output_files needs one path per input file ({len(args.input_files)})")
+    if not 0 < args.threshold <= 1:
+        parser.error("--threshold must be in (0, 1]")
+    if not 0 < args.prior_weight <= 1:
+        parser.error("--prior_weight must be in (0, 1]")
+    prior_files = args.prior_index or []
+    if args.index_file and any(os.path.abspath(path) == os.path.abspath(args.index_file) for path in prior_files):
+        parser.error("--index_file is rewritten by every run and cannot also be a --prior_index")
+
+    deduplicator = Deduplicator(args.num_perm, args.shingle, args.threshold, args.section, args.scope, args.seed,
+                                args.prior_weight)
+    for path in prior_files:
+        try:
+            deduplicator.load_prior(path)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+    stats = Counter()
+    with StageMetrics.from_args('dedup', args, input_file=args.input_files[0], mode=args.mode) as metrics:
+        totals = dedup_files(args.input_files, args.output_files, deduplicator, args.mode, stats)
+        duplicates = stats['near_duplicate']
+        # Only dropped samples are skipped; the others are kept with a lower weight
+        if args.mode == 'drop':
+            metrics.skip('near_duplicate', duplicates)
+        else:
+            metrics.info['down_weighted'] = duplicates
+        metrics.info.update(seen_before=stats['seen_before'], clusters=len(deduplicator.index))
+        metrics.records_out = sum(totals)
+        metrics.records_in = sum(totals) + (duplicates if args.mode == 'drop' else 0)
+    if args.index_file:
+        deduplicator.save(args.index_file)
+
+    for output_file, total in zip(args.output_files, totals):
+        print(f"{total} samples -> {output_file}")
+    print(f"Near-duplicates: {duplicates} ({'dropped' if args.mode == 'drop' else 'down-weighted'}) "
+          f"in {len(deduplicator.index)} clusters")
+    if prior_files:
+        print(f"Seen in an earlier iteration: {stats['seen_before']} "
+              f"(weight x{args.prior_weight}, {len(deduplicator.prior)} signatures from {', '.join(prior_files)})")
+
+
+if __name__ == '__main__':
+    main()
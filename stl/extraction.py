@@ -1,115 +1,205 @@
-import json
-import re
 import argparse
-
-# Regex patterns for sections
-caption_pattern = r"CAPTION:\s*(.*?)\s*(?:REASONING:|$)"
-reasoning_pattern = r"REASONING:\s*(.*?)\s*(?:CONCLUSION:|$)"
-conclusion_pattern = r"CONCLUSION:\s*(.*)"
-# Patterns for Method2 & Method3
-letter_pattern = r"\(([a-z])\)"
-choice_line_pattern = r"\(([a-z])\)\s*(.+)"
-
-# Threshold for excessive zeros (optional)
-ZERO_THRESHOLD = 50
+from functools import partial
+
+from incremental import content_hash, incremental_extract
+from instrument import StageMetrics, add_metrics_args
+from record_io import RecordWriter, iter_records
+from records import Extraction, skipped_entry
+from response_parser import is_degenerate, parse_pos_response
+from sharding import iter_sharded
+
+
+def skip_reason(caption, rationale, choice):
+    """Return why a parsed response cannot be used, or None if it can."""
+    if not caption:
+        return 'missing_caption'
+    if not rationale:
+        return 'missing_rationale'
+    if not choice:
+        return 'missing_choice'
+    if is_degenerate(rationale):
+        return 'zero_threshold'
+    return None
 
 
-def extract_using_methods(conclusion_text, prompt_text):
+def extract_responses(responses):
     """
-    Attempt Method3 and Method2 on the conclusion text if Method1 failed.
+    Yield ('extracted', record, None) or ('skipped', response, reason) for each model response.
     """
-    # Method3: single letter in conclusion text only
-    matches = re.findall(letter_pattern, conclusion_text)
-    if matches and len(set(matches)) == 1:
-        return f"({list(set(matches))[0]})"  # Method3
-
-    # Method2: map prompt choices to occurrences in conclusion text
-    choices_mapping = {}
-    prompt_block = prompt_text.split("Question:")[-1]
-    for line in prompt_block.splitlines():
-        m = re.match(choice_line_pattern, line.strip())
-        if m:
-            choices_mapping[m.group(1)] = m.group(2).strip()
-
-    found = {}
-    for letter, text in choices_mapping.items():
-        if re.search(re.escape(text), conclusion_text, re.IGNORECASE):
-            found[letter] = text
-    if len(found) == 1:
-        return f"({list(found.keys())[0]})"  # Method2
+    for data in responses:
+        qid = data.get('question_id')
+        prompt_text = data.get('prompt', '')
+        resp = data.get('text', '')
 
-    return None
+        # Extract sections and the chosen letter in a single pass
+        caption, rationale, choice = parse_pos_response(resp, prompt_text)
 
+        # Skip if anything missing or bad
+        reason = skip_reason(caption, rationale, choice)
+        if reason:
+            yield 'skipped', data, reason
+            continue
 
-def process_files(input_file, extracted_output_file, skipped_output_file=None):
-    extracted = []
-    skipped = []
+        yield 'extracted', Extraction(qid, caption, rationale, choice), None
 
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line)
-            qid = data.get('question_id')
-            prompt_text = data.get('prompt', '')
-            resp = data.get('text', '')
 
-            # Extract sections
-            cap_m = re.search(caption_pattern, resp, re.DOTALL|re.IGNORECASE)
-            reason_m = re.search(reasoning_pattern, resp, re.DOTALL|re.IGNORECASE)
-            concl_m = re.search(conclusion_pattern, resp, re.DOTALL|re.IGNORECASE)
+def response_key(record):
+    """Identify a prompt by question id and prompt text (negative prompts share question ids)."""
+    return str(record.get('question_id')), record.get('prompt', record.get('text'))
 
-            caption = cap_m.group(1).strip() if cap_m else None
-            rationale = reason_m.group(1).strip() if reason_m else None
 
-            # Extract conclusion text if present
-            conclusion_text = concl_m.group(1).strip() if concl_m else ''
+def group_by_question(keys):
+    """Map question id -> the distinct response keys with that id."""
+    grouped = {}
+    for key in keys:
+        grouped.setdefault(key[0], [])
+        if key not in grouped[key[0]]:
+            grouped[key[0]].append(key)
+    return grouped
 
-            # Method1: direct letter extraction from conclusion section
-            choice = None
-            if conclusion_text:
-                m = re.search(letter_pattern, conclusion_text)
-                if m:
-                    choice = f"({m.group(1)})"
 
-            # Fallbacks: Method3 then Method2, both using conclusion_text
-            if not choice:
-                choice = extract_using_methods(conclusion_text, prompt_text)
+def question_part(prompt):
+    """The prompt from its last "Question:" on: the part telling apart the prompts of one question id."""
+    prompt = prompt or ''
+    start = prompt.rfind('Question:')
+    return prompt[start:] if start >= 0 else prompt
 
-            # Skip if anything missing or bad
-            if not (caption and rationale and choice):
-                skipped.append(data)
-                continue
-            if rationale.count('0') > ZERO_THRESHOLD:
-                skipped.append(data)
+
+def match_key(key, candidates):
+    """
+    Return key if it is among candidates, else the only candidate with the
+    same question id and question_part (the instruction preamble before it
+    may differ), else None.
+    """
+    same_id = candidates.get(key[0], [])
+    if key in same_id:
+        return key
+    same_question = [candidate for candidate in same_id if question_part(candidate[1]) == question_part(key[1])]
+    return same_question[0] if len(same_question) == 1 else None
+
+
+def load_retries(retry_files, extract_fn):
+    """
+    Map response_key -> the first usable extraction among the responses to
+    retry.py prompts in retry_files, read in order.
+    """
+    recovered = {}
+    for path in retry_files:
+        for response in iter_records(path):
+            key = response_key(response)
+            if key in recovered:
                 continue
+            for kind, record, _ in extract_fn([response]):
+                if kind == 'extracted':
+                    recovered[key] = record
+    return recovered
 
-            extracted.append({
-                'question_id': qid,
-                'caption': caption,
-                'rationale': rationale,
-                'generated_choice': choice
-            })
 
-    # Write outputs as JSON arrays
-    with open(extracted_output_file, 'w', encoding='utf-8') as out:
-        json.dump(extracted, out, ensure_ascii=False, indent=2)
+def extract_with_retries(extract_fn, recovered, candidates, responses):
+    """
+    extract_fn over responses, with each skipped response replaced by the
+    recovered extraction of its prompt when there is one (matched like
+    retry.py merge does, see match_key).
+    """
+    for data in responses:
+        for kind, record, reason in extract_fn([data]):
+            if kind == 'skipped':
+                key = match_key(response_key(data), candidates)
+                if key is not None:
+                    kind, record, reason = 'extracted', recovered[key], None
+            yield kind, record, reason
 
-    if skipped_output_file:
-        with open(skipped_output_file, 'w', encoding='utf-8') as skipf:
-            json.dump(skipped, skipf, ensure_ascii=False, indent=2)
 
-    print(f"Extracted {len(extracted)} entries to {extracted_output_file}")
+def retry_extract_fn(extract_fn, retry_files):
+    """
+    Return (fn, recovered count, checkpoint salt): extract_fn applying the
+    retry responses of retry_files, or extract_fn itself without them.
+    """
+    if not retry_files:
+        return extract_fn, 0, None
+    recovered = load_retries(retry_files, extract_fn)
+    salt = content_hash([[list(key), dict(record)] for key, record in recovered.items()])
+    fn = partial(extract_with_retries, extract_fn, recovered, group_by_question(recovered))
+    return fn, len(recovered), salt
+
+
+def write_extractions(results, extracted_output_file, skipped_output_file=None, stats=None, full_skipped=False):
+    """
+    Stream extraction results into the extracted and skipped outputs; return their counts.
+    Skip reasons are counted in stats when given. Skipped responses are
+    written as {question_id, reason, row} references unless full_skipped.
+    """
+    skipped_count = 0
+    with RecordWriter(extracted_output_file, indent=2, ensure_ascii=False) as out:
+        skipf = RecordWriter(skipped_output_file, indent=2, ensure_ascii=False) if skipped_output_file else None
+        try:
+            # One result per response, in input order
+            for row, (kind, record, reason) in enumerate(results):
+                if kind == 'extracted':
+                    out.write(record)
+                else:
+                    skipped_count += 1
+                    if stats is not None:
+                        stats[reason] += 1
+                    if skipf:
+                        skipf.write(skipped_entry(record, reason, row, full_skipped))
+        finally:
+            if skipf:
+                skipf.close()
+    return out.count, skipped_count
+
+
+def process_files(input_file, extracted_output_file, skipped_output_file=None, workers=1,
+                  incremental=False, checkpoint_file=None, metrics=None, full_skipped=False, retry_files=None):
+    metrics = metrics or StageMetrics('extraction')
+    with metrics:
+        extract_fn, recovered, salt = retry_extract_fn(extract_responses, retry_files)
+        if retry_files:
+            print(f"{recovered} usable retry responses in {', '.join(retry_files)}")
+        if incremental:
+            # Only parse responses that are new or changed since the last checkpoint
+            parsed, extracted_count, skipped_count = incremental_extract(
+                input_file, extract_fn, extracted_output_file, skipped_output_file, checkpoint_file,
+                workers, metrics.skipped, full_skipped, salt
+            )
+            print(f"Parsed {parsed} new or changed responses")
+            metrics.records_in = parsed
+        else:
+            # Responses are streamed through the parser, sharded over worker processes when workers > 1;
+            # outputs are JSON arrays, or JSONL for .jsonl paths
+            extracted_count, skipped_count = write_extractions(
+                iter_sharded(input_file, extract_fn, workers), extracted_output_file, skipped_output_file,
+                metrics.skipped, full_skipped
+            )
+            metrics.records_in = extracted_count + skipped_count
+        metrics.records_out = extracted_count
+
+    print(f"Extracted {extracted_count} entries to {extracted_output_file}")
     if skipped_output_file:
-        print(f"Skipped {len(skipped)} entries to {skipped_output_file}")
+        print(f"Skipped {skipped_count} entries to {skipped_output_file}")
 
 
 def main():
     p = argparse.ArgumentParser(description="Extract caption, rationale, and choice with conclusion-based fallbacks")
     p.add_argument('-i','--input_file', required=True, help='Path to input JSONL with model responses')
-    p.add_argument('-e','--extracted_output_file', required=True, help='Path to output JSON file (array)')
-    p.add_argument('-s','--skipped_output_file', required=False, help='Path to output JSON file for skipped entries (array)')
+    p.add_argument('-e','--extracted_output_file', required=True, help='Path to output JSON file (array), or JSONL if it ends in .jsonl')
+    p.add_argument('-s','--skipped_output_file', required=False, help='Path to output JSON file for skipped entries (array), or JSONL if it ends in .jsonl')
+    p.add_argument('-w','--workers', type=int, default=1, help='Number of worker processes for sharded parsing')
+    p.add_argument('--incremental', action='store_true',
+                   help='Only parse responses added or changed since the last run, using a checkpoint sidecar')
+    p.add_argument('--checkpoint_file', required=False,
+                   help='Path to the incremental checkpoint (default: <extracted_output_file>.ckpt)')
+    p.add_argument('--full_skipped', action='store_true',
+                   help='Copy skipped responses in full instead of writing {question_id, reason, row} references')
+    p.add_argument('-r', '--retry_files', nargs='+', default=None,
+                   help='Responses to retry.py prompts; a skipped response is replaced by the first usable retry of its prompt')
+    add_metrics_args(p)
     args = p.parse_args()
-    process_files(args.input_file, args.extracted_output_file, args.skipped_output_file)
+    process_files(args.input_file, args.extracted_output_file, args.skipped_output_file, args.workers,
+                  args.incremental, args.checkpoint_file,
+                  StageMetrics.from_args('extraction', args, input_file=args.input_file), args.full_skipped,
+                  args.retry_files)
+
 
 if __name__ == '__main__':
     main()
-
@@ -1,89 +1,84 @@
-import json
-import re
 import argparse
 
-# Updated regex patterns
-caption_pattern = r"CAPTION:\s*(.*?)\s*(?:EXPLANATION:|$)"
-explanation_pattern = r"EXPLANATION:\s*(.*)"
-# Pattern to find choices in question block
-choice_line_pattern = r"\(([a-z])\)\s*(.+)"
-# Pattern to find 'Explain why...' incorrect choice
-incorrect_choice_pattern = r"Explain why this answer is wrong:\s*(\([a-z]\))"
-
-# Threshold for excessive zeros in explanation
-ZERO_THRESHOLD = 50
-
-def process_files(input_file, extracted_output_file, skipped_output_file=None):
-    extracted = []
-    skipped = []
-
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line)
-            qid = data.get('question_id')
-            prompt_text = data.get('prompt', '')  # <-- FIXED: now correctly using 'prompt'
-            resp = data.get('text', '')  # the model's response output
-
-            # Extract CAPTION and EXPLANATION
-            cap_m = re.search(caption_pattern, resp, re.DOTALL | re.IGNORECASE)
-            expl_m = re.search(explanation_pattern, resp, re.DOTALL | re.IGNORECASE)
-
-            caption = cap_m.group(1).strip() if cap_m else None
-            explanation = expl_m.group(1).strip() if expl_m else None
-
-            # Extract generated_choice (correct choice) from "The correct choice is ..."
-            correct_choice = None
-            if "The correct choice is" in prompt_text:
-                lines = prompt_text.splitlines()
-                for line in lines:
-                    if line.startswith("The correct choice is"):
-                        match = re.search(r"\(([a-z])\)", line)
-                        if match:
-                            correct_choice = f"({match.group(1)})"
-                            break
-
-            # Extract incorrect_choice from "Explain why this answer is wrong: (X)"
-            incorrect_choice = None
-            m = re.search(incorrect_choice_pattern, prompt_text, re.IGNORECASE)
-            if m:
-                incorrect_choice = m.group(1)
-
-            # Skip if any important fields missing
-            if not (caption and explanation and correct_choice and incorrect_choice):
-                skipped.append(data)
-                continue
-            if explanation.count('0') > ZERO_THRESHOLD:
-                skipped.append(data)
-                continue
-
-            extracted.append({
-                'question_id': qid,
-                'caption': caption,
-                'explanation': explanation,
-                'generated_choice': correct_choice,
-                'incorrect_choice': incorrect_choice
-            })
-
-    # Write extracted and skipped records
-    with open(extracted_output_file, 'w', encoding='utf-8') as out:
-        json.dump(extracted, out, ensure_ascii=False, indent=2)
-
+from extraction import retry_extract_fn, write_extractions
+from instrument import StageMetrics, add_metrics_args
+from records import NegExtraction
+from response_parser import is_degenerate, parse_neg_response
+from sharding import iter_sharded
+
+
+def skip_reason(caption, explanation, correct_choice, incorrect_choice):
+    """Return why a parsed negative response cannot be used, or None if it can."""
+    if not caption:
+        return 'missing_caption'
+    if not explanation:
+        return 'missing_explanation'
+    if not (correct_choice and incorrect_choice):
+        return 'missing_choice'
+    if is_degenerate(explanation):
+        return 'zero_threshold'
+    return None
+
+
+def extract_responses(responses):
+    """
+    Yield ('extracted', record, None) or ('skipped', response, reason) for each model response.
+    """
+    for data in responses:
+        qid = data.get('question_id')
+        prompt_text = data.get('prompt', '')
+        resp = data.get('text', '')
+
+        # Extract CAPTION and EXPLANATION, plus the correct choice from
+        # "The correct choice is ..." and the incorrect choice from
+        # "Explain why this answer is wrong: (X)"
+        caption, explanation, correct_choice, incorrect_choice = parse_neg_response(resp, prompt_text)
+
+        # Skip if any important fields missing or degenerate
+        reason = skip_reason(caption, explanation, correct_choice, incorrect_choice)
+        if reason:
+            yield 'skipped', data, reason
+            continue
+
+        yield 'extracted', NegExtraction(qid, caption, explanation, correct_choice, incorrect_choice), None
+
+
+def process_files(input_file, extracted_output_file, skipped_output_file=None, workers=1, metrics=None,
+                  full_skipped=False, retry_files=None):
+    metrics = metrics or StageMetrics('extraction_neg')
+    with metrics:
+        extract_fn, recovered, _ = retry_extract_fn(extract_responses, retry_files)
+        if retry_files:
+            print(f"{recovered} usable retry responses in {', '.join(retry_files)}")
+        # Write extracted and skipped records as they are parsed, in input order
+        extracted_count, skipped_count = write_extractions(
+            iter_sharded(input_file, extract_fn, workers), extracted_output_file, skipped_output_file,
+            metrics.skipped, full_skipped
+        )
+        metrics.records_in = extracted_count + skipped_count
+        metrics.records_out = extracted_count
+
+    print(f"Extracted {extracted_count} entries to {extracted_output_file}")
     if skipped_output_file:
-        with open(skipped_output_file, 'w', encoding='utf-8') as skipf:
-            json.dump(skipped, skipf, ensure_ascii=False, indent=2)
+        print(f"Skipped {skipped_count} entries to {skipped_output_file}")
 
-    print(f"Extracted {len(extracted)} entries to {extracted_output_file}")
-    if skipped_output_file:
-        print(f"Skipped {len(skipped)} entries to {skipped_output_file}")
 
 def main():
     p = argparse.ArgumentParser(description="Extract caption, explanation, correct and incorrect choices from model outputs.")
     p.add_argument('-i', '--input_file', required=True, help='Path to input JSONL with model responses')
-    p.add_argument('-e', '--extracted_output_file', required=True, help='Path to output JSON file (array)')
-    p.add_argument('-s', '--skipped_output_file', required=False, help='Path to output JSON file for skipped entries (array)')
+    p.add_argument('-e', '--extracted_output_file', required=True, help='Path to output JSON file (array), or JSONL if it ends in .jsonl')
+    p.add_argument('-s', '--skipped_output_file', required=False, help='Path to output JSON file for skipped entries (array), or JSONL if it ends in .jsonl')
+    p.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes for sharded parsing')
+    p.add_argument('--full_skipped', action='store_true',
+                   help='Copy skipped responses in full instead of writing {question_id, reason, row} references')
+    p.add_argument('-r', '--retry_files', nargs='+', default=None,
+                   help='Responses to retry.py prompts; a skipped response is replaced by the first usable retry of its prompt')
+    add_metrics_args(p)
     args = p.parse_args()
-    process_files(args.input_file, args.extracted_output_file, args.skipped_output_file)
+    process_files(args.input_file, args.extracted_output_file, args.skipped_output_file, args.workers,
+                  StageMetrics.from_args('extraction_neg', args, input_file=args.input_file), args.full_skipped,
+                  args.retry_files)
+
 
 if __name__ == '__main__':
     main()
-
@@ -1,43 +1,225 @@
 # -*- coding: utf-8 -*-
-import json
-import random
+"""
+Merge and shuffle training records from several files into one training set.
+
+The shuffle streams: every record gets a random 64-bit key from a seeded
+generator, records are held in chunks of at most --chunk_size, and full
+chunks are sorted by key and spilled to temporary run files that are merged
+back in key order. The output only depends on the inputs and --seed, not on
+--chunk_size, so reruns are reproducible and can be cached.
+
+--weights scales how many times each input file's records are used (0.5
+keeps a random half, 2 repeats every record twice), and --stratify spreads
+positive (type "1") and negative (type "2") records evenly over the output
+instead of leaving their mix to chance. A record's own "weight" field (see
+dedup.py) multiplies its file's weight and is removed from the output.
+
+--lengths writes the token-length sidecar of the output
+(<output>.lengths.jsonl, see tokens.py) in the shuffled order. The lengths
+of each input come from its own sidecar when it was measured with the same
+--tokenizer, and are computed with --tokenizer otherwise.
+"""
 import argparse
+import heapq
+import os
+import random
+
+from compact_dataset import iter_training_records, write_compact
+from instrument import StageMetrics, add_metrics_args
+from record_io import SORT_CHUNK_SIZE, ExternalSort, RecordWriter, write_records
+from records import WEIGHT_KEY
+from tokens import (BUCKET_SIZE, iter_with_lengths, length_entry, lengths_path, load_token_counter,
+                    sample_length, sidecar_tokenizer)
+
+CHUNK_SIZE = SORT_CHUNK_SIZE
+
+# Key under which a record carries its sidecar entry through the shuffle
+LENGTH_KEY = '_length'
+
+
+class ExternalShuffle(ExternalSort):
+    """Shuffle a stream of records while holding at most chunk_size of them in memory."""
+
+    def __init__(self, rng, chunk_size=CHUNK_SIZE, tmp_dir=None):
+        super().__init__(chunk_size, tmp_dir)
+        self.rng = rng
+
+    def add(self, record):
+        super().add(self.rng.getrandbits(64), record)
+
+
+def interleave(streams):
+    """
+    Merge shuffled (count, records) streams so that each one is spread evenly
+    over the output: a stream holding 30% of the records contributes about
+    3 of every 10 records throughout.
+    """
+    iterators = [iter(records) for _, records in streams]
+    counts = [count for count, _ in streams]
+    heap = [(0.5 / count, i, 0) for i, count in enumerate(counts) if count]
+    heapq.heapify(heap)
+    while heap:
+        _, i, taken = heapq.heappop(heap)
+        yield next(iterators[i])
+        taken += 1
+        if taken < counts[i]:
+            heapq.heappush(heap, ((taken + 0.5) / counts[i], i, taken))
+
+
+def _repeats(rng, weight):
+    # floor(weight) copies plus one more with probability frac(weight)
+    whole = int(weight)
+    return whole + (rng.random() < weight - whole)
+
+
+def attach_lengths(records, count_tokens, bucket_size=BUCKET_SIZE, lengths_file=None, tokenizer='approx'):
+    """
+    Yield copies of the records carrying their sidecar entry under LENGTH_KEY,
+    read from lengths_file when given (it must be measured with tokenizer) and
+    computed with count_tokens otherwise.
+    """
+    if lengths_file:
+        pairs = ((record, dict(entry, bucket=entry['length'] // bucket_size))
+                 for record, entry in iter_with_lengths(records, lengths_file, tokenizer))
+    else:
+        pairs = ((record, length_entry(record, sample_length(record, count_tokens), bucket_size, tokenizer))
+                 for record in records)
+    for record, entry in pairs:
+        yield dict(record, **{LENGTH_KEY: entry})
+
+
+def reusable_sidecar(path, tokenizer):
+    """The sidecar of an input file when it exists and was measured with tokenizer, else None."""
+    lengths_file = lengths_path(path)
+    if not os.path.exists(lengths_file):
+        return None
+    measured = sidecar_tokenizer(lengths_file)
+    if measured != tokenizer:
+        print(f"{lengths_file} was measured with {measured or 'an unrecorded tokenizer'}; recomputing with {tokenizer}")
+        return None
+    return lengths_file
+
+
+def detach_lengths(records, lengths_file):
+    """Yield the records without their sidecar entries, writing those to lengths_file."""
+    with RecordWriter(lengths_file) as writer:
+        for record in records:
+            writer.write(record[LENGTH_KEY])
+            yield {key: value for key, value in record.items() if key != LENGTH_KEY}
+
+
+def merge_and_shuffle(record_sources, seed=0, weights=None, stratify=False, chunk_size=CHUNK_SIZE, tmp_dir=None):
+    """
+    Yield the records of several record iterables in a seeded shuffled order.
+    weights gives one sampling weight per source, which a record's
+    WEIGHT_KEY multiplies; with stratify, records are shuffled per "type" and
+    interleaved proportionally.
+    """
+    rng = random.Random(seed)
+    strata = {}
+    for index, records in enumerate(record_sources):
+        weight = 1.0 if weights is None else weights[index]
+        for record in records:
+            record_weight = weight
+            if WEIGHT_KEY in record:
+                record_weight *= record[WEIGHT_KEY]
+                record = {key: value for key, value in record.items() if key != WEIGHT_KEY}
+            copies = 1 if record_weight == 1.0 else _repeats(rng, record_weight)
+            if not copies:
+                continue
+            stratum = record.get('type') if stratify else None
+            if stratum not in strata:
+                strata[stratum] = ExternalShuffle(rng, chunk_size, tmp_dir)
+            for _ in range(copies):
+                strata[stratum].add(record)
+
+    if len(strata) == 1:
+        yield from next(iter(strata.values()))
+    elif strata:
+        # Order strata by name only, so ties between equally sized strata do not depend on the shuffle objects
+        ordered = sorted(strata.items(), key=lambda item: str(item[0]))
+        yield from interleave([(shuffle.count, shuffle) for _, shuffle in ordered])
+
 
 def main():
     parser = argparse.ArgumentParser(
         description="Merge and shuffle multiple JSON array files into a single output file."
     )
     parser.add_argument(
-        "--input_files", 
-        required=True, 
-        nargs="+", 
-        help="Paths to the input JSON files (each should contain a JSON array)"
+        "--input_files",
+        required=True,
+        nargs="+",
+        help="Paths to the input JSON files (each should contain a JSON array) or JSONL files"
     )
     parser.add_argument(
         "--output_file",
         required=True,
         help="Path for the merged and shuffled output JSON file"
     )
-    
-    args = parser.parse_args()
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write the output in the compact template-interned format (see compact_dataset.py)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the shuffle (and of --weights sampling)")
+    parser.add_argument(
+        "--weights",
+        type=float,
+        nargs="+",
+        default=None,
+        help="One sampling weight per input file, e.g. 1 0.5 to keep half of the second file's records"
+    )
+    parser.add_argument(
+        "--stratify",
+        action="store_true",
+        help='Interleave positive (type "1") and negative (type "2") records evenly'
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Records held in memory before spilling a sorted run to disk"
+    )
+    parser.add_argument("--tmp_dir", default=None, help="Directory for the spilled runs (default: system temp)")
+    parser.add_argument(
+        "--lengths",
+        action="store_true",
+        help="Write the token lengths of the output to <output>.lengths.jsonl, reusing the inputs' sidecars"
+    )
+    parser.add_argument("--tokenizer", default="approx",
+                        help="Tokenizer of the lengths; input sidecars measured with another one are recomputed")
+    parser.add_argument("--bucket_size", type=int, default=BUCKET_SIZE, help="Width of the sidecar length buckets")
 
-    merged_data = []
-    # Iterate through each provided input file.
-    for filepath in args.input_files:
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            merged_data.extend(data)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    if args.weights is not None and len(args.weights) != len(args.input_files):
+        parser.error(f"--weights needs one value per input file ({len(args.input_files)})")
+    if args.weights is not None and min(args.weights) < 0:
+        parser.error("--weights must not be negative")
 
-    # Shuffle the merged list.
-    random.shuffle(merged_data)
+    with StageMetrics.from_args("final_training_set", args, output_file=args.output_file) as metrics:
+        # Iterate through each provided input file.
+        sources = (iter_training_records(filepath) for filepath in args.input_files)
+        if args.lengths:
+            count_tokens = load_token_counter(args.tokenizer)
+            sidecars = [reusable_sidecar(filepath, args.tokenizer) for filepath in args.input_files]
+            sources = (attach_lengths(records, count_tokens, args.bucket_size, sidecar, args.tokenizer)
+                       for records, sidecar in zip(sources, sidecars))
+        merged_data = merge_and_shuffle(sources, args.seed, args.weights, args.stratify, args.chunk_size,
+                                        args.tmp_dir)
+        if args.lengths:
+            merged_data = detach_lengths(merged_data, lengths_path(args.output_file))
 
-    # Write the shuffled list to the output file as a JSON array.
-    with open(args.output_file, "w", encoding="utf-8") as f:
-        json.dump(merged_data, f, indent=4)
+        # Write the shuffled records to the output file as a JSON array (or JSONL), or compacted.
+        if args.compact:
+            total = write_compact(args.output_file, merged_data)
+        else:
+            total = write_records(args.output_file, merged_data, indent=4)
+        metrics.records_in = metrics.records_out = total
 
-    print(f"Merged and shuffled {len(merged_data)} entries into {args.output_file}")
+    print(f"Merged and shuffled {total} entries into {args.output_file}")
+    if args.lengths:
+        print(f"Token lengths -> {lengths_path(args.output_file)}")
 
 if __name__ == "__main__":
     main()
-
-
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Per-domain gold answer cache.
+
+correct_answers_*.json holds the answers of every domain. The first load
+for a given questions file keeps only that domain's ids and writes them to
+a marshal cache next to the answers file
+(<answers_file>.<questions file name>.gold) as a key tuple, a small table
+of distinct answer strings and one code byte per key. Later loads rebuild
+the dict from that cache without parsing JSON, and every answer is one of
+the interned table strings, so the dict holds no per-record copies.
+"""
+import json
+import marshal
+import os
+import string
+import sys
+
+from question_store import open_question_store
+from record_io import open_text
+
+CACHE_VERSION = 1
+
+# Interned answer letters shared by every cache
+LETTERS = tuple(sys.intern(f"({c})") for c in string.ascii_lowercase)
+
+_loaded = {}
+
+
+def _stamp(path):
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def default_cache_path(answers_file, questions_file=None):
+    domain_key = os.path.splitext(os.path.basename(questions_file))[0] if questions_file else 'all'
+    return f"{answers_file}.{domain_key}.gold"
+
+
+def _build(answers_file, questions_file):
+    with open_text(answers_file) as f:
+        answers = json.load(f)
+    if questions_file:
+        store = open_question_store(questions_file)
+        keys = tuple(qid for qid in store if qid in answers)
+    else:
+        keys = tuple(answers)
+
+    table = list(LETTERS)
+    index = {letter: i for i, letter in enumerate(table)}
+    codes = []
+    for qid in keys:
+        value = answers[qid]
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(table)
+            table.append(sys.intern(value))
+        codes.append(code)
+    # One byte per key unless there are more than 256 distinct answers
+    return keys, tuple(table), bytes(codes) if len(table) <= 256 else tuple(codes)
+
+
+def load_gold_answers(answers_file, questions_file=None, cache_file=None):
+    """
+    Return {question_id: answer} for the questions in questions_file (or all
+    answers when it is None), using and refreshing the on-disk cache.
+    """
+    cache_file = cache_file or default_cache_path(answers_file, questions_file)
+    stamps = (_stamp(answers_file), _stamp(questions_file))
+    cached = _loaded.get(cache_file)
+    if cached and cached[0] == stamps:
+        return cached[1]
+
+    data = None
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                data = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            data = None
+        if not data or data[0] != CACHE_VERSION or tuple(data[1]) != stamps:
+            data = None
+
+    if data is None:
+        keys, table, codes = _build(answers_file, questions_file)
+        data = (CACHE_VERSION, stamps, keys, table, codes)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            marshal.dump(data, f)
+        os.replace(tmp_file, cache_file)
+
+    _, _, keys, table, codes = data
+    table = tuple(sys.intern(value) for value in table)
+    answers = dict(zip(keys, map(table.__getitem__, codes)))
+    _loaded[cache_file] = (stamps, answers)
+    return answers
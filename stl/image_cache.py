@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Image manifest and pre-padded pixel cache for the question files.
+
+Every question points at an image under playground/data/m3cot/images/, and
+each model_vqa.py pass and training epoch decodes and pads the same images
+again. This stage runs once on the CPU:
+
+  manifest  one JSONL record per distinct image:
+            {"image", "exists", "width", "height", "bytes"}
+            Dimensions come from the PNG header (PIL for other formats), so
+            missing or unreadable images are reported before any GPU job.
+  cache     <prefix>.npy, a uint8 (N, size, size, 3) array written as a
+            NumPy memmap, and <prefix>.json listing the image path of every
+            row. Images are padded to a square with the CLIP mean color and
+            resized with bicubic filtering, the same as
+            --image_aspect_ratio pad followed by the CLIP 336px processor.
+
+ImageCache opens a cache read-only and returns the pixels of an image path,
+or the normalized CHW pixel_values the vision tower expects.
+
+Usage:
+  python stl/image_cache.py --question_files playground/data/folder/questions_*.jsonl \\
+      --manifest_file playground/data/folder/images.jsonl
+  python stl/image_cache.py --question_files playground/data/folder/questions_*.jsonl \\
+      --manifest_file playground/data/folder/images.jsonl --cache_prefix playground/data/folder/images_336 --workers 8
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from record_io import RecordWriter, iter_records
+
+IMAGE_SIZE = 336
+# openai/clip-vit-large-patch14-336 image processor statistics
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+# Padding color LLaVA uses for --image_aspect_ratio pad
+BACKGROUND = tuple(int(x * 255) for x in CLIP_MEAN)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_size(path):
+    """(width, height) from a PNG header, or None if the file is not a PNG."""
+    with open(path, 'rb') as f:
+        head = f.read(24)
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def image_size(path):
+    """(width, height) of an image file; raises ValueError if it cannot be read."""
+    size = png_size(path)
+    if size is not None:
+        return size
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ValueError(f"{path} is not a PNG and Pillow is not installed") from None
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except OSError as e:
+        raise ValueError(f"Cannot read {path}: {e}") from None
+
+
+def iter_image_paths(question_files):
+    """Yield the distinct image paths of the question files in order of first use."""
+    seen = set()
+    for question_file in question_files:
+        for record in iter_records(question_file):
+            image = record.get('image')
+            if image and image not in seen:
+                seen.add(image)
+                yield image
+
+
+def manifest_entry(image, image_root='.'):
+    path = os.path.join(image_root, image)
+    entry = {"image": image, "exists": os.path.isfile(path), "width": None, "height": None, "bytes": None}
+    if entry["exists"]:
+        entry["bytes"] = os.path.getsize(path)
+        try:
+            entry["width"], entry["height"] = image_size(path)
+        except ValueError as e:
+            entry["error"] = str(e)
+    return entry
+
+
+def build_manifest(question_files, manifest_file, image_root='.'):
+    """Write the manifest of every image referenced by the question files and return its entries."""
+    entries = []
+    with RecordWriter(manifest_file) as writer:
+        for image in iter_image_paths(question_files):
+            entry = manifest_entry(image, image_root)
+            writer.write(entry)
+            entries.append(entry)
+    return entries
+
+
+def load_padded(path, size=IMAGE_SIZE):
+    """Decode an image, pad it to a square with the CLIP mean color and resize it to size x size (uint8 HWC)."""
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image = image.convert('RGB')
+    width, height = image.size
+    if width != height:
+        square = Image.new('RGB', (max(width, height),) * 2, BACKGROUND)
+        square.paste(image, ((max(width, height) - width) // 2, (max(width, height) - height) // 2))
+        image = square
+    if image.size != (size, size):
+        image = image.resize((size, size), Image.BICUBIC)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def _fill_rows(cache_file, image_root, size, rows):
+    import numpy as np
+
+    pixels = np.load(cache_file, mmap_mode='r+')
+    for row, image in rows:
+        pixels[row] = load_padded(os.path.join(image_root, image), size)
+    pixels.flush()
+    return len(rows)
+
+
+def build_cache(images, cache_prefix, image_root='.', size=IMAGE_SIZE, workers=1, chunk=64):
+    """Write the padded pixels of images to <cache_prefix>.npy and the row index to <cache_prefix>.json."""
+    import numpy as np
+
+    cache_file = cache_prefix + '.npy'
+    pixels = np.lib.format.open_memmap(cache_file, mode='w+', dtype=np.uint8, shape=(len(images), size, size, 3))
+    del pixels
+    rows = list(enumerate(images))
+    batches = [rows[i:i + chunk] for i in range(0, len(rows), chunk)]
+    fill = partial(_fill_rows, cache_file, image_root, size)
+    if workers <= 1:
+        for batch in batches:
+            fill(batch)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fill, batches))
+    with open(cache_prefix + '.json', 'w', encoding='utf-8') as f:
+        json.dump({"size": size, "background": list(BACKGROUND), "images": list(images)}, f)
+    return len(images)
+
+
+class ImageCache:
+    """Read-only view of a pixel cache, indexed by the image path used in the question files."""
+
+    def __init__(self, cache_prefix):
+        import numpy as np
+
+        with open(cache_prefix + '.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.size = meta['size']
+        self.rows = {image: row for row, image in enumerate(meta['images'])}
+        self.pixels = np.load(cache_prefix + '.npy', mmap_mode='r')
+
+    def __contains__(self, image):
+        return image in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, image):
+        """uint8 (size, size, 3) pixels of an image."""
+        return self.pixels[self.rows[image]]
+
+    def pixel_values(self, image):
+        """float32 (3, size, size) pixels normalized with the CLIP mean and std."""
+        import numpy as np
+
+        values = self[image].astype(np.float32) / 255.0
+        values = (values - np.array(CLIP_MEAN, dtype=np.float32)) / np.array(CLIP_STD, dtype=np.float32)
+        return values.transpose(2, 0, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the images of question files and cache their padded pixels.")
+    parser.add_argument('--question_files', nargs='+', required=True, help='Question JSONL files')
+    parser.add_argument('--manifest_file', required=True, help='Output image manifest (JSONL)')
+    parser.add_argument('--image_root', default='.', help='Directory the image paths are relative to')
+    parser.add_argument('--cache_prefix', default=None,
+                        help='Also write the padded pixel cache to <prefix>.npy and <prefix>.json (needs Pillow and NumPy)')
+    parser.add_argument('--size', type=int, default=IMAGE_SIZE, help='Side of the cached square images')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes decoding images for the cache')
+    parser.add_argument('--allow_missing', action='store_true',
+                        help='Exit successfully even when images are missing or unreadable')
+    args = parser.parse_args()
+    if args.cache_prefix:
+        try:
+            import numpy  # noqa: F401
+            import PIL  # noqa: F401
+        except ImportError as e:
+            parser.error(f"--cache_prefix needs Pillow and NumPy ({e})")
+
+    entries = build_manifest(args.question_files, args.manifest_file, args.image_root)
+    bad = [entry for entry in entries if not entry['exists'] or entry.get('error')]
+    print(f"{len(entries)} images, {len(bad)} missing or unreadable -> {args.manifest_file}")
+    for entry in bad[:10]:
+        print(f"  {entry['image']}: {entry.get('error', 'missing')}")
+
+    if args.cache_prefix:
+        images = [entry['image'] for entry in entries if entry['exists'] and not entry.get('error')]
+        total = build_cache(images, args.cache_prefix, args.image_root, args.size, args.workers)
+        print(f"Cached {total} images at {args.size}x{args.size} -> {args.cache_prefix}.npy")
+
+    if bad and not args.allow_missing:
+        sys.exit(f"{len(bad)} images are missing or unreadable; see {args.manifest_file}")
+
+
+if __name__ == '__main__':
+    main()
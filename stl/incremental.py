@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental extraction driven by a sidecar checkpoint.
+
+The checkpoint (<extracted_output_file>.ckpt by default) stores the byte
+offset reached in the response file, a fingerprint of the last line
+consumed, and a content hash, outcome and input position per question_id.
+On the next run:
+
+  - if the file only grew, just the appended complete lines are parsed;
+    new question ids are appended to JSONL outputs, and a question id that
+    reappears replaces its earlier extraction in place;
+  - if the already-consumed part changed (e.g. model_vqa.py was restarted
+    and rewrote the file), every line is hashed again but only the records
+    whose hash changed are re-parsed.
+
+Outputs hold one entry per question_id, in input order of first
+appearance, like a full run over a file without duplicate ids. A
+compressed (.gz/.zst) response file has no usable byte offsets, so it is
+read whole on every run, but only the changed records are parsed.
+"""
+import hashlib
+import json
+import os
+from functools import partial
+
+from record_io import RecordWriter, is_compressed, is_jsonl, iter_records
+from records import skipped_entry
+from sharding import iter_sharded
+
+CHECKPOINT_VERSION = 2
+
+
+def content_hash(data):
+    return hashlib.blake2b(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+
+def _hashed_results(extract_fn, known, responses):
+    """
+    Yield (qid, hash, kind, record, reason) per response. Responses whose hash
+    matches the checkpoint entry for their question id are not parsed again
+    and yield kind None.
+    """
+    for data in responses:
+        qid = str(data.get('question_id'))
+        digest = content_hash(data)
+        if known.get(qid) == digest:
+            yield qid, digest, None, None, None
+            continue
+        for kind, record, reason in extract_fn([data]):
+            yield qid, digest, kind, record, reason
+
+
+def _after_last_newline(path, limit):
+    """Return the offset just past the last newline in path[:limit], or 0."""
+    with open(path, 'rb') as f:
+        pos = limit
+        while pos > 0:
+            step = min(65536, pos)
+            f.seek(pos - step)
+            i = f.read(step).rfind(b'\n')
+            if i >= 0:
+                return pos - step + i + 1
+            pos -= step
+    return 0
+
+
+def complete_end(path):
+    """Return the offset just past the last complete line, ignoring a partially written one."""
+    return _after_last_newline(path, os.path.getsize(path))
+
+
+def _line_fingerprint(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return hashlib.blake2b(f.read(end - start), digest_size=16).hexdigest()
+
+
+def load_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        ckpt = json.load(f)
+    return ckpt if ckpt.get('version') == CHECKPOINT_VERSION else None
+
+
+def save_checkpoint(checkpoint_file, ckpt):
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(ckpt, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def _load_outputs(extracted_output_file, skipped_output_file):
+    """Map question_id -> record for every record already written to the outputs."""
+    previous = {'extracted': {}, 'skipped': {}}
+    for kind, path in (('extracted', extracted_output_file), ('skipped', skipped_output_file)):
+        if path and os.path.exists(path):
+            for record in iter_records(path):
+                previous[kind][str(record.get('question_id'))] = record
+    return previous
+
+
+def _write_outputs(entries, extracted_output_file, skipped_output_file, append=False):
+    """Write (ordinal, kind, record) entries to the outputs in ordinal order."""
+    writers = {'extracted': RecordWriter(extracted_output_file, indent=2, ensure_ascii=False, append=append)}
+    if skipped_output_file:
+        writers['skipped'] = RecordWriter(skipped_output_file, indent=2, ensure_ascii=False, append=append)
+    try:
+        for _, kind, record in sorted(entries, key=lambda e: e[0]):
+            if kind in writers:
+                writers[kind].write(record)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def incremental_extract(input_file, extract_fn, extracted_output_file, skipped_output_file=None,
+                        checkpoint_file=None, workers=1, stats=None, full_skipped=False, salt=None):
+    """
+    Bring the extracted/skipped outputs up to date with input_file and return
+    (parsed, total_extracted, total_skipped).
+    extract_fn maps responses to ('extracted' | 'skipped', record, reason) tuples;
+    skip reasons of the parsed responses are counted in stats when given.
+    Skipped responses are written as references unless full_skipped. salt
+    identifies whatever else extract_fn depends on (the retry responses of
+    extraction.py); a checkpoint saved with another salt is not reused.
+    """
+    checkpoint_file = checkpoint_file or extracted_output_file + '.ckpt'
+    ckpt = load_checkpoint(checkpoint_file)
+    compressed = is_compressed(input_file)
+    end = None if compressed else complete_end(input_file)
+
+    outputs_exist = os.path.exists(extracted_output_file) and \
+        (not skipped_output_file or os.path.exists(skipped_output_file))
+    if not (ckpt and outputs_exist and ckpt['input_file'] == os.path.abspath(input_file)
+            and ckpt.get('salt') == salt):
+        ckpt = None
+    append_only = bool(
+        ckpt and not compressed and ckpt['offset'] <= end
+        and (ckpt['offset'] == 0 or
+             _line_fingerprint(input_file, ckpt['tail_start'], ckpt['offset']) == ckpt['tail_hash'])
+    )
+
+    # question_id -> [hash, kind, ordinal]
+    known = ckpt['records'] if ckpt else {}
+    current = dict(known) if append_only else {}
+    next_ordinal = ckpt['count'] if append_only else 0
+    fresh = {}
+
+    start = ckpt['offset'] if append_only else 0
+    # Responses before start, so skipped references get their row in the response file
+    rows = ckpt['rows'] if append_only else 0
+    fn = partial(_hashed_results, extract_fn, {qid: value[0] for qid, value in known.items()})
+    for qid, digest, kind, record, reason in iter_sharded(input_file, fn, workers, start, end):
+        row, rows = rows, rows + 1
+        prev = current.get(qid)
+        if prev:
+            ordinal = prev[2]
+        else:
+            ordinal = next_ordinal
+            next_ordinal += 1
+        if kind is None:
+            # Same content as in the last run
+            if not append_only:
+                current[qid] = [digest, known[qid][1], ordinal]
+                fresh.pop(qid, None)
+            continue
+        current[qid] = [digest, kind, ordinal]
+        fresh[qid] = record if kind == 'extracted' else skipped_entry(record, reason, row, full_skipped)
+        if reason and stats is not None:
+            stats[reason] += 1
+
+    if append_only and all(qid not in known for qid in fresh) \
+            and is_jsonl(extracted_output_file) and (not skipped_output_file or is_jsonl(skipped_output_file)):
+        # Only new question ids: append them to the outputs
+        entries = [(current[qid][2], current[qid][1], record) for qid, record in fresh.items()]
+        _write_outputs(entries, extracted_output_file, skipped_output_file, append=True)
+    elif fresh or not append_only:
+        # Patch changed ids in place and rewrite the outputs in input order
+        previous = _load_outputs(extracted_output_file, skipped_output_file) if ckpt else None
+        entries = []
+        for qid, (_, kind, ordinal) in current.items():
+            record = fresh.get(qid)
+            if record is None:
+                record = previous[kind].get(qid)
+                if record is None and kind == 'extracted':
+                    raise RuntimeError(f"{extracted_output_file} does not match checkpoint {checkpoint_file}; "
+                                       f"remove the checkpoint to re-extract")
+            if record is not None:
+                entries.append((ordinal, kind, record))
+        _write_outputs(entries, extracted_output_file, skipped_output_file)
+
+    tail_start = _after_last_newline(input_file, end - 1) if end else 0
+    save_checkpoint(checkpoint_file, {
+        'version': CHECKPOINT_VERSION,
+        'input_file': os.path.abspath(input_file),
+        'salt': salt,
+        'offset': end,
+        'rows': rows,
+        'tail_start': tail_start,
+        'tail_hash': _line_fingerprint(input_file, tail_start, end) if end else None,
+        'count': next_ordinal,
+        'records': current,
+    })
+
+    counts = {'extracted': 0, 'skipped': 0}
+    for _, kind, _ in current.values():
+        counts[kind] += 1
+    return len(fresh), counts['extracted'], counts['skipped']
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Batched inference client with pluggable backends.
+
+Reads a prompt JSONL file as written by pos_prompts.py / neg_prompts.py
+({"question_id", "image", "text"}), sends the prompts to a backend in
+batches with a bounded number of batches in flight, and writes the answers
+in input order in the model_vqa.py answer layout:
+
+  {"question_id", "prompt", "text", "answer_id", "model_id", "metadata"}
+
+Backends (--backend):
+  fake                 deterministic stand-in emitting well-formed
+                       CAPTION/REASONING/CONCLUSION or CAPTION/EXPLANATION
+  http://host:port/... POST {"prompts": [...], "params": {...}} to a server,
+                       expecting {"outputs": [text, ...]}
+  cmd:<command>        run a command per batch with {question_file} and
+                       {answers_file} filled in, e.g. model_vqa.py; other
+                       braces in the command are left as they are
+  llava:<model_path>   load a LLaVA checkpoint once and answer in process
+                       the way model_vqa.py does (needs the LLaVA repo,
+                       torch and a GPU); with --early_stop, generation
+                       stops once the parser below has settled the response
+  module:function      call function(prompts, **params) in process
+
+A cmd: backend starts its command, and so loads the model, for every
+batch; a caller sending many small batches (sequential_eval.py) should use
+llava: or an HTTP server (`serve --backend llava:<model_path>`).
+
+A prompt record may carry its own sampling parameters under "sampling"
+(as retry.py writes them); they override the client's parameters for that
+record, and consecutive records with the same parameters share a batch.
+Command backends can use them as placeholders, e.g. {temperature}; a
+parameter without a placeholder is reported once and not passed on.
+
+parser_stopping_criteria() wraps response_parser.StreamingParser as a
+transformers StoppingCriteria, so a generate() loop stops once the
+CONCLUSION letter is out or the response has degenerated; the llava:
+backend uses it with --early_stop and cuts the answer after the letter.
+
+`python stl/inference.py serve --backend fake` exposes a backend over
+HTTP for load tests.
+
+Usage:
+  python stl/inference.py run -q pos_prompts_it1.jsonl -o response_pos_it1.jsonl --backend fake
+  python stl/inference.py run -q pos_prompts_it1.jsonl -o response_pos_it1.jsonl \\
+      --backend "cmd:python llava/eval/model_vqa.py --model-path m --question-file {question_file} --image-folder . --answers-file {answers_file}"
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from question_store import parse_choices
+from record_io import RecordWriter, iter_records
+from records import PosResponse, dumps
+from response_parser import DONE, NEG_LAYOUT, POS_LAYOUT, RUNNING, StreamingParser
+
+
+def _digest(*parts):
+    return hashlib.blake2b('/'.join(map(str, parts)).encode('utf-8'), digest_size=8).hexdigest()
+
+
+class FakeBackend:
+    """
+    Deterministic stand-in for a model. Positive prompts get a CONCLUSION
+    with a choice picked by hashing the model id and question id; negative
+    prompts (asking for an EXPLANATION) get a caption and an explanation.
+    delay adds a sleep per batch and per prompt to imitate a real server.
+    """
+
+    def __init__(self, model_id='fake', delay=0.0, delay_per_prompt=0.0):
+        self.model_id = model_id
+        self.delay = delay
+        self.delay_per_prompt = delay_per_prompt
+
+    def response(self, record):
+        prompt = record.get('text', '')
+        qid = record.get('question_id')
+        if 'EXPLANATION' in prompt:
+            return ("CAPTION: A stub description of the image.\n\n"
+                    "EXPLANATION: A stub explanation of why the answer is wrong.")
+        choices = parse_choices(prompt) or [('(a)', '')]
+        pick = int(_digest(self.model_id, qid), 16) % len(choices)
+        return ("CAPTION: A stub description of the image.\n\n"
+                "REASONING: A stub line of reasoning about the question.\n\n"
+                f"CONCLUSION: {choices[pick][0]}")
+
+    def generate(self, prompts, **params):
+        time.sleep(self.delay + self.delay_per_prompt * len(prompts))
+        return [self.response(record) for record in prompts]
+
+
+class HTTPBackend:
+    """POST batches to a generation server speaking the serve protocol below."""
+
+    def __init__(self, url, timeout=600):
+        self.url = url
+        self.timeout = timeout
+
+    def generate(self, prompts, **params):
+        # Prompts may be typed records (records.py), which the codec writes as their dict
+        body = dumps({'prompts': prompts, 'params': params}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            outputs = json.load(response)['outputs']
+        if len(outputs) != len(prompts):
+            raise RuntimeError(f"{self.url} returned {len(outputs)} outputs for {len(prompts)} prompts")
+        return outputs
+
+
+# {name} placeholders in a command; only known names are substituted
+placeholder_pattern = re.compile(r"\{(\w+)\}")
+
+
+class SubprocessBackend:
+    """
+    Run a command per batch. The batch is written to a temporary question
+    file and the command writes model_vqa.py style answers, matched back to
+    the prompts by question_id and prompt text.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.argv = shlex.split(command)
+        self.placeholders = {name for arg in self.argv for name in placeholder_pattern.findall(arg)}
+        self._reported = set()
+
+    def _fill(self, values):
+        """Return the argv with the {name} placeholders of values filled in."""
+        def substitute(m):
+            value = values.get(m.group(1))
+            return m.group(0) if value is None else str(value)
+        return [placeholder_pattern.sub(substitute, arg) for arg in self.argv]
+
+    def generate(self, prompts, **params):
+        with tempfile.TemporaryDirectory(prefix='stl_infer_') as tmp:
+            question_file = os.path.join(tmp, 'questions.jsonl')
+            answers_file = os.path.join(tmp, 'answers.jsonl')
+            with open(question_file, 'w', encoding='utf-8') as f:
+                for record in prompts:
+                    f.write(dumps(record) + '\n')
+            unused = set(params) - self.placeholders - self._reported
+            if unused:
+                self._reported |= unused
+                print(f"Warning: the command has no placeholder for {', '.join(sorted(unused))}; "
+                      f"not passed to: {self.command}")
+            subprocess.run(self._fill(dict(params, question_file=question_file, answers_file=answers_file)),
+                           check=True)
+            answers = {}
+            for answer in iter_records(answers_file):
+                answers.setdefault((str(answer.get('question_id')), answer.get('prompt')), []).append(answer['text'])
+        outputs = []
+        for record in prompts:
+            texts = answers.get((str(record.get('question_id')), record.get('text')))
+            if not texts:
+                raise RuntimeError(f"No answer for question {record.get('question_id')} from: {self.command}")
+            outputs.append(texts.pop(0))
+        return outputs
+
+
+class LlavaBackend:
+    """
+    A LLaVA checkpoint loaded once, answering prompt records one at a time
+    with the conversation template, image handling and default sampling
+    (temperature 0.2, 1024 new tokens) of llava/eval/model_vqa.py. With
+    early_stop, a StreamingParser stops generation once the response is
+    settled, and a DONE response is cut after its CONCLUSION letter (beam
+    search always runs to the end).
+    """
+
+    def __init__(self, model_path, model_base=None, image_folder='.', conv_mode='llava_v1', temperature=0.2,
+                 top_p=None, num_beams=1, max_new_tokens=1024, early_stop=False):
+        from llava.mm_utils import get_model_name_from_path
+        from llava.model.builder import load_pretrained_model
+        from llava.utils import disable_torch_init
+
+        disable_torch_init()
+        model_path = os.path.expanduser(model_path)
+        self.tokenizer, self.model, self.image_processor, _ = load_pretrained_model(
+            model_path, model_base, get_model_name_from_path(model_path))
+        self.model_id = get_model_name_from_path(model_path)
+        self.image_folder = image_folder
+        self.conv_mode = conv_mode
+        self.early_stop = early_stop
+        self.defaults = {'temperature': temperature, 'top_p': top_p, 'num_beams': num_beams,
+                         'max_new_tokens': max_new_tokens}
+
+    def _answer(self, record, temperature, top_p, num_beams, max_new_tokens):
+        import torch
+        from PIL import Image
+        from llava.constants import (DEFAULT_IM_END_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IMAGE_TOKEN,
+                                     IMAGE_TOKEN_INDEX)
+        from llava.conversation import conv_templates
+        from llava.mm_utils import process_images, tokenizer_image_token
+        from transformers import StoppingCriteriaList
+
+        qs = record['text']
+        if self.model.config.mm_use_im_start_end:
+            qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
+        else:
+            qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
+        conv = conv_templates[self.conv_mode].copy()
+        conv.append_message(conv.roles[0], qs)
+        conv.append_message(conv.roles[1], None)
+        input_ids = tokenizer_image_token(conv.get_prompt(), self.tokenizer, IMAGE_TOKEN_INDEX,
+                                          return_tensors='pt').unsqueeze(0).cuda()
+        image = Image.open(os.path.join(self.image_folder, record['image'])).convert('RGB')
+        image_tensor = process_images([image], self.image_processor, self.model.config)[0]
+        criteria = None
+        if self.early_stop and num_beams == 1:
+            # LLaVA generates from inputs_embeds, so output_ids hold only the new tokens
+            layout = NEG_LAYOUT if 'EXPLANATION' in record['text'] else POS_LAYOUT
+            criteria = parser_stopping_criteria(self.tokenizer, layout=layout)
+        with torch.inference_mode():
+            output_ids = self.model.generate(
+                input_ids,
+                images=image_tensor.unsqueeze(0).half().cuda(),
+                image_sizes=[image.size],
+                do_sample=temperature > 0,
+                temperature=temperature,
+                top_p=top_p,
+                num_beams=num_beams,
+                max_new_tokens=max_new_tokens,
+                stopping_criteria=StoppingCriteriaList([criteria]) if criteria else None,
+                use_cache=True)
+        text = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0]
+        return settled_text(text, criteria.parsers[0]) if criteria else text.strip()
+
+    def generate(self, prompts, **params):
+        options = dict(self.defaults, **{key: value for key, value in params.items() if key in self.defaults})
+        return [self._answer(record, **options) for record in prompts]
+
+
+class InProcessBackend:
+    """Call a Python function taking a list of prompt records and returning their texts."""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def generate(self, prompts, **params):
+        return list(self.fn(prompts, **params))
+
+
+def load_backend(spec, model_id=None, delay=0.0, early_stop=False):
+    """
+    Build a backend from a --backend spec (see the module docstring).
+    early_stop applies to llava: backends.
+    """
+    if spec == 'fake':
+        return FakeBackend(model_id or 'fake', delay=delay)
+    if spec.startswith(('http://', 'https://')):
+        return HTTPBackend(spec)
+    if spec.startswith('cmd:'):
+        return SubprocessBackend(spec[4:])
+    if spec.startswith('llava:'):
+        return LlavaBackend(spec[6:], early_stop=early_stop)
+    if ':' in spec:
+        module, name = spec.split(':', 1)
+        return InProcessBackend(getattr(importlib.import_module(module), name))
+    raise ValueError(f"Unknown backend '{spec}' "
+                     f"(expected fake, http://..., cmd:<command>, llava:<model_path> or module:function)")
+
+
+class InferenceClient:
+    """Send prompts to a backend in batches, at most concurrency batches at a time, yielding answers in order."""
+
+    def __init__(self, backend, batch_size=8, concurrency=1, model_id=None, params=None):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.model_id = model_id or getattr(backend, 'model_id', 'model')
+        # Sampling parameters passed to every generate call
+        self.params = params or {}
+
+    def _batches(self, prompts):
+        """Yield (batch, params) with at most batch_size prompts sharing the same sampling parameters."""
+        batch, params = [], None
+        for record in prompts:
+            record_params = dict(self.params, **record.get('sampling', {}))
+            if batch and (len(batch) == self.batch_size or record_params != params):
+                yield batch, params
+                batch = []
+            batch.append(record)
+            params = record_params
+        if batch:
+            yield batch, params
+
+    def iter_answers(self, prompts):
+        """Yield one model_vqa.py style answer per prompt, in input order."""
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for batch, params in self._batches(prompts):
+                in_flight.append((batch, pool.submit(self.backend.generate, batch, **params)))
+                if len(in_flight) >= self.concurrency:
+                    yield from self._answers(*in_flight.popleft())
+            while in_flight:
+                yield from self._answers(*in_flight.popleft())
+
+    def _answers(self, batch, future):
+        for record, text in zip(batch, future.result()):
+            yield PosResponse(
+                record.get('question_id'),
+                record.get('text', ''),
+                text,
+                _digest(self.model_id, record.get('question_id'), record.get('text', '')),
+                self.model_id,
+                dict(record.get('sampling', {})),
+            )
+
+    def run(self, question_file, answers_file):
+        """Answer every prompt of a question file and return how many answers were written."""
+        with RecordWriter(answers_file) as writer:
+            for answer in self.iter_answers(iter_records(question_file)):
+                writer.write(answer)
+        return writer.count
+
+
+def parser_stopping_criteria(tokenizer, batch_size=1, prompt_length=0, layout=POS_LAYOUT, **parser_options):
+    """
+    Build a transformers StoppingCriteria running one StreamingParser per
+    sequence; generation stops once every sequence is done or aborted.
+    prompt_length is the number of prompt tokens at the start of input_ids
+    (0 when generating from inputs_embeds, as LLaVA does). Use it as
+    model.generate(..., stopping_criteria=StoppingCriteriaList([criteria])).
+    """
+    from transformers import StoppingCriteria
+
+    class ParserStoppingCriteria(StoppingCriteria):
+        def __init__(self):
+            self.parsers = [StreamingParser(layout, **parser_options) for _ in range(batch_size)]
+
+        def __call__(self, input_ids, scores, **kwargs):
+            for row, parser in zip(input_ids, self.parsers):
+                if parser.state != RUNNING:
+                    continue
+                # Decode the whole continuation: sub-word pieces only read correctly in context
+                text = tokenizer.decode(row[prompt_length:], skip_special_tokens=True)
+                if len(text) > len(parser.text):
+                    parser.feed(text[len(parser.text):])
+            return all(parser.state != RUNNING for parser in self.parsers)
+
+    return ParserStoppingCriteria()
+
+
+def settled_text(text, parser):
+    """
+    The answer to keep from a generated text the parser watched: cut after
+    the CONCLUSION letter when the parser is DONE (the tokens generated in
+    the same step may run past it), else the whole text, stripped like
+    model_vqa.py strips its answers.
+    """
+    if parser.state == DONE and text.startswith(parser.text[:parser.end]):
+        text = text[:parser.end]
+    return text.strip()
+
+
+def make_server(backend, host='127.0.0.1', port=8000):
+    """An HTTP server exposing a backend: POST {"prompts": [...], "params": {...}} -> {"outputs": [...]}."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            outputs = backend.generate(request['prompts'], **request.get('params', {}))
+            body = json.dumps({'outputs': outputs}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(backend, host='127.0.0.1', port=8000):
+    """Serve a backend over HTTP until interrupted (see make_server)."""
+    server = make_server(backend, host, port)
+    print(f"Serving {type(backend).__name__} on http://{host}:{server.server_port}/")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched inference over prompt JSONL files.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='Answer a prompt file')
+    run_parser.add_argument('--question_file', '-q', required=True, help='Prompt JSONL file')
+    run_parser.add_argument('--answers_file', '-o', required=True, help='Output answers JSONL file')
+    run_parser.add_argument('--batch_size', type=int, default=8, help='Prompts per backend call')
+    run_parser.add_argument('--concurrency', type=int, default=1, help='Backend calls in flight')
+    run_parser.add_argument('--temperature', type=float, default=None, help='Sampling temperature passed to the backend')
+
+    serve_parser = sub.add_parser('serve', help='Serve a backend over HTTP')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+
+    for p in (run_parser, serve_parser):
+        p.add_argument('--backend', default='fake',
+                       help='fake, http://..., cmd:<command>, llava:<model_path> or module:function')
+        p.add_argument('--model_id', default=None,
+                       help="model_id written to the answers (default: the backend's, e.g. the llava: checkpoint name)")
+        p.add_argument('--delay', type=float, default=0.0, help='Seconds per batch for the fake backend')
+        p.add_argument('--early_stop', action='store_true',
+                       help='llava: backend only: stop generating once the CONCLUSION letter is out '
+                            'or the response has degenerated')
+    args = parser.parse_args()
+
+    backend = load_backend(args.backend, args.model_id, args.delay, args.early_stop)
+    if args.command == 'serve':
+        serve(backend, args.host, args.port)
+        return
+
+    params = {} if args.temperature is None else {'temperature': args.temperature}
+    client = InferenceClient(backend, args.batch_size, args.concurrency, args.model_id, params)
+    start = time.time()
+    total = client.run(args.question_file, args.answers_file)
+    elapsed = time.time() - start
+    print(f"Answered {total} prompts in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f}/s) -> {args.answers_file}")
+
+
+if __name__ == '__main__':
+    main()
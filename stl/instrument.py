@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation shared by the stl scripts.
+
+A StageMetrics context manager wraps the work of one stage and, on exit,
+appends one JSON line to the metrics file with:
+
+  stage, wall_s, records_in, records_out, records_per_s,
+  peak_rss_mb, peak_rss_scope, bytes_read, bytes_written,
+  skipped (count per reason), plus any extra fields passed in
+
+peak_rss_mb is the peak of this stage (peak_rss_scope "stage") where Linux
+lets the peak be reset at stage start, so the stages run in one process by
+pipeline.py each report their own. Elsewhere it is the peak of the whole
+process so far (peak_rss_scope "process"). Worker processes count when
+their peak exceeds the one of all children reaped before the stage.
+
+The metrics file is --metrics_file, or the STL_METRICS_FILE environment
+variable so a whole iteration can log to one file; nothing is written when
+neither is set. --profile PATH also profiles the stage: with cProfile
+(--profile_mode cprofile, a pstats file) or with a low-overhead sampling
+profiler (--profile_mode sample, collapsed stacks for flamegraph.pl).
+
+Skip reasons used by the stages:
+  missing_caption, missing_rationale, missing_explanation, missing_choice,
+  zero_threshold, unknown_qid, no_gold_answer, over_budget, invalid_json
+"""
+import argparse
+import cProfile
+import json
+import os
+import resource
+import signal
+import sys
+import time
+from collections import Counter
+
+METRICS_ENV = 'STL_METRICS_FILE'
+
+SAMPLE_INTERVAL = 0.005
+
+
+def add_metrics_args(parser):
+    """Add the --metrics_file and --profile options to a stage's argument parser."""
+    parser.add_argument('--metrics_file', default=os.environ.get(METRICS_ENV),
+                        help=f'Append per-stage metrics to this JSONL file (default: ${METRICS_ENV})')
+    parser.add_argument('--profile', default=None, help='Profile the stage and write the result to this path')
+    parser.add_argument('--profile_mode', choices=('cprofile', 'sample'), default='cprofile',
+                        help='cprofile: deterministic pstats output; sample: collapsed stacks from a sampling profiler')
+
+
+def _io_counters():
+    """Bytes read and written by this process so far, or None where /proc is unavailable."""
+    try:
+        with open('/proc/self/io', 'r', encoding='ascii') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _maxrss_kb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _reset_peak_rss():
+    """Reset this process's peak RSS (VmHWM); False where the kernel does not allow it."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _vm_hwm_kb():
+    try:
+        with open('/proc/self/status', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class SamplingProfiler:
+    """Sample the Python stack on a CPU-time timer and count collapsed stacks."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class StageMetrics:
+    """
+    Measure one stage. Set records_in/records_out and call skip(reason) as
+    records are processed; the metrics line is written on exit.
+    """
+
+    def __init__(self, stage, metrics_file=None, profile=None, profile_mode='cprofile', **info):
+        self.stage = stage
+        self.metrics_file = metrics_file
+        self.profile = profile
+        self.profile_mode = profile_mode
+        self.info = info
+        self.records_in = 0
+        self.records_out = 0
+        self.skipped = Counter()
+        self.result = None
+
+    @classmethod
+    def from_args(cls, stage, args, **info):
+        return cls(stage, getattr(args, 'metrics_file', None), getattr(args, 'profile', None),
+                   getattr(args, 'profile_mode', 'cprofile'), **info)
+
+    def skip(self, reason, count=1):
+        self.skipped[reason] += count
+
+    def __enter__(self):
+        self._profiler = None
+        if self.profile and self.profile_mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile:
+            self._profiler = SamplingProfiler()
+            self._profiler.start()
+        self._io = _io_counters()
+        self._children_rss = _maxrss_kb(resource.RUSAGE_CHILDREN)
+        self._stage_rss = _reset_peak_rss()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._start
+        if self._profiler is not None:
+            if self.profile_mode == 'cprofile':
+                self._profiler.disable()
+                self._profiler.dump_stats(self.profile)
+            else:
+                self._profiler.stop()
+                self._profiler.dump(self.profile)
+
+        io = _io_counters()
+        peak = _vm_hwm_kb() if self._stage_rss else None
+        scope = 'stage' if peak is not None else 'process'
+        if peak is None:
+            peak = _maxrss_kb(resource.RUSAGE_SELF)
+        children = _maxrss_kb(resource.RUSAGE_CHILDREN)
+        if scope == 'process' or children > self._children_rss:
+            peak = max(peak, children)
+        self.result = {
+            'stage': self.stage,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'wall_s': round(wall, 3),
+            'records_in': self.records_in,
+            'records_out': self.records_out,
+            'records_per_s': round(self.records_in / wall, 1) if wall > 0 else None,
+            'peak_rss_mb': round(peak / 1024, 1),
+            'peak_rss_scope': scope,
+            'bytes_read': io[0] - self._io[0] if io and self._io else None,
+            'bytes_written': io[1] - self._io[1] if io and self._io else None,
+            'skipped': dict(self.skipped),
+            **self.info,
+        }
+        if exc_type is not None:
+            self.result['error'] = f"{exc_type.__name__}: {exc}"
+        if self.metrics_file:
+            with open(self.metrics_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(self.result) + '\n')
+        return False
+
+
+def summarize(metrics_file):
+    """Print total time and skip reasons per stage from a metrics JSONL file."""
+    totals = {}
+    with open(metrics_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            m = json.loads(line)
+            t = totals.setdefault(m['stage'], {'runs': 0, 'wall_s': 0.0, 'records_in': 0, 'skipped': Counter(),
+                                                'peak_rss_mb': 0.0})
+            t['runs'] += 1
+            t['wall_s'] += m['wall_s']
+            t['records_in'] += m['records_in']
+            t['peak_rss_mb'] = max(t['peak_rss_mb'], m['peak_rss_mb'] or 0.0)
+            t['skipped'].update(m.get('skipped', {}))
+    width = max([len(stage) for stage in totals] + [len('stage')])
+    print(f"{'stage':<{width}} {'runs':>4} {'wall s':>8} {'records':>9} {'rss MB':>7}  skipped")
+    for stage, t in sorted(totals.items(), key=lambda item: -item[1]['wall_s']):
+        skipped = ', '.join(f"{reason}={count}" for reason, count in t['skipped'].most_common())
+        print(f"{stage:<{width}} {t['runs']:>4} {t['wall_s']:>8.2f} {t['records_in']:>9} "
+              f"{t['peak_rss_mb']:>7.1f}  {skipped}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize a per-stage metrics JSONL file.")
+    parser.add_argument('--metrics_file', '-m', default=os.environ.get(METRICS_ENV), required=METRICS_ENV not in os.environ,
+                        help=f'Metrics JSONL file (default: ${METRICS_ENV})')
+    args = parser.parse_args()
+    summarize(args.metrics_file)
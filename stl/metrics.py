@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized accuracy metrics over many iterations and domains at once.
+
+For each domain the test questions are laid out as columns (question id,
+category, gold letter) and every extracted_<split>_it*.json file becomes one
+row of predicted letters, so accuracy, per-category accuracy, skip rate and
+iteration-over-iteration flip matrices are computed with NumPy over the
+whole (iterations x questions) array.
+
+Accuracy follows accuracy.py: correct / extracted answers with a gold
+letter. The skip rate is the share of test questions with a gold letter
+and no extracted answer.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+from question_store import open_question_store
+from record_io import iter_records, open_text
+
+# Per-question outcome of one iteration
+STATES = ('correct', 'incorrect', 'skipped')
+CORRECT, INCORRECT, SKIPPED = range(len(STATES))
+
+# Extracted artifacts only, not the .ckpt / .tmp sidecars written next to them
+iteration_pattern = re.compile(r"^extracted_(?P<split>.+)_it(?P<num>\d+)\.jsonl?(\.gz|\.zst)?$")
+
+
+class LetterCodes:
+    """Interns answer strings such as "(a)" into small integer codes; -1 means missing."""
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, letter):
+        if letter is None:
+            return -1
+        return self.codes.setdefault(letter.strip(), len(self.codes))
+
+
+def find_iteration_files(root, domain, split='test'):
+    """
+    Return [(iteration, path)] for every extracted file of a domain, sorted by
+    iteration. When an iteration has several (e.g. .json and .jsonl.gz), the
+    most recently written one is used.
+    """
+    found = {}
+    for path in glob.glob(os.path.join(root, domain, 'ours', f'extracted_{split}_it*')):
+        m = iteration_pattern.match(os.path.basename(path))
+        if not m or m.group('split') != split:
+            continue
+        num = int(m.group('num'))
+        if num not in found or os.path.getmtime(path) > os.path.getmtime(found[num]):
+            found[num] = path
+    return sorted(found.items())
+
+
+def build_domain_columns(questions_file, correct_answers, letters):
+    """Return (question_ids, category_codes, category_names, gold_codes) arrays for a domain."""
+    store = open_question_store(questions_file)
+    qids = list(store)
+    categories = {}
+    category_codes = np.fromiter(
+        (categories.setdefault(store[qid].get('category'), len(categories)) for qid in qids),
+        dtype=np.int32, count=len(qids),
+    )
+    gold = np.fromiter((letters.encode(correct_answers.get(qid)) for qid in qids), dtype=np.int32, count=len(qids))
+    return np.array(qids, dtype=object), category_codes, list(categories), gold
+
+
+def build_prediction_matrix(iteration_files, qid_index, letters):
+    """Return an (iterations x questions) array of predicted letter codes, -1 where nothing was extracted."""
+    predictions = np.full((len(iteration_files), len(qid_index)), -1, dtype=np.int32)
+    for row, path in enumerate(iteration_files):
+        cols, codes = [], []
+        for entry in iter_records(path):
+            col = qid_index.get(entry["question_id"])
+            if col is not None:
+                cols.append(col)
+                codes.append(letters.encode(entry["generated_choice"]))
+        predictions[row, cols] = codes
+    return predictions
+
+
+def compute_metrics(predictions, gold, category_codes, num_categories):
+    """Compute accuracy, per-category accuracy, skip rate and flip matrices for a prediction matrix."""
+    has_gold = gold >= 0
+    answered = (predictions >= 0) & has_gold
+    correct = answered & (predictions == gold)
+
+    states = np.where(correct, CORRECT, np.where(answered, INCORRECT, SKIPPED))[:, has_gold]
+
+    answered_count = answered.sum(axis=1)
+    correct_count = correct.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = np.where(answered_count > 0, correct_count / answered_count, 0.0)
+    skip_rate = 1.0 - answered_count / max(int(has_gold.sum()), 1)
+
+    # Per-category counts for all iterations in one bincount: offset each row by its index
+    n_iter = predictions.shape[0]
+    offsets = (np.arange(n_iter) * num_categories)[:, None]
+    cat = np.broadcast_to(category_codes, predictions.shape) + offsets
+    cat_answered = np.bincount(cat[answered], minlength=n_iter * num_categories).reshape(n_iter, num_categories)
+    cat_correct = np.bincount(cat[correct], minlength=n_iter * num_categories).reshape(n_iter, num_categories)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cat_accuracy = np.where(cat_answered > 0, cat_correct / cat_answered, np.nan)
+
+    # Flip matrices between consecutive iterations: flips[k][from_state][to_state]
+    n = len(STATES)
+    if n_iter > 1:
+        pairs = states[:-1] * n + states[1:] + (np.arange(n_iter - 1) * n * n)[:, None]
+        flips = np.bincount(pairs.ravel(), minlength=(n_iter - 1) * n * n).reshape(n_iter - 1, n, n)
+    else:
+        flips = np.zeros((0, n, n), dtype=np.int64)
+
+    return {
+        'answered': answered_count,
+        'correct': correct_count,
+        'accuracy': accuracy,
+        'skip_rate': skip_rate,
+        'category_answered': cat_answered,
+        'category_accuracy': cat_accuracy,
+        'flips': flips,
+    }
+
+
+def domain_report(domain, root, data_dir, split, correct_answers, letters):
+    files = find_iteration_files(root, domain, split)
+    if not files:
+        return None
+    qids, category_codes, category_names, gold = build_domain_columns(
+        os.path.join(data_dir, f'questions_{split}_{domain}.jsonl'), correct_answers, letters
+    )
+    qid_index = {qid: i for i, qid in enumerate(qids)}
+    predictions = build_prediction_matrix([path for _, path in files], qid_index, letters)
+    metrics = compute_metrics(predictions, gold, category_codes, len(category_names))
+
+    iterations = [it for it, _ in files]
+    return {
+        'domain': domain,
+        'iterations': iterations,
+        'accuracy': [round(float(a) * 100, 2) for a in metrics['accuracy']],
+        'correct': metrics['correct'].tolist(),
+        'answered': metrics['answered'].tolist(),
+        'skip_rate': [round(float(s) * 100, 2) for s in metrics['skip_rate']],
+        'category_accuracy': {
+            str(name): [None if np.isnan(v) else round(float(v) * 100, 2) for v in metrics['category_accuracy'][:, c]]
+            for c, name in enumerate(category_names)
+        },
+        'flips': {
+            f'it{a}->it{b}': metrics['flips'][k].tolist() for k, (a, b) in enumerate(zip(iterations, iterations[1:]))
+        },
+    }
+
+
+def print_report(report):
+    print(f"== {report['domain']} ==")
+    for i, it in enumerate(report['iterations']):
+        print(f"  it{it}: accuracy {report['accuracy'][i]:.2f}% ({report['correct'][i]}/{report['answered'][i]}), "
+              f"skipped {report['skip_rate'][i]:.2f}%")
+    width = max([len(name) for name in report['category_accuracy']] + [len('category')])
+    print(f"  {'category':<{width}}  " + ' '.join(f"{'it' + str(it):>6}" for it in report['iterations']))
+    for name, values in report['category_accuracy'].items():
+        cells = ' '.join('     -' if v is None else f'{v:6.2f}' for v in values)
+        print(f"  {name:<{width}}  {cells}")
+    for pair, matrix in report['flips'].items():
+        print(f"  flips {pair} (rows from, cols to: {', '.join(STATES)}): {matrix}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute accuracy metrics for every iteration of one or more domains.")
+    parser.add_argument('--domains', nargs='+', required=True, help='Domains to report')
+    parser.add_argument('--root', default='.', help='Directory holding the <domain>/ours/ artifacts')
+    parser.add_argument('--data_dir', default='playground/data/folder', help='Directory with the question and answer files')
+    parser.add_argument('--split', default='test', help='Split name used in extracted_<split>_it*.json')
+    parser.add_argument('--correct_answers_file', help='Correct answers JSON (default: <data_dir>/correct_answers_<split>.json)')
+    parser.add_argument('--output_file', help='Optional path to write the full report as JSON')
+    args = parser.parse_args()
+
+    answers_file = args.correct_answers_file or os.path.join(args.data_dir, f'correct_answers_{args.split}.json')
+    with open_text(answers_file) as f:
+        correct_answers = json.load(f)
+
+    letters = LetterCodes()
+    reports = []
+    for domain in args.domains:
+        report = domain_report(domain, args.root, args.data_dir, args.split, correct_answers, letters)
+        if report is None:
+            print(f"No extracted_{args.split}_it*.json files found for domain '{domain}'")
+            continue
+        print_report(report)
+        reports.append(report)
+
+    if args.output_file:
+        with open(args.output_file, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python3
-import json
-import re
 import argparse
 
+from instrument import StageMetrics, add_metrics_args
+from prompt_groups import manifest_path, write_grouped_prompts
+from question_store import open_question_store
+from record_io import iter_records, open_text
+from records import dumps
+from tokens import IMAGE_TOKENS, approx_token_count, load_token_counter, word_pattern
+
 # Updated prompt template
 prompt_template = (
     "You are an image based question-answering expert. "
@@ -17,33 +22,38 @@ prompt_template = (
     "Response:\n"
 )
 
-# Regex pattern to extract choices: lines like "(a) text"
-choice_pattern = re.compile(r"^\(([a-z])\)\s*(.+)$")
-
-def generate_prompts(correct_extractions_file, questions_file, output_file):
-    # Load correct extractions into a dict keyed by question_id
-    with open(correct_extractions_file, 'r', encoding='utf-8') as f:
-        correct_extractions = json.load(f)
-    correct_dict = {entry['question_id']: entry for entry in correct_extractions}
-
-    # Load all questions into a dict keyed by question_id
-    questions_dict = {}
-    with open(questions_file, 'r', encoding='utf-8') as infile:
-        for line in infile:
-            try:
-                qdata = json.loads(line)
-                qid = qdata.get('question_id')
-                if qid:
-                    questions_dict[qid] = qdata
-            except json.JSONDecodeError:
-                continue
-
-    final_prompts = []
-
+def rank_distractors(choices, correct_choice, rationale=''):
+    """
+    Order the incorrect choices from most to least confusable: word overlap
+    with the correct choice, plus a bonus when the model's own rationale
+    mentions the distractor. Ties keep the original choice order.
+    """
+    correct_words = set(word_pattern.findall(choices.get(correct_choice, '').lower()))
+    rationale_lower = rationale.lower()
+
+    def confusability(letter):
+        text = choices[letter].lower()
+        words = set(word_pattern.findall(text))
+        union = words | correct_words
+        overlap = len(words & correct_words) / len(union) if union else 0.0
+        mentioned = letter in rationale or (text and text in rationale_lower)
+        return overlap + (1.0 if mentioned else 0.0)
+
+    return sorted((letter for letter in choices if letter != correct_choice), key=confusability, reverse=True)
+
+def iter_prompts(correct_dict, questions_dict, max_per_question=None, max_prompt_tokens=None,
+                 count_tokens=approx_token_count, stats=None):
+    """
+    Yield one negative prompt record per incorrect option of each correct extraction.
+    max_per_question keeps only the k most confusable distractors of a question;
+    prompts longer than max_prompt_tokens are dropped. Skip reasons are counted in stats.
+    """
     # Iterate over each correctly extracted entry
     for qid, extraction in correct_dict.items():
         question_record = questions_dict.get(qid)
         if not question_record:
+            if stats is not None:
+                stats['unknown_qid'] += 1
             continue  # skip if question not found
 
         question_text = question_record.get('text', '')
@@ -51,19 +61,21 @@ def generate_prompts(correct_extractions_file, questions_file, output_file):
         # Extract correct choice
         correct_choice = extraction.get('generated_choice')
         if not correct_choice:
+            if stats is not None:
+                stats['missing_choice'] += 1
             continue  # skip incomplete extractions
 
-        # Extract choices from question_text
-        choices = {}
-        for line in question_text.splitlines():
-            m = choice_pattern.match(line.strip())
-            if m:
-                letter = f"({m.group(1)})"
-                choices[letter] = m.group(2).strip()
+        # Choices parsed from question_text when the store was built
+        choices = dict(questions_dict.choices(qid))
+
+        # Cap the fan-out to the most confusable distractors, keeping choice order
+        selected = None
+        if max_per_question is not None:
+            selected = set(rank_distractors(choices, correct_choice, extraction.get('rationale') or '')[:max_per_question])
 
         # Generate prompt for each incorrect option
         for letter in choices:
-            if letter == correct_choice:
+            if letter == correct_choice or (selected is not None and letter not in selected):
                 continue
 
             prompt_text = prompt_template.format(
@@ -72,20 +84,67 @@ def generate_prompts(correct_extractions_file, questions_file, output_file):
                 incorrect_choice=letter
             )
 
-            output_record = {
+            if max_prompt_tokens is not None and count_tokens(prompt_text) > max_prompt_tokens:
+                if stats is not None:
+                    stats['over_budget'] += 1
+                continue
+
+            yield {
                 'question_id': qid,
                 'image': question_record.get('image'),
                 'text': prompt_text,
                 'category': question_record.get('category')
             }
-            final_prompts.append(output_record)
 
-    # Write out final prompts
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        for rec in final_prompts:
-            outfile.write(json.dumps(rec, ensure_ascii=False) + '\n')
-
-    print(f"Total prompts generated: {len(final_prompts)}")
+def prompt_token_budget(max_length, reserve_tokens=0):
+    """Tokens left for the prompt text once the image tokens and the expected response are set aside."""
+    return max_length - IMAGE_TOKENS - reserve_tokens
+
+def load_questions(questions_file):
+    # Questions keyed by question_id, backed by the compiled question store
+    return open_question_store(questions_file)
+
+def write_prompts(prompts, output_file, group_by_image=False):
+    """
+    Write prompt records to a JSONL file and return how many were written.
+    With group_by_image, records sharing an image are written together and
+    the shared-prefix manifest is written next to the file (see prompt_groups.py).
+    """
+    if group_by_image:
+        return write_grouped_prompts(prompts, output_file)
+    count = 0
+    with open_text(output_file, 'w') as outfile:
+        for rec in prompts:
+            outfile.write(dumps(rec) + '\n')
+            count += 1
+    return count
+
+def generate_prompts(correct_extractions_file, questions_file, output_file, max_per_question=None,
+                     max_length=None, reserve_tokens=0, tokenizer='approx', metrics=None, group_by_image=False):
+    metrics = metrics or StageMetrics('neg_prompts')
+    stats = metrics.skipped
+    with metrics:
+        # Load correct extractions into a dict keyed by question_id
+        correct_dict = {entry['question_id']: entry for entry in iter_records(correct_extractions_file)}
+        questions_dict = load_questions(questions_file)
+
+        max_prompt_tokens = prompt_token_budget(max_length, reserve_tokens) if max_length else None
+
+        # Prompts are written as they are generated
+        total = write_prompts(
+            iter_prompts(correct_dict, questions_dict, max_per_question, max_prompt_tokens,
+                         load_token_counter(tokenizer), stats),
+            output_file,
+            group_by_image
+        )
+        metrics.records_in = len(correct_dict)
+        metrics.records_out = total
+
+    print(f"Total prompts generated: {total}")
+    if group_by_image:
+        print(f"Shared-prefix manifest written to {manifest_path(output_file)}")
+    if max_prompt_tokens is not None:
+        print(f"Prompts dropped over the {max_prompt_tokens}-token budget: {stats['over_budget']}")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -94,7 +153,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--extractions_file', '-c',
         required=True,
-        help='Path to the JSON file containing correct extractions.'
+        help='Path to the JSON or JSONL file containing correct extractions.'
     )
     parser.add_argument(
         '--questions_file', '-q',
@@ -106,10 +165,45 @@ if __name__ == '__main__':
         required=True,
         help='Path to the output JSONL file for generated prompts.'
     )
+    parser.add_argument(
+        '--max_per_question', '-k',
+        type=int,
+        default=None,
+        help='Keep at most this many distractors per question, the most confusable first.'
+    )
+    parser.add_argument(
+        '--max_length',
+        type=int,
+        default=None,
+        help='Model context length (e.g. 1024, as --model_max_length); drop prompts that do not fit.'
+    )
+    parser.add_argument(
+        '--reserve_tokens',
+        type=int,
+        default=128,
+        help='Tokens kept free for the response when --max_length is set.'
+    )
+    parser.add_argument(
+        '--tokenizer',
+        default='approx',
+        help='Token counter for the budget: approx, whitespace or hf:<tokenizer path>.'
+    )
+    parser.add_argument(
+        '--group_by_image',
+        action='store_true',
+        help='Write prompts sharing an image together, with a shared-prefix manifest (<output>.groups.jsonl).'
+    )
+    add_metrics_args(parser)
     args = parser.parse_args()
     generate_prompts(
         args.extractions_file,
         args.questions_file,
-        args.output_file
+        args.output_file,
+        args.max_per_question,
+        args.max_length,
+        args.reserve_tokens,
+        args.tokenizer,
+        StageMetrics.from_args('neg_prompts', args, input_file=args.extractions_file),
+        args.group_by_image
     )
 
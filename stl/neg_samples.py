@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python3
-import json
 import argparse
-import re
+
+from instrument import StageMetrics, add_metrics_args
+from question_store import open_question_store
+from record_io import iter_records, write_records
+from records import ConversationSample
+from tokens import LengthFilter, add_length_args
 
 # Prompt template matching the required format
 prompt_template = (
@@ -16,22 +20,26 @@ prompt_template = (
     "Response:\n"
 )
 
-# Load questions into a dict keyed by question_id
+# Target response built from the extracted sections
+response_template = "CAPTION: {caption}\n\nEXPLANATION: {explanation}"
+
+# Load questions as a mapping keyed by question_id, backed by the compiled question store
 # Assumes question text already includes the choices but may contain a prompt line to remove
 
 def load_questions(filename):
-    questions = {}
-    with open(filename, 'r', encoding='utf-8') as infile:
-        for line in infile:
-            record = json.loads(line.strip())
-            qid = record.get('question_id') or record.get('id')
-            if qid is not None:
-                questions[str(qid)] = record
-    return questions
-
-# Generate standardized entries with the required format
-def generate_entries(extractions, questions_dict):
-    entries = []
+    return open_question_store(filename)
+
+def skip_reason(question_record, caption, explanation, incorrect_choice):
+    if not question_record:
+        return 'unknown_qid'
+    if not caption:
+        return 'missing_caption'
+    if not explanation:
+        return 'missing_explanation'
+    return 'missing_choice'
+
+# Generate standardized entries with the required format; skip reasons are counted in stats
+def iter_entries(extractions, questions_dict, stats=None):
     for record in extractions:
         qid = str(record.get('question_id'))
         caption = record.get('caption', '').strip()
@@ -40,6 +48,8 @@ def generate_entries(extractions, questions_dict):
 
         question_record = questions_dict.get(qid)
         if not question_record or not caption or not explanation or not incorrect_choice:
+            if stats is not None:
+                stats[skip_reason(question_record, caption, explanation, incorrect_choice)] += 1
             continue
 
         # Clean question text
@@ -52,22 +62,20 @@ def generate_entries(extractions, questions_dict):
             incorrect_choice=incorrect_choice
         )
         # Build GPT response
-        gpt_value = (
-            f"CAPTION: {caption}\n\n"
-            f"EXPLANATION: {explanation}"
-        )
+        gpt_value = response_template.format(caption=caption, explanation=explanation)
 
-        entry = {
-            "id": qid,
-            "image": question_record.get('image', ''),
-            "conversations": [
+        yield ConversationSample(
+            qid,
+            question_record.get('image', ''),
+            [
                 {"from": "human", "value": human_value},
                 {"from": "gpt",   "value": gpt_value}
             ],
-            "type": "2"
-        }
-        entries.append(entry)
-    return entries
+            "2"
+        )
+
+def generate_entries(extractions, questions_dict):
+    return list(iter_entries(extractions, questions_dict))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -76,22 +84,31 @@ if __name__ == '__main__':
     parser.add_argument('--questions_file', '-q', required=True,
                         help='Path to the questions JSONL file (with choices included in text)')
     parser.add_argument('--extractions_file', '-e', required=True,
-                        help='Path to the JSON file with extracted caption, explanation, and incorrect_choice')
+                        help='Path to the JSON or JSONL file with extracted caption, explanation, and incorrect_choice')
     parser.add_argument('--output_file', '-o', required=True,
-                        help='Path for the output JSON file')
+                        help='Path for the output JSON file (or JSONL if it ends in .jsonl)')
+    add_length_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
 
-    # Load data
-    questions = load_questions(args.questions_file)
-    with open(args.extractions_file, 'r', encoding='utf-8') as ef:
-        extractions = json.load(ef)
-
-    # Generate entries
-    entries = generate_entries(extractions, questions)
+    with StageMetrics.from_args('neg_samples', args, input_file=args.extractions_file) as metrics:
+        # Load data
+        questions = load_questions(args.questions_file)
+        extractions = iter_records(args.extractions_file)
 
-    # Write output as JSON array
-    with open(args.output_file, 'w', encoding='utf-8') as outf:
-        json.dump(entries, outf, indent=4)
+        # Generate entries and stream them out as JSON array, or JSONL for .jsonl paths
+        samples = iter_entries(extractions, questions, metrics.skipped)
+        # Measure token lengths, dropping or reporting samples over --max_length
+        length_filter = LengthFilter.from_args(args, args.output_file)
+        if length_filter is not None:
+            samples = length_filter(samples, metrics.skipped)
+        total = write_records(args.output_file, samples, indent=4)
+        metrics.records_out = total
+        if length_filter is not None:
+            metrics.info['over_length'] = length_filter.over
+        metrics.records_in = total + sum(metrics.skipped.values())
 
-    print(f"Total entries generated: {len(entries)}")
+    print(f"Total entries generated: {total}")
+    if length_filter is not None:
+        print(length_filter.report())
 
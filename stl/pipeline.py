@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+In-process STL iteration pipeline.
+
+Runs the CPU stages of one iteration as composable generator steps that
+share a single loaded question index, instead of one interpreter per
+script:
+
+  prompts  questions -> pos_prompts
+  pos      response_pos -> extracted -> correct/incorrect -> pos_samples, neg_prompts
+  neg      response_neg -> extracted_neg -> neg_samples
+  merge    pos_samples + neg_samples -> training_set
+
+Outputs consumed outside the run (prompts for model_vqa.py, samples needed
+by a later merge, the training set) are always written. Intermediate
+artifacts are written only with --keep_intermediates. --compress gz|zst
+compresses the artifacts only the stl scripts read (intermediates and
+samples); prompts, responses and the training set stay plain for
+model_vqa.py and training. When response_retry_pos_it<num>.jsonl or
+response_retry_neg_it<num>.jsonl (the answers to retry.py prompts) exists,
+its usable responses replace the skipped ones, so recovered responses
+survive a rerun.
+
+Usage:
+  python stl/pipeline.py --domain commonsense --num 1 --stage pos
+  python stl/pipeline.py --domain commonsense --num 1 --stage neg merge
+"""
+import argparse
+import os
+
+from correct_incorrect import split_extractions
+from extraction import extract_responses as extract_pos_responses
+from extraction import retry_extract_fn
+from extraction_neg import extract_responses as extract_neg_responses
+from final_training_set import attach_lengths, detach_lengths, merge_and_shuffle
+from gold_answers import load_gold_answers
+from instrument import StageMetrics, add_metrics_args
+from neg_prompts import iter_prompts, prompt_token_budget, write_prompts
+from neg_samples import iter_entries
+from pos_prompts import format_prompt
+from pos_samples import iter_conversations, load_questions
+from record_io import RecordWriter, iter_records, write_records
+from records import skipped_entry
+from sharding import iter_sharded
+from tokens import LengthFilter, lengths_path, load_token_counter
+
+STAGES = ('prompts', 'pos', 'neg', 'merge')
+
+# Artifact name -> stage that consumes it within an iteration
+CONSUMERS = {
+    'pos_samples': 'merge',
+    'neg_samples': 'merge',
+}
+
+# Intermediate artifacts that no stage reads back
+INTERMEDIATES = ('extracted', 'skipped', 'correct', 'incorrect', 'extracted_neg', 'skipped_neg')
+
+# Artifacts only read by the stl scripts, which --compress applies to
+COMPRESSIBLE = INTERMEDIATES + ('pos_samples', 'neg_samples')
+
+
+def artifact_paths(domain, num, root='.', data_dir='playground/data/folder', compress=None):
+    """Return the artifact paths used by the scripts for one domain and iteration, COMPRESSIBLE ones ending in .<compress>."""
+    out_dir = os.path.join(root, domain, 'ours')
+    paths = {
+        'questions': os.path.join(data_dir, f'questions_train_{domain}.jsonl'),
+        'correct_answers': os.path.join(data_dir, 'correct_answers_train.json'),
+        'pos_prompts': os.path.join(out_dir, f'pos_prompts_it{num}.jsonl'),
+        'response_pos': os.path.join(out_dir, f'response_pos_it{num}.jsonl'),
+        'retry_pos': os.path.join(out_dir, f'response_retry_pos_it{num}.jsonl'),
+        'extracted': os.path.join(out_dir, f'extracted_train_it{num}.jsonl'),
+        'skipped': os.path.join(out_dir, f'skipped_train_it{num}.jsonl'),
+        'correct': os.path.join(out_dir, f'correct_train_it{num}.jsonl'),
+        'incorrect': os.path.join(out_dir, f'incorrect_train_it{num}.jsonl'),
+        'pos_samples': os.path.join(out_dir, f'pos_samples_train_it{num}.jsonl'),
+        'neg_prompts': os.path.join(out_dir, f'neg_from_correct_prompts_it{num}.jsonl'),
+        'response_neg': os.path.join(out_dir, f'response_neg_train_it{num}.jsonl'),
+        'retry_neg': os.path.join(out_dir, f'response_retry_neg_it{num}.jsonl'),
+        'extracted_neg': os.path.join(out_dir, f'extracted_train_neg_it{num}.jsonl'),
+        'skipped_neg': os.path.join(out_dir, f'skipped_train_neg_it{num}.jsonl'),
+        'neg_samples': os.path.join(out_dir, f'neg_train_samples_it{num}.jsonl'),
+        'training_set': os.path.join(out_dir, f'training_set_it{num}.json'),
+    }
+    if compress:
+        for name in COMPRESSIBLE:
+            paths[name] += f'.{compress}'
+    return paths
+
+
+class _NullWriter:
+    count = 0
+
+    def write(self, record):
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+class Pipeline:
+    def __init__(self, paths, stages, keep_intermediates=False, workers=1, neg_prompt_options=None,
+                 metrics_options=None, seed=0, length_filter=None, count_tokens=None, group_by_image=False,
+                 full_skipped=False, tokenizer='approx'):
+        self.paths = paths
+        self.stages = stages
+        self.keep_intermediates = keep_intermediates
+        self.workers = workers
+        # Keyword arguments for neg_prompts.iter_prompts (fan-out cap, token budget)
+        self.neg_prompt_options = neg_prompt_options or {}
+        # metrics_file / profile / profile_mode for the per-stage instrument.StageMetrics
+        self.metrics_options = metrics_options or {}
+        # Seed of the training set shuffle
+        self.seed = seed
+        # tokens.LengthFilter applied to the pos/neg samples (reports or drops over-length samples)
+        self.length_filter = length_filter
+        # Token counter for the training set length sidecar, None to skip it
+        self.count_tokens = count_tokens
+        # Tokenizer spec recorded in the length sidecar
+        self.tokenizer = tokenizer
+        # Write prompt files grouped by image, with shared-prefix manifests
+        self.group_by_image = group_by_image
+        # Copy skipped responses in full instead of writing references
+        self.full_skipped = full_skipped
+        self.metrics = None
+        self._questions = None
+        self._memory = {}
+
+    @property
+    def questions(self):
+        # Loaded once and shared by every stage of the run
+        if self._questions is None:
+            self._questions = load_questions(self.paths['questions'])
+        return self._questions
+
+    def _writer(self, name, indent, ensure_ascii=True):
+        if name in INTERMEDIATES and not self.keep_intermediates:
+            return _NullWriter()
+        return RecordWriter(self.paths[name], indent=indent, ensure_ascii=ensure_ascii)
+
+    def _emit(self, name, records, indent=4):
+        """Keep an artifact in memory for a later stage of this run, write it to disk otherwise."""
+        in_run = CONSUMERS.get(name) in self.stages
+        if in_run:
+            records = list(records)
+            self._memory[name] = records
+        if not in_run or self.keep_intermediates:
+            return write_records(self.paths[name], records, indent=indent)
+        return len(records)
+
+    def _load(self, name):
+        if name in self._memory:
+            return self._memory.pop(name)
+        return iter_records(self.paths[name])
+
+    def _measure(self, samples):
+        if self.length_filter is None:
+            return samples
+        # Counts are reported per stage
+        self.length_filter.over = self.length_filter.longest = 0
+        return self.length_filter(samples, self.metrics.skipped)
+
+    def _report_lengths(self):
+        if self.length_filter is not None:
+            print(self.length_filter.report())
+
+    def _extract_fn(self, extract_fn, retry_name):
+        """extract_fn, applying the retry.py responses of the iteration when that file exists."""
+        if not os.path.exists(self.paths[retry_name]):
+            return extract_fn
+        extract_fn, recovered, _ = retry_extract_fn(extract_fn, [self.paths[retry_name]])
+        print(f"{recovered} usable retry responses in {self.paths[retry_name]}")
+        return extract_fn
+
+    def _split_extractions(self, results, extracted_name, skipped_name):
+        """Route parser results into the extracted/skipped artifacts, yielding extracted records."""
+        extracted_out = self._writer(extracted_name, indent=2, ensure_ascii=False)
+        skipped_out = self._writer(skipped_name, indent=2, ensure_ascii=False)
+        try:
+            for row, (kind, record, reason) in enumerate(results):
+                self.metrics.records_in += 1
+                if kind == 'extracted':
+                    extracted_out.write(record)
+                    yield record
+                else:
+                    self.metrics.skip(reason)
+                    skipped_out.write(skipped_entry(record, reason, row, self.full_skipped))
+        finally:
+            extracted_out.close()
+            skipped_out.close()
+        print(f"Extracted {extracted_out.count} entries, skipped {skipped_out.count}")
+
+    def run_prompts(self):
+        total = write_prompts((format_prompt(q) for q in self.questions.values()), self.paths['pos_prompts'],
+                              self.group_by_image)
+        self.metrics.records_in = self.metrics.records_out = total
+        print(f"Positive prompts generated: {total} -> {self.paths['pos_prompts']}")
+
+    def run_pos(self):
+        correct_answers = load_gold_answers(self.paths['correct_answers'], self.paths['questions'])
+
+        extracted = self._split_extractions(
+            iter_sharded(self.paths['response_pos'], self._extract_fn(extract_pos_responses, 'retry_pos'), self.workers),
+            'extracted', 'skipped'
+        )
+
+        correct_dict = {}
+        correct_out = self._writer('correct', indent=4)
+        incorrect_out = self._writer('incorrect', indent=4)
+
+        def correct_entries():
+            for is_correct, entry in split_extractions(extracted, correct_answers, self.metrics.skipped):
+                if is_correct:
+                    correct_out.write(entry)
+                    correct_dict[entry['question_id']] = entry
+                    yield entry
+                else:
+                    incorrect_out.write(entry)
+
+        try:
+            total = self._emit('pos_samples', self._measure(iter_conversations(correct_entries(), self.questions,
+                                                                               self.metrics.skipped)))
+        finally:
+            correct_out.close()
+            incorrect_out.close()
+        print(f"Correct: {correct_out.count}, incorrect: {incorrect_out.count}")
+        print(f"Positive samples generated: {total}")
+        self._report_lengths()
+        self.metrics.records_out = total
+
+        total = write_prompts(iter_prompts(correct_dict, self.questions, stats=self.metrics.skipped,
+                                           **self.neg_prompt_options),
+                              self.paths['neg_prompts'], self.group_by_image)
+        self.metrics.info['neg_prompts'] = total
+        print(f"Negative prompts generated: {total} -> {self.paths['neg_prompts']}")
+
+    def run_neg(self):
+        extracted = self._split_extractions(
+            iter_sharded(self.paths['response_neg'], self._extract_fn(extract_neg_responses, 'retry_neg'), self.workers),
+            'extracted_neg', 'skipped_neg'
+        )
+        total = self._emit('neg_samples', self._measure(iter_entries(extracted, self.questions,
+                                                                     self.metrics.skipped)))
+        self.metrics.records_out = total
+        print(f"Negative samples generated: {total}")
+        self._report_lengths()
+
+    def run_merge(self):
+        sources = [self._load('pos_samples'), self._load('neg_samples')]
+        if self.count_tokens is not None:
+            sources = [attach_lengths(records, self.count_tokens, tokenizer=self.tokenizer) for records in sources]
+        merged_data = merge_and_shuffle(sources, self.seed)
+        if self.count_tokens is not None:
+            merged_data = detach_lengths(merged_data, lengths_path(self.paths['training_set']))
+        total = write_records(self.paths['training_set'], merged_data, indent=4)
+        self.metrics.records_in = self.metrics.records_out = total
+        print(f"Merged and shuffled {total} entries into {self.paths['training_set']}")
+
+    def run(self):
+        for stage in STAGES:
+            if stage in self.stages:
+                print(f"Stage '{stage}'")
+                options = dict(self.metrics_options)
+                if options.get('profile'):
+                    options['profile'] = f"{options['profile']}.{stage}"
+                with StageMetrics(f'pipeline.{stage}', **options) as self.metrics:
+                    getattr(self, f'run_{stage}')()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the CPU stages of an STL iteration in a single process.")
+    parser.add_argument('--domain', required=True, help='Domain name, e.g. commonsense')
+    parser.add_argument('--num', type=int, required=True, help='Iteration number')
+    parser.add_argument('--stage', nargs='+', required=True, choices=STAGES,
+                        help='Stages to run, in pipeline order')
+    parser.add_argument('--root', default='.', help='Directory holding the <domain>/ours/ artifacts')
+    parser.add_argument('--data_dir', default='playground/data/folder', help='Directory with the question and answer files')
+    parser.add_argument('--keep_intermediates', action='store_true',
+                        help='Also write extracted, skipped, correct and incorrect artifacts')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for response extraction')
+    parser.add_argument('--neg_max_per_question', type=int, default=None,
+                        help='Keep at most this many distractors per question in the negative prompts')
+    parser.add_argument('--max_length', type=int, default=None,
+                        help='Model context length; drop negative prompts that do not fit')
+    parser.add_argument('--reserve_tokens', type=int, default=128,
+                        help='Tokens kept free for the response when --max_length is set')
+    parser.add_argument('--tokenizer', default='approx', help='approx, whitespace or hf:<tokenizer path>')
+    parser.add_argument('--drop_over_length', action='store_true',
+                        help='Drop pos/neg samples longer than --max_length tokens instead of only reporting them')
+    parser.add_argument('--lengths', action='store_true',
+                        help='Write the token lengths of the training set to training_set_it<num>.lengths.jsonl')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the training set shuffle')
+    parser.add_argument('--full_skipped', action='store_true',
+                        help='Copy skipped responses in full instead of writing {question_id, reason, row} references')
+    parser.add_argument('--compress', choices=('gz', 'zst'), default=None,
+                        help='Compress the intermediate and samples artifacts (level: STL_COMPRESS_LEVEL)')
+    parser.add_argument('--group_by_image', action='store_true',
+                        help='Write prompts sharing an image together, with shared-prefix manifests (see prompt_groups.py)')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+
+    count_tokens = load_token_counter(args.tokenizer)
+    neg_prompt_options = {'max_per_question': args.neg_max_per_question}
+    length_filter = None
+    if args.max_length:
+        neg_prompt_options['max_prompt_tokens'] = prompt_token_budget(args.max_length, args.reserve_tokens)
+        neg_prompt_options['count_tokens'] = count_tokens
+        length_filter = LengthFilter(count_tokens, args.max_length, args.drop_over_length, tokenizer=args.tokenizer)
+
+    paths = artifact_paths(args.domain, args.num, args.root, args.data_dir, args.compress)
+    os.makedirs(os.path.dirname(paths['training_set']), exist_ok=True)
+    metrics_options = {'metrics_file': args.metrics_file, 'profile': args.profile, 'profile_mode': args.profile_mode,
+                       'domain': args.domain, 'num': args.num}
+    Pipeline(paths, args.stage, args.keep_intermediates, args.workers, neg_prompt_options, metrics_options,
+             args.seed, length_filter, count_tokens if args.lengths else None, args.group_by_image,
+             args.full_skipped, args.tokenizer).run()
+
+
+if __name__ == '__main__':
+    main()
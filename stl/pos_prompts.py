@@ -1,6 +1,33 @@
-import json
 import argparse
 
+from instrument import StageMetrics, add_metrics_args
+from prompt_groups import manifest_path, write_grouped_prompts
+from record_io import open_text
+from records import dumps, loads
+
+# Prompt template
+prompt_template = (
+    "You are an image based question-answering expert. "
+    "Given an image along with a multiple choice question, your task is to select the correct choice based on the image. "
+    "Your response should strictly follow the format with three specific sections: CAPTION, REASONING and CONCLUSION. Response:\n"
+    "###CAPTION:[Provide a detailed description of the image, particularly emphasizing the aspects related to the question.]\n\n"
+    "###REASONING:[Provide a detailed thought process to answer the question.]\n\n"
+    "###CONCLUSION:[Provide the correct choice based on the reasoning.]\n\n\n"
+    "Question: {question_and_choices}\n"
+    "Response:\n"
+)
+
+def format_prompt(data):
+    """Return a copy of a question record whose text is the formatted QA prompt."""
+    question_and_choices = data.get("text", "").strip()
+
+    # Build the formatted prompt
+    formatted_prompt = prompt_template.format(
+        question_and_choices=question_and_choices
+    )
+
+    return dict(data, text=formatted_prompt)
+
 def main():
     parser = argparse.ArgumentParser(
         description="Rewrite JSONL questions into QA prompts."
@@ -15,40 +42,39 @@ def main():
         required=True,
         help='Path where the rewritten JSONL will be written'
     )
-    args = parser.parse_args()
-
-    # Prompt template
-    prompt_template = (
-        "You are an image based question-answering expert. "
-        "Given an image along with a multiple choice question, your task is to select the correct choice based on the image. "
-        "Your response should strictly follow the format with three specific sections: CAPTION, REASONING and CONCLUSION. Response:\n"
-        "###CAPTION:[Provide a detailed description of the image, particularly emphasizing the aspects related to the question.]\n\n"
-        "###REASONING:[Provide a detailed thought process to answer the question.]\n\n"
-        "###CONCLUSION:[Provide the correct choice based on the reasoning.]\n\n\n"
-        "Question: {question_and_choices}\n"
-        "Response:\n"
+    parser.add_argument(
+        '--group_by_image',
+        action='store_true',
+        help='Write prompts sharing an image together, with a shared-prefix manifest (<output>.groups.jsonl)'
     )
+    add_metrics_args(parser)
+    args = parser.parse_args()
 
-    with open(args.questions_file, 'r', encoding='utf-8') as qfile, \
-         open(args.output_file, 'w', encoding='utf-8') as outfile:
-        for line in qfile:
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
-            question_and_choices = data.get("text", "").strip()
+    with StageMetrics.from_args('pos_prompts', args, input_file=args.questions_file) as metrics, \
+         open_text(args.questions_file) as qfile:
 
-            # Build the formatted prompt
-            formatted_prompt = prompt_template.format(
-                question_and_choices=question_and_choices
-            )
+        def prompts():
+            for line in qfile:
+                metrics.records_in += 1
+                try:
+                    data = loads(line)
+                except ValueError:
+                    metrics.skip('invalid_json')
+                    continue
+                yield format_prompt(data)
 
-            # Update and write out the record
-            data["text"] = formatted_prompt
-            outfile.write(json.dumps(data, ensure_ascii=False) + "\n")
+        if args.group_by_image:
+            metrics.records_out = write_grouped_prompts(prompts(), args.output_file)
+        else:
+            with open_text(args.output_file, 'w') as outfile:
+                for record in prompts():
+                    # Update and write out the record
+                    outfile.write(dumps(record) + "\n")
+                    metrics.records_out += 1
 
     print(f"✅ Rewritten prompts written to {args.output_file}")
+    if args.group_by_image:
+        print(f"Shared-prefix manifest written to {manifest_path(args.output_file)}")
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,11 @@
-import json
 import argparse
 
+from instrument import StageMetrics, add_metrics_args
+from question_store import open_question_store
+from record_io import iter_records, write_records
+from records import ConversationSample
+from tokens import LengthFilter, add_length_args
+
 # Prompt template matching the required format
 prompt_template = (
     "You are an image based question-answering expert. "
@@ -13,19 +18,24 @@ prompt_template = (
     "Response:\n"
 )
 
-# Load questions into a dict keyed by question_id
+# Target response built from the extracted sections
+response_template = "CAPTION: {caption}\n\nREASONING: {rationale}\n\nCONCLUSION: {generated_choice}"
+
+# Load questions as a mapping keyed by question_id, backed by the compiled question store
 def load_questions(filename):
-    questions = {}
-    with open(filename, 'r', encoding='utf-8') as infile:
-        for line in infile:
-            record = json.loads(line.strip())
-            qid = record.get('question_id')
-            if qid is not None:
-                questions[str(qid)] = record
-    return questions
+    return open_question_store(filename)
 
-def generate_conversations(extractions, questions_dict):
-    conversations = []
+def skip_reason(question_record, caption, rationale, generated_choice):
+    if not question_record:
+        return 'unknown_qid'
+    if not caption:
+        return 'missing_caption'
+    if not rationale:
+        return 'missing_rationale'
+    return 'missing_choice'
+
+def iter_conversations(extractions, questions_dict, stats=None):
+    """Yield one conversation object per usable extraction; skip reasons are counted in stats."""
     for record in extractions:
         qid = str(record.get('question_id'))
         caption = record.get('caption', '').strip()
@@ -34,6 +44,8 @@ def generate_conversations(extractions, questions_dict):
 
         question_record = questions_dict.get(qid)
         if not question_record or not caption or not rationale or not generated_choice:
+            if stats is not None:
+                stats[skip_reason(question_record, caption, rationale, generated_choice)] += 1
             continue
 
         question_text = question_record.get('text', '').strip()
@@ -49,22 +61,22 @@ def generate_conversations(extractions, questions_dict):
         human_value = "<image>\n" + prompt_template.format(question_and_choices=question_and_choices)
 
         # Build gpt message
-        gpt_value = (
-            f"CAPTION: {caption}\n\n"
-            f"REASONING: {rationale}\n\n"
-            f"CONCLUSION: {generated_choice}"
+        gpt_value = response_template.format(
+            caption=caption, rationale=rationale, generated_choice=generated_choice
         )
 
-        conversations.append({
-            "id": int(qid) if qid.isdigit() else qid,
-            "image": question_record.get('image', ''),
-            "conversations": [
+        yield ConversationSample(
+            int(qid) if qid.isdigit() else qid,
+            question_record.get('image', ''),
+            [
                 {"from": "human", "value": human_value},
                 {"from": "gpt", "value": gpt_value}
             ],
-            "type": "1"
-        })
-    return conversations
+            "1"
+        )
+
+def generate_conversations(extractions, questions_dict):
+    return list(iter_conversations(extractions, questions_dict))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -73,17 +85,29 @@ if __name__ == '__main__':
     parser.add_argument('--questions_file', '-q', required=True,
                         help='Path to the questions JSONL file')
     parser.add_argument('--extractions_file', '-e', required=True,
-                        help='Path to the JSON file with extracted caption, rationale, choice')
+                        help='Path to the JSON or JSONL file with extracted caption, rationale, choice')
     parser.add_argument('--output_file', '-o', required=True,
-                        help='Path for the output JSON file')
+                        help='Path for the output JSON file (or JSONL if it ends in .jsonl)')
+    add_length_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
 
-    questions = load_questions(args.questions_file)
-    with open(args.extractions_file, 'r', encoding='utf-8') as ef:
-        extractions = json.load(ef)
+    with StageMetrics.from_args('pos_samples', args, input_file=args.extractions_file) as metrics:
+        questions = load_questions(args.questions_file)
+        extractions = iter_records(args.extractions_file)
 
-    convos = generate_conversations(extractions, questions)
-    with open(args.output_file, 'w', encoding='utf-8') as outf:
-        json.dump(convos, outf, indent=4)
+        # Stream conversations out as JSON array, or JSONL for .jsonl paths
+        samples = iter_conversations(extractions, questions, metrics.skipped)
+        # Measure token lengths, dropping or reporting samples over --max_length
+        length_filter = LengthFilter.from_args(args, args.output_file)
+        if length_filter is not None:
+            samples = length_filter(samples, metrics.skipped)
+        total = write_records(args.output_file, samples, indent=4)
+        metrics.records_out = total
+        if length_filter is not None:
+            metrics.info['over_length'] = length_filter.over
+        metrics.records_in = total + sum(metrics.skipped.values())
 
-    print(f"Total conversation objects generated: {len(convos)}")
+    print(f"Total conversation objects generated: {total}")
+    if length_filter is not None:
+        print(length_filter.report())
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Image-grouped prompt files with a shared-prefix manifest.
+
+The negative pass asks up to three prompts per question that share the
+image and all of the text except the "Explain why this answer is wrong"
+line, and every positive prompt starts with the same instructions. When
+prompts are written grouped, records with the same image are consecutive
+(groups in order of first appearance, records in input order) and a
+manifest (<prompts>.groups.jsonl by default) holds one line per group:
+
+  {"group", "image", "prefix", "records": [{"row", "question_id", "suffix_offset"}, ...]}
+
+row indexes the prompt file, prefix is the text shared by the group, cut
+at a line boundary, and text[suffix_offset:] is what remains to prefill for
+a record once the image is encoded and the prefix is in the KV cache. A
+group of one record shares the prefix common to the whole file. When every
+image is used by a single question, the prompt file is the same as
+ungrouped. The records are ordered with the external sort of record_io,
+so a prompt file of any size is grouped in bounded memory.
+"""
+import os
+from itertools import groupby
+
+from record_io import SORT_CHUNK_SIZE, ExternalSort, RecordWriter, open_text, with_suffix
+from records import dumps
+
+
+def manifest_path(prompts_file):
+    return with_suffix(prompts_file, '.groups', '.jsonl')
+
+
+def _prefix_length(first, last, shortest):
+    # The common prefix of the smallest and largest text is common to all of them
+    common = os.path.commonprefix([first, last])
+    return common.rfind('\n', 0, min(len(common), shortest - 1)) + 1
+
+
+def shared_prefix_length(texts):
+    """Length of the longest common prefix of texts that ends at a line boundary and leaves every text a suffix."""
+    if not texts:
+        return 0
+    return _prefix_length(min(texts), max(texts), min(len(text) for text in texts))
+
+
+def write_grouped_prompts(prompts, output_file, manifest_file=None, chunk_size=SORT_CHUNK_SIZE, tmp_dir=None):
+    """
+    Write prompt records grouped by image to a JSONL file, with their
+    manifest; return the count. Records are ordered with an external sort,
+    so at most chunk_size of them (and one group) are held in memory.
+    """
+    group_ids = {}
+    records = ExternalSort(chunk_size, tmp_dir)
+    first = last = shortest = None
+    for row, record in enumerate(prompts):
+        group_id = group_ids.setdefault(record.get('image'), len(group_ids))
+        # Groups in order of first appearance, records in input order within a group
+        records.add((group_id << 32) | row, record)
+        text = record.get('text', '')
+        if first is None:
+            first = last = text
+            shortest = len(text)
+        else:
+            first, last, shortest = min(first, text), max(last, text), min(shortest, len(text))
+    file_prefix = _prefix_length(first, last, shortest) if first is not None else 0
+
+    row = 0
+    with open_text(output_file, 'w') as outfile, \
+         RecordWriter(manifest_file or manifest_path(output_file)) as manifest:
+        for index, (image, group) in enumerate(groupby(records, key=lambda record: record.get('image'))):
+            group = list(group)
+            texts = [record.get('text', '') for record in group]
+            offset = shared_prefix_length(texts) if len(group) > 1 else file_prefix
+            manifest.write({
+                "group": index,
+                "image": image,
+                "prefix": texts[0][:offset],
+                "records": [{"row": row + i, "question_id": record.get('question_id'), "suffix_offset": offset}
+                            for i, record in enumerate(group)],
+            })
+            for record in group:
+                outfile.write(dumps(record) + '\n')
+            row += len(group)
+    return records.count
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled, memory-mapped question store.
+
+A questions_*.jsonl file is compiled once into a binary index next to it
+(<questions_file>.qidx) holding, per question_id, the question text, the
+parsed "(x) text" choices, the image path and the category. Stages open
+the index with mmap and do O(1) lookups through an on-disk hash table, so
+no JSON is parsed after the first build and the pages are shared between
+processes running side by side. The index is rebuilt automatically when
+the source file changes.
+
+Layout (little-endian):
+  header   magic, version, count, nslots, source size, source mtime_ns
+  slots    nslots x (hash64, record offset), offset 0 = empty slot
+  records  u32 length + flags byte + length-prefixed UTF-8 fields + choices
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+from collections.abc import Mapping
+
+from record_io import open_text
+from records import Question
+
+MAGIC = b'STLQ'
+VERSION = 1
+INDEX_SUFFIX = '.qidx'
+
+_header = struct.Struct('<4sIIIQQ')
+_slot = struct.Struct('<QQ')
+_u32 = struct.Struct('<I')
+_u16 = struct.Struct('<H')
+_NONE = 0xFFFFFFFF
+
+# Field order inside a record; a missing field is stored as _NONE
+FIELDS = ('question_id', 'image', 'text', 'category')
+
+# Choice lines in the question text: "(a) text"
+choice_pattern = re.compile(r"^\(([a-z])\)\s*(.+)$")
+
+_open_stores = {}
+
+
+def _hash(qid):
+    return int.from_bytes(hashlib.blake2b(qid.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def parse_choices(question_text):
+    """Return the [(letter, text)] choices listed in a question text, e.g. [('(a)', 'Red')]."""
+    choices = {}
+    for line in question_text.splitlines():
+        m = choice_pattern.match(line.strip())
+        if m:
+            choices[f"({m.group(1)})"] = m.group(2).strip()
+    return list(choices.items())
+
+
+def _pack_str(value):
+    if value is None:
+        return _u32.pack(_NONE)
+    data = value.encode('utf-8')
+    return _u32.pack(len(data)) + data
+
+
+def _pack_record(qid, record):
+    parts = [_pack_str(qid)]
+    for field in FIELDS[1:]:
+        value = record.get(field)
+        parts.append(_pack_str(value if value is None or isinstance(value, str) else str(value)))
+    # Any other fields are kept verbatim so records round-trip
+    extra = {k: v for k, v in record.items() if k not in FIELDS}
+    parts.append(_pack_str(json.dumps(extra, ensure_ascii=False) if extra else None))
+    choices = parse_choices(record.get('text') or '')
+    parts.append(_u16.pack(len(choices)))
+    for letter, text in choices:
+        parts.append(_pack_str(letter))
+        parts.append(_pack_str(text))
+    body = b''.join(parts)
+    return _u32.pack(len(body)) + body
+
+
+def default_index_path(questions_file):
+    return questions_file + INDEX_SUFFIX
+
+
+def build_question_store(questions_file, index_file=None):
+    """Compile a questions JSONL file into a binary index and return the index path."""
+    index_file = index_file or default_index_path(questions_file)
+    stat = os.stat(questions_file)
+
+    # Last record wins for duplicate ids, as with the dict based loaders
+    questions = {}
+    with open_text(questions_file) as infile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            qid = record.get('question_id') or record.get('id')
+            if qid is not None:
+                questions[str(qid)] = record
+
+    nslots = max(8, 2 * len(questions))
+    slots = [(0, 0)] * nslots
+    records = []
+    offset = _header.size + nslots * _slot.size
+    for qid, record in questions.items():
+        h = _hash(qid)
+        i = h % nslots
+        while slots[i][1]:
+            i = (i + 1) % nslots
+        slots[i] = (h, offset)
+        packed = _pack_record(qid, record)
+        records.append(packed)
+        offset += len(packed)
+
+    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as out:
+        out.write(_header.pack(MAGIC, VERSION, len(questions), nslots, stat.st_size, stat.st_mtime_ns))
+        out.write(b''.join(_slot.pack(h, off) for h, off in slots))
+        out.writelines(records)
+    os.replace(tmp_file, index_file)
+    return index_file
+
+
+class QuestionStore(Mapping):
+    """Read-only mapping of question_id -> question record backed by an mmapped index."""
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self._nslots, self.source_size, self.source_mtime_ns = \
+            _header.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{index_file} is not a question store (version {VERSION})")
+        self._records_start = _header.size + self._nslots * _slot.size
+
+    def _read_str(self, pos):
+        (n,) = _u32.unpack_from(self._mm, pos)
+        if n == _NONE:
+            return None, pos + 4
+        return self._mm[pos + 4:pos + 4 + n].decode('utf-8'), pos + 4 + n
+
+    def _find(self, qid):
+        h = _hash(qid)
+        i = h % self._nslots
+        while True:
+            slot_hash, offset = _slot.unpack_from(self._mm, _header.size + i * _slot.size)
+            if not offset:
+                return None
+            if slot_hash == h and self._read_str(offset + 4)[0] == qid:
+                return offset
+            i = (i + 1) % self._nslots
+
+    def _decode(self, offset, with_record=True):
+        pos = offset + 4
+        values = []
+        for _ in FIELDS:
+            value, pos = self._read_str(pos)
+            values.append(value)
+        extra, pos = self._read_str(pos)
+        (nchoices,) = _u16.unpack_from(self._mm, pos)
+        pos += 2
+        choices = []
+        for _ in range(nchoices):
+            letter, pos = self._read_str(pos)
+            text, pos = self._read_str(pos)
+            choices.append((letter, text))
+        record = None
+        if with_record:
+            fields = {field: value for field, value in zip(FIELDS, values) if value is not None}
+            record = Question(**fields, **json.loads(extra)) if extra is not None else Question(**fields)
+        return record, choices
+
+    def __getitem__(self, qid):
+        offset = self._find(str(qid))
+        if offset is None:
+            raise KeyError(qid)
+        return self._decode(offset)[0]
+
+    def __contains__(self, qid):
+        return self._find(str(qid)) is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        # Records are stored in source file order
+        pos = self._records_start
+        for _ in range(self._count):
+            (size,) = _u32.unpack_from(self._mm, pos)
+            yield self._read_str(pos + 4)[0]
+            pos += 4 + size
+
+    def choices(self, qid):
+        """Return the parsed [(letter, text)] choices of a question, or [] if it is unknown."""
+        offset = self._find(str(qid))
+        if offset is None:
+            return []
+        return self._decode(offset, with_record=False)[1]
+
+    def is_stale(self, questions_file):
+        stat = os.stat(questions_file)
+        return (stat.st_size, stat.st_mtime_ns) != (self.source_size, self.source_mtime_ns)
+
+    def close(self):
+        self._mm.close()
+
+
+def open_question_store(questions_file, index_file=None):
+    """
+    Open the question store for a questions file, building or rebuilding its
+    index when missing or out of date. Stores are cached per process.
+    """
+    index_file = index_file or default_index_path(questions_file)
+    store = _open_stores.get(index_file)
+    if store is not None and not store.is_stale(questions_file):
+        return store
+
+    store = None
+    if os.path.exists(index_file):
+        try:
+            store = QuestionStore(index_file)
+        except (ValueError, struct.error):
+            store = None
+        if store is not None and store.is_stale(questions_file):
+            store.close()
+            store = None
+    if store is None:
+        store = QuestionStore(build_question_store(questions_file, index_file))
+    _open_stores[index_file] = store
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile a questions JSONL file into a memory-mapped question store.")
+    parser.add_argument('--questions_file', '-q', required=True, help='Path to the questions JSONL file')
+    parser.add_argument('--index_file', '-o', help='Path for the index (default: <questions_file>.qidx)')
+    args = parser.parse_args()
+
+    index_file = build_question_store(args.questions_file, args.index_file)
+    store = QuestionStore(index_file)
+    print(f"Indexed {len(store)} questions into {index_file}")
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Record readers and writers shared by the stl stages.
+
+Paths ending in .jsonl/.ndjson are read and written one record per line,
+so a stage holds a single record at a time. Any other path is treated as a
+JSON array, which is still written incrementally and is byte-identical to
+json.dump(records, f, indent=...). Typed records (records.py) are written as
+their dict, and JSONL lines go through the records.py codec.
+
+A .gz or .zst suffix after the extension (records.jsonl.gz,
+training_set.json.zst) compresses the file as a stream with gzip or
+zstandard (the zstandard package is only imported for .zst paths). The
+compression level is the level argument, else STL_COMPRESS_LEVEL, else
+COMPRESS_LEVELS.
+
+ExternalSort orders a stream of records by integer keys while holding a
+bounded number of them in memory, spilling sorted runs to temporary files.
+"""
+import gzip
+import heapq
+import io
+import json
+import os
+import tempfile
+from contextlib import ExitStack
+
+from records import dumps, loads, to_json
+
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+
+# Default level per compression suffix
+COMPRESS_LEVELS = {'.gz': 6, '.zst': 3}
+
+# Records ExternalSort holds in memory before spilling a sorted run
+SORT_CHUNK_SIZE = 100000
+
+
+def split_compression(path):
+    """Return (path without a .gz/.zst suffix, the suffix or '')."""
+    root, ext = os.path.splitext(path)
+    if ext.lower() in COMPRESS_LEVELS:
+        return root, ext.lower()
+    return path, ''
+
+
+def is_compressed(path):
+    return bool(split_compression(path)[1])
+
+
+def is_jsonl(path):
+    return os.path.splitext(split_compression(path)[0])[1].lower() in JSONL_EXTENSIONS
+
+
+def with_suffix(path, suffix, ext=None):
+    """Insert suffix before the extension, keeping any compression suffix: a.jsonl.gz -> a<suffix>.jsonl.gz."""
+    inner, compression = split_compression(path)
+    root, inner_ext = os.path.splitext(inner)
+    return root + suffix + (inner_ext if ext is None else ext) + compression
+
+
+def compress_level(path, level=None):
+    if level is None:
+        level = os.environ.get('STL_COMPRESS_LEVEL')
+    return COMPRESS_LEVELS[split_compression(path)[1]] if level is None else int(level)
+
+
+def open_text(path, mode='r', level=None):
+    """Open a text file for 'r', 'w' or 'a', decompressing or compressing .gz/.zst paths as a stream."""
+    compression = split_compression(path)[1]
+    if compression == '.gz':
+        return gzip.open(path, mode + 't', compresslevel=compress_level(path, level), encoding='utf-8')
+    if compression == '.zst':
+        import zstandard
+
+        raw = open(path, mode + 'b')
+        if mode == 'r':
+            # Appended runs are separate frames
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=compress_level(path, level)).stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def iter_records(path, record_type=None):
+    """Yield the records of a JSONL file or a JSON array file, as record_type (see records.py) when given."""
+    with open_text(path) as f:
+        if is_jsonl(path):
+            records = (loads(line) for line in f if line.strip())
+        else:
+            records = loads(f.read())
+        if record_type is None:
+            yield from records
+        else:
+            for record in records:
+                yield record_type.from_dict(record)
+
+
+class RecordWriter:
+    """
+    Write records one at a time to a JSONL file or a JSON array file.
+    indent and ensure_ascii only affect the JSON array layout; append is
+    only supported for JSONL files. level sets the compression level of
+    .gz/.zst paths.
+    """
+
+    def __init__(self, path, indent=None, ensure_ascii=True, append=False, level=None):
+        self.path = path
+        self.jsonl = is_jsonl(path)
+        if append and not self.jsonl:
+            raise ValueError(f"Cannot append to JSON array file {path}")
+        self.indent = indent
+        self.ensure_ascii = ensure_ascii
+        self.count = 0
+        self._f = open_text(path, 'a' if append else 'w', level)
+
+    def write(self, record):
+        if self.jsonl:
+            self._f.write(dumps(record) + '\n')
+        elif self.indent is None:
+            self._f.write(('[' if self.count == 0 else ', ') + json.dumps(record, ensure_ascii=self.ensure_ascii, default=to_json))
+        else:
+            pad = ' ' * self.indent
+            text = json.dumps(record, ensure_ascii=self.ensure_ascii, indent=self.indent, default=to_json)
+            self._f.write(('[\n' if self.count == 0 else ',\n') + pad + text.replace('\n', '\n' + pad))
+        self.count += 1
+
+    def close(self):
+        if self._f.closed:
+            return
+        if not self.jsonl:
+            if self.count == 0:
+                self._f.write('[]')
+            else:
+                self._f.write(']' if self.indent is None else '\n]')
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_records(path, records, indent=None, ensure_ascii=True, level=None):
+    """Write an iterable of records and return how many were written."""
+    with RecordWriter(path, indent=indent, ensure_ascii=ensure_ascii, level=level) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
+
+
+class ExternalSort:
+    """
+    Yield added (key, record) pairs' records in key order while holding at
+    most chunk_size of them in memory. Keys are integers in [0, 2**64);
+    records with equal keys come back in an unspecified order.
+    """
+
+    def __init__(self, chunk_size=SORT_CHUNK_SIZE, tmp_dir=None):
+        self.chunk_size = chunk_size
+        self.tmp_dir = tmp_dir
+        self.count = 0
+        self._chunk = []
+        self._runs = []
+
+    def add(self, key, record):
+        self._chunk.append((key, record))
+        self.count += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        self._chunk.sort(key=lambda item: item[0])
+        fd, path = tempfile.mkstemp(prefix='stl_sort_', suffix='.run', dir=self.tmp_dir)
+        with open(fd, 'w', encoding='utf-8') as f:
+            for key, record in self._chunk:
+                # Fixed-width hex keys sort the same as text and as numbers
+                f.write(f"{key:016x}\t{dumps(record)}\n")
+        self._runs.append(path)
+        self._chunk = []
+
+    def __iter__(self):
+        if not self._runs:
+            self._chunk.sort(key=lambda item: item[0])
+            for _, record in self._chunk:
+                yield record
+            self._chunk = []
+            return
+        if self._chunk:
+            self._spill()
+        try:
+            with ExitStack() as stack:
+                runs = [stack.enter_context(open_text(path)) for path in self._runs]
+                for line in heapq.merge(*runs):
+                    yield loads(line[17:])
+        finally:
+            for path in self._runs:
+                os.remove(path)
+            self._runs = []
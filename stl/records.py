@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Typed stage records and the JSON codec used to read and write them.
+
+The stages create one of these compact records instead of a dict:
+
+  Question            question_id, image, text, category (question_store.py)
+  PosResponse         question_id, prompt, text, answer_id, model_id, metadata
+                      (inference.py answers, for the positive and negative pass)
+  Extraction          question_id, caption, rationale, generated_choice
+  NegExtraction       question_id, caption, explanation, generated_choice, incorrect_choice
+  ConversationSample  id, image, conversations, type
+  SkippedRef          question_id, reason, row: what the skipped outputs keep
+                      of an unusable response (row indexes the response file)
+
+Fields live in __slots__ and any other keys in an extra dict, so a record
+takes a fraction of a dict's memory. Records are read-only Mappings: code
+that uses record['caption'] or record.get('caption', '') works unchanged,
+a field that was never set is a missing key, and a record equals the dict
+it serializes to. Keys are written in field order, then the extra keys.
+
+dumps/loads use orjson when it is installed and the stdlib json module
+otherwise; STL_JSON_CODEC=json (or use_codec('json')) forces the stdlib.
+orjson writes JSONL lines without the blanks after ',' and ':'. Indented
+JSON arrays are always written by the stdlib, so they stay byte-identical.
+"""
+import json
+import os
+from collections.abc import Mapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODECS = ('auto', 'json', 'orjson')
+
+# Optional per-sample sampling weight of a ConversationSample, written by
+# dedup.py --mode weight and read by final_training_set.py
+WEIGHT_KEY = 'weight'
+
+
+class Record(Mapping):
+    """Base of the typed records: FIELDS in __slots__, read like the dict they replace."""
+
+    __slots__ = ('extra',)
+    FIELDS = ()
+
+    def __init__(self, *values, **fields):
+        for name, value in zip(self.FIELDS, values):
+            setattr(self, name, value)
+        extra = None
+        for name, value in fields.items():
+            if name in self.FIELDS:
+                setattr(self, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, data):
+        return data if isinstance(data, cls) else cls(**data)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __iter__(self):
+        for name in self.FIELDS:
+            if hasattr(self, name):
+                yield name
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS if hasattr(self, name)}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Question(Record):
+    __slots__ = FIELDS = ('question_id', 'image', 'text', 'category')
+
+
+class PosResponse(Record):
+    __slots__ = FIELDS = ('question_id', 'prompt', 'text', 'answer_id', 'model_id', 'metadata')
+
+
+class Extraction(Record):
+    __slots__ = FIELDS = ('question_id', 'caption', 'rationale', 'generated_choice')
+
+
+class NegExtraction(Record):
+    __slots__ = FIELDS = ('question_id', 'caption', 'explanation', 'generated_choice', 'incorrect_choice')
+
+
+class ConversationSample(Record):
+    __slots__ = FIELDS = ('id', 'image', 'conversations', 'type')
+
+
+class SkippedRef(Record):
+    __slots__ = FIELDS = ('question_id', 'reason', 'row')
+
+
+def skipped_entry(response, reason, row=None, full=False):
+    """The skipped output record of a response: a SkippedRef, or the whole response with full."""
+    if full:
+        return response
+    if row is None:
+        return SkippedRef(response.get('question_id'), reason)
+    return SkippedRef(response.get('question_id'), reason, row)
+
+
+def is_skipped_ref(record):
+    return 'reason' in record and 'prompt' not in record and 'text' not in record
+
+
+def to_json(obj):
+    """default= hook of the encoders: records are written as their dict."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=to_json)
+
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, default=to_json, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    except TypeError:
+        # Integers beyond 64 bits and other values only the stdlib encodes
+        return _stdlib_dumps(obj)
+
+
+def _orjson_loads(text):
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        # NaN, Infinity and big integers are accepted by the stdlib
+        return json.loads(text)
+
+
+def use_codec(name='auto'):
+    """Select the codec behind dumps/loads: auto (orjson if installed), json or orjson. Returns the one in use."""
+    global codec, _dumps, _loads
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON codec '{name}' (expected {', '.join(CODECS)})")
+    if name == 'orjson' and orjson is None:
+        raise ValueError("The orjson codec needs the orjson package")
+    codec = 'orjson' if name != 'json' and orjson is not None else 'json'
+    if codec == 'orjson':
+        _dumps, _loads = _orjson_dumps, _orjson_loads
+    else:
+        _dumps, _loads = _stdlib_dumps, json.loads
+    return codec
+
+
+def dumps(obj):
+    """One-line JSON text of obj, non-ASCII characters unescaped."""
+    return _dumps(obj)
+
+
+def loads(text):
+    return _loads(text)
+
+
+codec = _dumps = _loads = None
+use_codec(os.environ.get('STL_JSON_CODEC', 'auto'))
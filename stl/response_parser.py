@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Shared response parser for the extraction stages.
+
+A response is tokenized once into its CAPTION / REASONING / EXPLANATION /
+CONCLUSION sections with a single precompiled marker pattern, so parsing
+stays linear in the response length even for long degenerate generations.
+
+StreamingParser applies the same rules while a response is being generated,
+so an inference loop can stop as soon as the outcome of extraction is known.
+"""
+import re
+from functools import lru_cache
+
+# Section markers, matched case-insensitively in one pass over the response
+section_pattern = re.compile(r"(CAPTION|REASONING|EXPLANATION|CONCLUSION):", re.IGNORECASE)
+# A choice letter such as "(b)"
+letter_pattern = re.compile(r"\(([a-z])\)")
+# Choice lines in the question block: "(a) text"
+choice_line_pattern = re.compile(r"\(([a-z])\)\s*(.+)")
+# "The correct choice is (x)." line of a negative prompt
+correct_choice_pattern = re.compile(r"^The correct choice is.*?\(([a-z])\)", re.MULTILINE)
+# "Explain why this answer is wrong: (x)" line of a negative prompt
+incorrect_choice_pattern = re.compile(r"Explain why this answer is wrong:\s*(\([a-z]\))", re.IGNORECASE)
+
+# Section layouts: each section runs up to the first occurrence of its terminator
+POS_LAYOUT = (("CAPTION", "REASONING"), ("REASONING", "CONCLUSION"), ("CONCLUSION", None))
+NEG_LAYOUT = (("CAPTION", "EXPLANATION"), ("EXPLANATION", None))
+
+# Threshold for excessive zeros in a rationale or explanation
+ZERO_THRESHOLD = 50
+
+# Sections the extraction stages reject when they are degenerate
+DEGENERATE_SECTIONS = ('REASONING', 'EXPLANATION')
+# Longest section marker ("EXPLANATION:"), the most a marker can straddle two pieces
+MAX_MARKER_LENGTH = 12
+# A generation whose last REPEAT_WINDOW characters repeat a unit of at most
+# MAX_PERIOD characters is looping
+REPEAT_WINDOW = 256
+MAX_PERIOD = 64
+
+# StreamingParser states
+RUNNING, DONE, ABORT = 'running', 'done', 'abort'
+
+
+def tokenize_sections(text):
+    """Return the section markers found in text as (name, start, end) tuples."""
+    return [(m.group(1).upper(), m.start(), m.end()) for m in section_pattern.finditer(text)]
+
+
+def split_sections(text, layout=POS_LAYOUT):
+    """
+    Split a response into its sections.
+    Each section starts at the first occurrence of its marker and ends at the
+    first occurrence of its terminator after that point (or at the end of the
+    text). Missing sections map to None.
+    """
+    markers = tokenize_sections(text)
+    sections = {}
+    for name, terminator in layout:
+        body_start = None
+        body_end = len(text)
+        for marker, start, end in markers:
+            if body_start is None:
+                if marker == name:
+                    body_start = end
+            elif marker == terminator and start >= body_start:
+                body_end = start
+                break
+        sections[name] = text[body_start:body_end].strip() if body_start is not None else None
+    return sections
+
+
+@lru_cache(maxsize=65536)
+def choice_mapping(question_block):
+    """Map each choice letter in a question block to a case-insensitive pattern for its text."""
+    mapping = {}
+    for line in question_block.splitlines():
+        m = choice_line_pattern.match(line.strip())
+        if m:
+            mapping[m.group(1)] = re.compile(re.escape(m.group(2).strip()), re.IGNORECASE)
+    return mapping
+
+
+def extract_choice(conclusion_text, prompt_text):
+    """
+    Resolve the chosen letter from a conclusion.
+    Method1: the first "(x)" letter in the conclusion.
+    Method2: the only choice whose text appears in the conclusion.
+    """
+    if conclusion_text:
+        m = letter_pattern.search(conclusion_text)
+        if m:
+            return f"({m.group(1)})"
+
+    found = [letter for letter, pattern in choice_mapping(prompt_text.split("Question:")[-1]).items()
+             if pattern.search(conclusion_text)]
+    if len(found) == 1:
+        return f"({found[0]})"
+    return None
+
+
+def is_degenerate(text, threshold=ZERO_THRESHOLD):
+    """Return True if text contains more zeros than the threshold allows."""
+    return text.count('0') > threshold
+
+
+def parse_pos_response(resp, prompt_text):
+    """Parse a positive response into (caption, rationale, choice)."""
+    sections = split_sections(resp, POS_LAYOUT)
+    choice = extract_choice(sections["CONCLUSION"] or '', prompt_text)
+    return sections["CAPTION"], sections["REASONING"], choice
+
+
+def parse_neg_prompt(prompt_text):
+    """Return the (correct_choice, incorrect_choice) letters named in a negative prompt."""
+    m = correct_choice_pattern.search(prompt_text)
+    correct_choice = f"({m.group(1)})" if m else None
+    m = incorrect_choice_pattern.search(prompt_text)
+    incorrect_choice = m.group(1) if m else None
+    return correct_choice, incorrect_choice
+
+
+def parse_neg_response(resp, prompt_text):
+    """Parse a negative response into (caption, explanation, correct_choice, incorrect_choice)."""
+    sections = split_sections(resp, NEG_LAYOUT)
+    correct_choice, incorrect_choice = parse_neg_prompt(prompt_text)
+    return sections["CAPTION"], sections["EXPLANATION"], correct_choice, incorrect_choice
+
+
+class StreamingParser:
+    """
+    Incremental version of the section parser, fed the generated text piece
+    by piece (for instance one decoded token at a time). feed() returns:
+
+      RUNNING  keep generating
+      DONE     a CONCLUSION with a "(x)" letter has been emitted after every
+               other section of the layout was closed; the rest of the
+               response cannot change the extraction
+      ABORT    a REASONING or EXPLANATION section has more zeros than
+               ZERO_THRESHOLD (extraction would skip the response anyway),
+               or the text has fallen into a loop of a short repeated unit
+
+    reason holds 'conclusion', 'zero_threshold' or 'repetition' once the
+    state is not RUNNING, and end the offset in text the response can be cut
+    at (just after the CONCLUSION letter when DONE). Pass repeat_window=0 to
+    disable loop detection.
+    """
+
+    def __init__(self, layout=POS_LAYOUT, zero_threshold=ZERO_THRESHOLD, repeat_window=REPEAT_WINDOW,
+                 max_period=MAX_PERIOD):
+        self.terminators = dict(layout)
+        self.zero_threshold = zero_threshold
+        self.repeat_window = repeat_window
+        self.max_period = max_period
+        self.text = ''
+        self.state = RUNNING
+        self.reason = None
+        self.end = None
+        # Section name -> body start / end offsets in text
+        self.starts = {}
+        self.ends = {}
+        self._zeros = {}
+        self._scan = 0
+        self._repeat_checked = 0
+
+    def _stop(self, state, reason, end=None):
+        self.state, self.reason = state, reason
+        self.end = len(self.text) if end is None else end
+        return state
+
+    def _markers(self):
+        for m in section_pattern.finditer(self.text, self._scan):
+            name = m.group(1).upper()
+            for section, start in self.starts.items():
+                if section not in self.ends and self.terminators.get(section) == name and m.start() >= start:
+                    self.ends[section] = m.start()
+            if name in self.terminators and name not in self.starts:
+                self.starts[name] = m.end()
+                self._zeros[name] = 0
+            self._scan = m.end()
+        # The tail may hold the beginning of a marker completed by the next piece
+        self._scan = max(self._scan, len(self.text) - MAX_MARKER_LENGTH + 1)
+
+    def _looping(self):
+        tail = self.text[-self.repeat_window:]
+        return any(tail[p:] == tail[:-p] for p in range(1, self.max_period + 1))
+
+    def feed(self, piece):
+        """Append generated text and return the new state."""
+        if self.state != RUNNING:
+            return self.state
+        previous = len(self.text)
+        self.text += piece
+        self._markers()
+
+        for section in DEGENERATE_SECTIONS:
+            if section in self.starts:
+                end = self.ends.get(section, len(self.text))
+                begin = max(self.starts[section], previous)
+                if begin < end:
+                    self._zeros[section] += self.text.count('0', begin, end)
+                if self._zeros[section] > self.zero_threshold:
+                    return self._stop(ABORT, 'zero_threshold')
+
+        # Every section with a terminator must have been emitted and closed, so
+        # stopping here cannot change what extraction reads from the response
+        letter = 'CONCLUSION' in self.starts and letter_pattern.search(self.text, self.starts['CONCLUSION'])
+        if letter and all(terminator is None or section in self.ends
+                          for section, terminator in self.terminators.items()):
+            return self._stop(DONE, 'conclusion', letter.end())
+
+        if (self.repeat_window and len(self.text) >= self.repeat_window
+                and len(self.text) - self._repeat_checked >= self.max_period // 2):
+            self._repeat_checked = len(self.text)
+            if self._looping():
+                return self._stop(ABORT, 'repetition')
+        return RUNNING
+
+
+def feed_stream(parser, pieces):
+    """Feed pieces to a StreamingParser until it stops; return the text consumed and the final state."""
+    for piece in pieces:
+        if parser.feed(piece) != RUNNING:
+            break
+    return parser.text, parser.state
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Retry queue for responses the extraction stages could not parse.
+
+Instead of running model_vqa.py on the whole prompt file again, only the
+skipped responses are re-inferred:
+
+  prompts  skipped_*.json + the prompt file given to model_vqa.py
+           -> a prompt JSONL holding just the skipped prompts, one per
+              sampling variant (--temperatures / --top_p are stored under
+              "sampling" in each record, see inference.py)
+  merge    responses to the retry prompts -> extracted with the pos or neg
+           parser; the first usable response per skipped prompt is appended
+           to the extracted file, and the skipped file is rewritten with
+           only the prompts that still failed
+
+merge patches the outputs of one extraction run. To keep the recovered
+responses when the extraction runs again, pass the retry responses to it:
+extraction.py / extraction_neg.py --retry_files, or name them
+response_retry_pos_it<num>.jsonl / response_retry_neg_it<num>.jsonl next to
+the responses, which pipeline.py and dag.py pick up.
+
+Skipped files hold {question_id, reason, row} references unless the
+extraction ran with --full_skipped; --responses_file (the response file
+the extraction read) resolves them to the skipped responses and is required
+for such files.
+
+Usage:
+  python stl/retry.py prompts -s commonsense/ours/skipped_train_it1.json -r commonsense/ours/response_pos_it1.jsonl \\
+      -p commonsense/ours/pos_prompts_it1.jsonl -o commonsense/ours/retry_pos_prompts_it1.jsonl --temperatures 0.7 1.0
+  python stl/inference.py run -q commonsense/ours/retry_pos_prompts_it1.jsonl \\
+      -o commonsense/ours/response_retry_pos_it1.jsonl --backend "cmd:..."
+  python stl/retry.py merge --kind pos -i commonsense/ours/response_retry_pos_it1.jsonl -r commonsense/ours/response_pos_it1.jsonl \\
+      -e commonsense/ours/extracted_train_it1.json -s commonsense/ours/skipped_train_it1.json
+  python stl/extraction.py -i commonsense/ours/response_pos_it1.jsonl --retry_files commonsense/ours/response_retry_pos_it1.jsonl \\
+      -e commonsense/ours/extracted_train_it1.json -s commonsense/ours/skipped_train_it1.json
+"""
+import argparse
+import os
+
+from extraction import extract_responses as extract_pos_responses
+from extraction import group_by_question, match_key, response_key
+from extraction_neg import extract_responses as extract_neg_responses
+from instrument import StageMetrics, add_metrics_args
+from record_io import RecordWriter, iter_records, with_suffix, write_records
+from records import is_skipped_ref
+
+EXTRACTORS = {'pos': extract_pos_responses, 'neg': extract_neg_responses}
+
+
+def extraction_key(record):
+    # Negative extractions of one question differ by the incorrect choice
+    return str(record.get('question_id')), record.get('incorrect_choice')
+
+
+def has_references(skipped_file):
+    return any(is_skipped_ref(record) for record in iter_records(skipped_file))
+
+
+def resolve_skipped(skipped, responses_file=None):
+    """
+    Return the skipped records with each reference replaced by the response
+    at its row of responses_file. Raises ValueError when there are references
+    and responses_file is missing or does not hold them.
+    """
+    wanted = {record.get('row'): i for i, record in enumerate(skipped) if is_skipped_ref(record)}
+    resolved = list(skipped)
+    if not wanted:
+        return resolved
+    if not responses_file:
+        raise ValueError("the skipped file holds references; pass the response file they point into")
+    for row, response in enumerate(iter_records(responses_file)):
+        i = wanted.pop(row, None)
+        if i is None:
+            continue
+        if str(response.get('question_id')) != str(skipped[i].get('question_id')):
+            raise ValueError(f"row {row} of {responses_file} answers question {response.get('question_id')}, "
+                             f"not {skipped[i].get('question_id')}; is it the response file of the extraction?")
+        resolved[i] = response
+    if wanted:
+        raise ValueError(f"{len(wanted)} references point past the responses in {responses_file}")
+    return resolved
+
+
+def sampling_variants(temperatures=None, top_p=None):
+    """Return the sampling parameter sets to try, [{}] when none are given."""
+    variants = [{'temperature': t} for t in temperatures] if temperatures else [{}]
+    if top_p is not None:
+        variants = [dict(v, top_p=top_p) for v in variants]
+    return variants
+
+
+def select_prompts(skipped, prompts):
+    """
+    Return the prompt records the skipped responses were generated from, in
+    skipped order, and the number of skipped responses without one. A
+    response is matched by question id and prompt text, or by question id
+    and the question part of the prompt (see extraction.match_key).
+    """
+    keys = list(dict.fromkeys(response_key(record) for record in skipped))
+    wanted_ids = {key[0] for key in keys}
+    records = {}
+    for record in prompts:
+        key = response_key(record)
+        if key[0] in wanted_ids:
+            records.setdefault(key, record)
+    candidates = group_by_question(records)
+
+    selected, missing = [], 0
+    for key in keys:
+        match = match_key(key, candidates)
+        if match is None:
+            missing += 1
+        else:
+            selected.append(records[match])
+    return selected, missing
+
+
+def iter_retry_prompts(selected, variants):
+    """
+    Yield the selected prompt records once per sampling variant. Variants
+    are the outer loop so records with the same parameters stay together
+    and batch well.
+    """
+    for variant in variants:
+        for record in selected:
+            yield dict(record, sampling=variant) if variant else record
+
+
+def write_retry_prompts(skipped_file, prompts_file, output_file, temperatures=None, top_p=None, responses_file=None):
+    """Write the retry prompt JSONL and return (prompts written, skipped responses without a prompt)."""
+    skipped = resolve_skipped(list(iter_records(skipped_file)), responses_file)
+    selected, missing = select_prompts(skipped, iter_records(prompts_file))
+    total = write_records(output_file, iter_retry_prompts(selected, sampling_variants(temperatures, top_p)))
+    return total, missing
+
+
+def _tmp_path(path):
+    # Keep the extensions so the temporary file has the same record layout and compression
+    return with_suffix(path, '.tmp')
+
+
+def merge_retries(responses, extracted_file, skipped_file, extract_fn, stats=None, responses_file=None):
+    """
+    Parse retry responses and append the first usable extraction per
+    skipped prompt to extracted_file; rewrite skipped_file with the prompts
+    that are still unusable. responses_file resolves skipped references.
+    Returns (recovered, still skipped).
+    """
+    skipped = list(iter_records(skipped_file))
+    keys = [response_key(record) for record in resolve_skipped(skipped, responses_file)]
+    pending = group_by_question(keys)
+    existing = {extraction_key(record) for record in iter_records(extracted_file)}
+
+    recovered = {}
+    for response in responses:
+        key = match_key(response_key(response), pending)
+        if key is None or key in recovered:
+            continue
+        for kind, record, reason in extract_fn([response]):
+            if kind == 'extracted':
+                if extraction_key(record) not in existing:
+                    recovered[key] = record
+            elif stats is not None:
+                stats[reason] += 1
+
+    # Rewrite both files through temporary paths so an interrupted merge leaves them intact
+    tmp = _tmp_path(extracted_file)
+    with RecordWriter(tmp, indent=2, ensure_ascii=False) as out:
+        for record in iter_records(extracted_file):
+            out.write(record)
+        for record in recovered.values():
+            out.write(record)
+    os.replace(tmp, extracted_file)
+
+    still_skipped = [record for record, key in zip(skipped, keys) if key not in recovered]
+    tmp = _tmp_path(skipped_file)
+    write_records(tmp, still_skipped, indent=2, ensure_ascii=False)
+    os.replace(tmp, skipped_file)
+
+    # The incremental checkpoint describes the file before the merge
+    checkpoint = extracted_file + '.ckpt'
+    if recovered and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return len(recovered), len(still_skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-infer only the responses the extraction stages skipped.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    prompts_parser = sub.add_parser('prompts', help='Build a prompt file from skipped responses')
+    prompts_parser.add_argument('--skipped_file', '-s', required=True, help='Skipped responses of an extraction stage')
+    prompts_parser.add_argument('--prompts_file', '-p', required=True,
+                                help='Prompt file the responses were generated from')
+    prompts_parser.add_argument('--output_file', '-o', required=True, help='Output retry prompt JSONL file')
+    prompts_parser.add_argument('--responses_file', '-r', default=None,
+                                help='Response file the skipped references point into')
+    prompts_parser.add_argument('--temperatures', type=float, nargs='+', default=None,
+                                help='One retry prompt per skipped response and temperature')
+    prompts_parser.add_argument('--top_p', type=float, default=None, help='top_p for every retry prompt')
+
+    merge_parser = sub.add_parser('merge', help='Merge retried responses back into the extracted file')
+    merge_parser.add_argument('--kind', choices=sorted(EXTRACTORS), required=True,
+                              help='pos (extraction.py) or neg (extraction_neg.py) responses')
+    merge_parser.add_argument('--input_file', '-i', required=True, help='Responses to the retry prompts')
+    merge_parser.add_argument('--extracted_file', '-e', required=True, help='Extracted file to append to')
+    merge_parser.add_argument('--skipped_file', '-s', required=True,
+                              help='Skipped file to rewrite with the prompts that still failed')
+    merge_parser.add_argument('--responses_file', '-r', default=None,
+                              help='Response file the skipped references point into')
+    add_metrics_args(merge_parser)
+    args = parser.parse_args()
+
+    command_parser = prompts_parser if args.command == 'prompts' else merge_parser
+    if not args.responses_file and has_references(args.skipped_file):
+        command_parser.error(f"{args.skipped_file} holds {{question_id, reason, row}} references; "
+                             f"--responses_file must name the response file the extraction read")
+
+    if args.command == 'prompts':
+        try:
+            total, missing = write_retry_prompts(args.skipped_file, args.prompts_file, args.output_file,
+                                                 args.temperatures, args.top_p, args.responses_file)
+        except ValueError as e:
+            command_parser.error(str(e))
+        print(f"Wrote {total} retry prompts to {args.output_file}")
+        if missing:
+            print(f"Warning: {missing} skipped responses have no prompt in {args.prompts_file}")
+        return
+
+    try:
+        with StageMetrics.from_args(f'retry_{args.kind}', args, input_file=args.input_file) as metrics:
+            recovered, still_skipped = merge_retries(iter_records(args.input_file), args.extracted_file,
+                                                     args.skipped_file, EXTRACTORS[args.kind], metrics.skipped,
+                                                     args.responses_file)
+            metrics.records_in = recovered + still_skipped
+            metrics.records_out = recovered
+    except ValueError as e:
+        command_parser.error(str(e))
+    print(f"Recovered {recovered} responses into {args.extracted_file}; {still_skipped} still skipped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-domain scheduler for the STL loop.
+
+Builds the dag.py graph of every domain and runs the nodes by resource
+tag: 'gpu' nodes (model_vqa.py, training, LoRA merging) go through a single
+GPU queue fed from all domains, while 'cpu' nodes (prompt generation,
+extraction, sample building, merging, evaluation) run in a worker pool at
+the same time. While one domain is training, the CPU stages of the others
+run, and the GPU picks up whichever domain is ready next, shallowest node
+first, so no domain falls far behind.
+
+Nodes are brought up to date with dag.execute_node, so the content-addressed
+cache applies and an interrupted run resumes where it stopped. A failed node
+only stops its own descendants. The output of each node goes to
+.stl_cache/logs/<domain>_<node>.log.
+
+With --stub_gpu, GPU nodes do not launch anything: they sleep for
+--stub_seconds and then write model_vqa.py style answers from the
+inference.py fake backend (or a placeholder model directory), so the scheduling can be exercised on a CPU-only box.
+
+Usage:
+  python stl/scheduler.py --max_iter 5
+  python stl/scheduler.py --domains commonsense science_natural --max_iter 2 --stub_gpu --root /tmp/stl
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dag import CACHE_DIR, ArtifactCache, dependencies, execute_node, run_commands, stl_loop_graph
+from inference import FakeBackend, InferenceClient
+
+DOMAINS = ('commonsense', 'science_natural', 'science_social', 'science_language')
+
+
+def node_depths(nodes, deps):
+    """Longest dependency chain leading to each node."""
+    by_name = {node.name: node for node in nodes}
+    depths = {}
+
+    def depth(name):
+        if name not in depths:
+            depths[name] = 1 + max((depth(dep) for dep in deps[name]), default=-1)
+        return depths[name]
+
+    for name in by_name:
+        depth(name)
+    return depths
+
+
+def stub_gpu_run(seconds):
+    """Return a run function that stands in for GPU nodes on a CPU-only box."""
+    def run(node, root='.', stdout=None):
+        time.sleep(seconds)
+        if node.kind == 'model_vqa':
+            model_path, question_file = node.inputs
+            model_id = os.path.basename(model_path)
+            InferenceClient(FakeBackend(model_id), batch_size=32).run(question_file, node.outputs[0])
+        elif node.kind == 'sequential_eval':
+            cmd = list(node.cmds[0])
+            cmd[cmd.index('--backend') + 1] = 'fake'
+            subprocess.run(cmd, cwd=root, check=True, stdout=stdout, stderr=subprocess.STDOUT if stdout else None)
+        else:
+            for path in node.outputs:
+                os.makedirs(path, exist_ok=True)
+                with open(os.path.join(path, 'stub.txt'), 'w', encoding='utf-8') as f:
+                    f.write(f"{node.name}\n")
+    return run
+
+
+class Scheduler:
+    """Run a graph with a bounded number of concurrent nodes per resource tag."""
+
+    def __init__(self, nodes, cache, root='.', cpu_workers=2, gpu_slots=1, runners=None):
+        self.nodes = {node.name: node for node in nodes}
+        self.cache = cache
+        self.root = root
+        self.limits = {'cpu': cpu_workers, 'gpu': gpu_slots}
+        # resource tag -> run function, dag.run_commands by default
+        self.runners = runners or {}
+        self.deps = dependencies(nodes)
+        self.depths = node_depths(nodes, self.deps)
+        self.order = {node.name: i for i, node in enumerate(nodes)}
+        self.log_dir = os.path.join(root, CACHE_DIR, 'logs')
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.busy = {tag: 0.0 for tag in self.limits}
+
+    def _run_node(self, node):
+        run = self.runners.get(node.resource, run_commands)
+        log_file = os.path.join(self.log_dir, node.name.replace('/', '_') + '.log')
+        start = time.time()
+        with open(log_file, 'w', encoding='utf-8') as log:
+            result = execute_node(node, self.cache, self.root,
+                                  run=lambda n, root: run(n, root, stdout=log))
+        return result, time.time() - start
+
+    def run(self):
+        """Run every node; return the names of failed nodes and of those skipped because of them."""
+        done, failed = set(), []
+        pending = set(self.nodes)
+        running = {}
+        in_use = {tag: 0 for tag in self.limits}
+        t0 = time.time()
+
+        with ThreadPoolExecutor(max_workers=sum(self.limits.values())) as pool:
+            while pending or running:
+                ready = sorted((name for name in pending if self.deps[name] <= done),
+                               key=lambda name: (self.depths[name], self.order[name]))
+                for name in ready:
+                    node = self.nodes[name]
+                    if in_use[node.resource] < self.limits[node.resource]:
+                        in_use[node.resource] += 1
+                        pending.discard(name)
+                        running[pool.submit(self._run_node, node)] = node
+                        print(f"{time.time() - t0:8.1f}s  start  [{node.resource}] {name}", flush=True)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    in_use[node.resource] -= 1
+                    try:
+                        result, seconds = future.result()
+                    except Exception as e:
+                        failed.append(node.name)
+                        print(f"{time.time() - t0:8.1f}s  FAILED [{node.resource}] {node.name}: {e}", flush=True)
+                        continue
+                    self.busy[node.resource] += seconds
+                    done.add(node.name)
+                    print(f"{time.time() - t0:8.1f}s  {result:<6} [{node.resource}] {node.name} "
+                          f"({seconds:.1f}s)", flush=True)
+                # Descendants of failed nodes can never become ready
+                while True:
+                    alive = done | pending | {n.name for n in running.values()}
+                    blocked = {name for name in pending if not self.deps[name] <= alive}
+                    if not blocked:
+                        break
+                    pending -= blocked
+
+        self.cache.save()
+        wall = time.time() - t0
+        skipped = sorted(set(self.nodes) - done - set(failed))
+        print(f"Finished {len(done)}/{len(self.nodes)} nodes in {wall:.1f}s; "
+              + ', '.join(f"{tag} busy {self.busy[tag]:.1f}s" for tag in self.limits))
+        return failed, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the STL loop of several domains with a shared GPU queue.")
+    parser.add_argument('--domains', nargs='+', default=list(DOMAINS), help='Domains to run')
+    parser.add_argument('--max_iter', type=int, required=True, help='Number of STL iterations')
+    parser.add_argument('--root', default='.', help='Repository root holding models/, llava/ and <domain>/ours/')
+    parser.add_argument('--data_dir', default='playground/data/folder', help='Directory with the question and answer files')
+    parser.add_argument('--cpu_workers', type=int, default=2, help='CPU nodes run at the same time')
+    parser.add_argument('--gpu_slots', type=int, default=1, help='GPU nodes run at the same time')
+    parser.add_argument('--stub_gpu', action='store_true', help='Replace GPU nodes with a sleep and fake outputs')
+    parser.add_argument('--stub_seconds', type=float, default=1.0, help='Duration of a stub GPU node')
+    parser.add_argument('--sequential_eval', action='store_true',
+                        help='Evaluate iterations before the last with early-stopping sequential_eval.py')
+    args = parser.parse_args()
+
+    nodes = []
+    for domain in args.domains:
+        nodes += stl_loop_graph(domain, args.max_iter, args.root, args.data_dir,
+                                sequential_eval=args.sequential_eval)
+    runners = {}
+    if args.stub_gpu:
+        runners['gpu'] = stub_gpu_run(args.stub_seconds)
+        for node in nodes:
+            if node.resource == 'gpu':
+                # Keep stub outputs apart from real ones in the cache
+                node.params = dict(node.params, stub=True)
+
+    scheduler = Scheduler(nodes, ArtifactCache(args.root), args.root, args.cpu_workers, args.gpu_slots, runners)
+    failed, skipped = scheduler.run()
+    if failed:
+        sys.exit(f"Failed: {', '.join(failed)}; not run: {len(skipped)} nodes")
+
+
+if __name__ == '__main__':
+    main()
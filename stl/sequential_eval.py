@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Sequential test evaluation with early stopping.
+
+Instead of answering the whole formatted_questions_test_<domain>.jsonl after
+every iteration, questions are answered in batches drawn in a stratified
+order: each category is shuffled with --seed and the categories are
+interleaved in proportion to their size, so every prefix of the order is a
+near-proportional sample. After each batch the responses go through the
+extraction.py parser and the running accuracy (correct / extracted answers,
+as accuracy.py computes it) gets a Wilson confidence interval with a
+finite-population correction. Evaluation stops once
+
+  precise   the interval half-width is at most --half_width, or
+  worse     the upper bound is below the --baseline accuracy (the summary
+            file of the previous iteration, or a percentage),
+
+after at least --min_samples answers, and otherwise runs to the end of the
+test set (complete). --full always answers every question, for the final
+checkpoint.
+
+Batches go to an inference.py backend that keeps the model loaded
+(llava:<model_path>, or an HTTP server started with inference.py serve);
+a cmd: backend would reload the model for every batch.
+
+The answers, extracted and skipped responses are written as the full
+evaluation writes them, and --summary_file records the estimate:
+
+  {"accuracy", "lower", "upper" (percent), "answered", "extracted",
+   "correct", "population", "stop_reason", "categories": {category: [correct, extracted]}}
+
+Usage:
+  python stl/sequential_eval.py -q playground/data/folder/formatted_questions_test_science_natural.jsonl \\
+      -a playground/data/folder/correct_answers_test.json \\
+      --backend llava:models/science_natural/ours/llava-v1.5-7b-lora-oursit2 \\
+      --answers_file science_natural/ours/response_test_it2.jsonl --extracted_file science_natural/ours/extracted_test_it2.json \\
+      --summary_file science_natural/ours/eval_it2.json --baseline science_natural/ours/eval_it1.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+
+from extraction import extract_responses
+from final_training_set import interleave
+from gold_answers import load_gold_answers
+from inference import InferenceClient, load_backend
+from instrument import StageMetrics, add_metrics_args
+from record_io import RecordWriter, iter_records
+from records import Question, skipped_entry
+
+
+def stratified_order(questions, seed=0, key='category'):
+    """Shuffle each category and interleave them proportionally."""
+    rng = random.Random(seed)
+    strata = {}
+    for record in questions:
+        strata.setdefault(record.get(key), []).append(record)
+    streams = []
+    for name in sorted(strata, key=str):
+        records = strata[name]
+        rng.shuffle(records)
+        streams.append((len(records), records))
+    return list(interleave(streams))
+
+
+def wilson_interval(successes, n, z, population=None, sampled=None):
+    """
+    Wilson score interval for successes / n. With a finite population of
+    which sampled items have been drawn, the variance is scaled by the
+    finite-population correction, so the interval closes once all are drawn.
+    """
+    if n == 0:
+        return 0.0, 0.0, 1.0
+    p = successes / n
+    fpc = 1.0
+    if population and sampled is not None and population > 1:
+        fpc = max(0.0, (population - sampled) / (population - 1))
+    z2 = z * z * fpc
+    denom = 1 + z2 / n
+    center = (p + z2 / (2 * n)) / denom
+    half = math.sqrt(z2 * p * (1 - p) / n + z2 * z2 / (4 * n * n)) / denom
+    return p, max(0.0, center - half), min(1.0, center + half)
+
+
+def load_baseline(baseline):
+    """Baseline accuracy in percent from a summary file or a number, or None."""
+    if baseline is None:
+        return None
+    if os.path.exists(baseline):
+        with open(baseline, 'r', encoding='utf-8') as f:
+            return json.load(f)['accuracy']
+    return float(baseline)
+
+
+class SequentialEvaluator:
+    """Answer stratified batches through an InferenceClient until the accuracy estimate settles."""
+
+    def __init__(self, client, questions, gold, batch_size=64, min_samples=128, half_width=0.03,
+                 confidence=0.95, baseline=None, full=False, seed=0):
+        self.client = client
+        self.order = stratified_order(questions, seed)
+        self.gold = gold
+        self.batch_size = batch_size
+        self.min_samples = min_samples
+        self.half_width = half_width
+        self.z = statistics.NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+        # Accuracy to beat, as a fraction
+        self.baseline = None if baseline is None else baseline / 100
+        self.full = full
+        self.categories = {record['question_id']: record.get('category') for record in self.order}
+        self.answered = self.extracted = self.correct = 0
+        self.per_category = {}
+        self.stop_reason = None
+
+    def estimate(self):
+        return wilson_interval(self.correct, self.extracted, self.z, len(self.order), self.answered)
+
+    def _record(self, kind, record):
+        self.answered += 1
+        if kind != 'extracted' or record['question_id'] not in self.gold:
+            return
+        is_correct = record['generated_choice'].strip() == self.gold[record['question_id']].strip()
+        self.extracted += 1
+        self.correct += is_correct
+        counts = self.per_category.setdefault(self.categories.get(record['question_id']), [0, 0])
+        counts[0] += is_correct
+        counts[1] += 1
+
+    def _should_stop(self):
+        if self.full or self.answered < self.min_samples:
+            return None
+        _, lower, upper = self.estimate()
+        if (upper - lower) / 2 <= self.half_width:
+            return 'precise'
+        if self.baseline is not None and upper < self.baseline:
+            return 'worse'
+        return None
+
+    def run(self, answers_out, extracted_out, skipped_out=None, stats=None):
+        for start in range(0, len(self.order), self.batch_size):
+            batch = self.order[start:start + self.batch_size]
+            answers = list(self.client.iter_answers(batch))
+            for answer in answers:
+                answers_out.write(answer)
+            for row, (kind, record, reason) in enumerate(extract_responses(answers), self.answered):
+                self._record(kind, record)
+                if kind == 'extracted':
+                    extracted_out.write(record)
+                else:
+                    if stats is not None:
+                        stats[reason] += 1
+                    if skipped_out is not None:
+                        skipped_out.write(skipped_entry(record, reason, row))
+            p, lower, upper = self.estimate()
+            print(f"{self.answered:5d}/{len(self.order)}  accuracy {p * 100:6.2f}% "
+                  f"[{lower * 100:6.2f}, {upper * 100:6.2f}]", flush=True)
+            self.stop_reason = self._should_stop()
+            if self.stop_reason:
+                break
+        else:
+            self.stop_reason = 'complete'
+        return self.summary()
+
+    def summary(self):
+        p, lower, upper = self.estimate()
+        return {
+            "accuracy": round(p * 100, 2),
+            "lower": round(lower * 100, 2),
+            "upper": round(upper * 100, 2),
+            "answered": self.answered,
+            "extracted": self.extracted,
+            "correct": self.correct,
+            "population": len(self.order),
+            "stop_reason": self.stop_reason,
+            "categories": self.per_category,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate test accuracy from stratified batches, stopping early.")
+    parser.add_argument('--questions_file', '-q', required=True, help='Formatted test questions JSONL file')
+    parser.add_argument('--correct_answers_file', '-a', required=True, help='Correct answers JSON file')
+    parser.add_argument('--backend', default='fake', help='Inference backend (see inference.py)')
+    parser.add_argument('--model_id', default=None,
+                        help="model_id written to the answers (default: the backend's, e.g. the llava: checkpoint name)")
+    parser.add_argument('--early_stop', action='store_true',
+                        help='llava: backend only: stop generating once the CONCLUSION letter is out '
+                             'or the response has degenerated')
+    parser.add_argument('--answers_file', required=True, help='Output answers JSONL file')
+    parser.add_argument('--extracted_file', required=True, help='Output extracted responses (JSON or JSONL)')
+    parser.add_argument('--skipped_file', default=None, help='Output references to the skipped answers (JSON or JSONL)')
+    parser.add_argument('--summary_file', default=None, help='Output JSON summary of the estimate')
+    parser.add_argument('--batch_size', type=int, default=64, help='Questions answered between two checks')
+    parser.add_argument('--min_samples', type=int, default=128, help='Answers required before stopping early')
+    parser.add_argument('--half_width', type=float, default=3.0,
+                        help='Stop once the confidence interval half-width is at most this many points')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the interval')
+    parser.add_argument('--baseline', default=None,
+                        help="Previous iteration's summary file or accuracy in percent; stop once clearly below it")
+    parser.add_argument('--full', action='store_true', help='Answer every question (final checkpoint)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the stratified order')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+
+    questions = list(iter_records(args.questions_file, Question))
+    gold = load_gold_answers(args.correct_answers_file)
+    client = InferenceClient(load_backend(args.backend, args.model_id, early_stop=args.early_stop), batch_size=args.batch_size,
+                             model_id=args.model_id)
+    evaluator = SequentialEvaluator(client, questions, gold, args.batch_size, args.min_samples,
+                                    args.half_width / 100, args.confidence, load_baseline(args.baseline),
+                                    args.full, args.seed)
+
+    with StageMetrics.from_args('sequential_eval', args, input_file=args.questions_file) as metrics, \
+         RecordWriter(args.answers_file) as answers_out, \
+         RecordWriter(args.extracted_file, indent=2, ensure_ascii=False) as extracted_out:
+        skipped_out = RecordWriter(args.skipped_file, indent=2, ensure_ascii=False) if args.skipped_file else None
+        try:
+            summary = evaluator.run(answers_out, extracted_out, skipped_out, metrics.skipped)
+        finally:
+            if skipped_out:
+                skipped_out.close()
+        metrics.records_in = summary['answered']
+        metrics.records_out = summary['extracted']
+        metrics.info.update(accuracy=summary['accuracy'], stop_reason=summary['stop_reason'])
+
+    if args.summary_file:
+        with open(args.summary_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    print(f"Accuracy: {summary['accuracy']:.2f}% [{summary['lower']:.2f}, {summary['upper']:.2f}] "
+          f"({summary['correct']}/{summary['extracted']}, {summary['answered']} of {summary['population']} "
+          f"answered, {summary['stop_reason']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Byte-offset sharding of JSONL inputs over a process pool.
+
+The input is split into line-aligned byte ranges, each range is parsed by
+a worker process, and the per-shard results are yielded back in input
+order, so the merged output is identical to a single-process run.
+Compressed (.gz/.zst) inputs cannot be split by offset and are parsed in a
+single process.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from record_io import is_compressed, is_jsonl, iter_records
+from records import loads
+
+# Shards per worker: more, smaller shards keep workers busy
+SHARDS_PER_WORKER = 4
+# Shards submitted but not yet yielded, per worker; this bounds the number of
+# shard results held in memory at once
+PENDING_PER_WORKER = 2
+
+
+def shard_ranges(path, num_shards, start=0, end=None):
+    """Split path[start:end] into at most num_shards line-aligned (start, end) byte ranges."""
+    size = os.path.getsize(path) if end is None else end
+    bounds = [start]
+    with open(path, 'rb') as f:
+        for i in range(1, num_shards):
+            target = start + (size - start) * i // num_shards
+            if target <= bounds[-1]:
+                continue
+            # Move to the beginning of the first line starting at or after target
+            f.seek(target - 1)
+            f.readline()
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def iter_jsonl_range(path, start, end):
+    """Yield the records of the JSONL lines in path[start:end]."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            line = line.strip()
+            if line:
+                yield loads(line)
+
+
+def _process_range(fn, path, byte_range):
+    return list(fn(iter_jsonl_range(path, *byte_range)))
+
+
+def iter_sharded(path, fn, workers=1, start=0, end=None):
+    """
+    Apply fn (records -> results) to the records of path[start:end] and yield
+    the results in input order, using a pool of worker processes when
+    workers > 1. fn must be a module-level function (or a partial of one) so
+    it can be sent to the workers.
+    """
+    if start or end is not None:
+        end = os.path.getsize(path) if end is None else end
+        if workers <= 1:
+            yield from fn(iter_jsonl_range(path, start, end))
+            return
+    elif workers <= 1 or not is_jsonl(path) or is_compressed(path):
+        yield from fn(iter_records(path))
+        return
+
+    ranges = shard_ranges(path, workers * SHARDS_PER_WORKER, start, end)
+    process = partial(_process_range, fn, path)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for byte_range in ranges:
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                yield from pending.popleft().result()
+            pending.append(pool.submit(process, byte_range))
+        while pending:
+            yield from pending.popleft().result()
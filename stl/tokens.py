@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Pluggable token counting for length budgets.
+
+  approx       word/punctuation split with long words counted as several
+               sub-word pieces, a close stand-in for the LLaMA tokenizer
+  whitespace   one token per whitespace separated word
+  hf:<path>    a Hugging Face tokenizer (requires transformers)
+
+Training samples are measured as LLaVA v1 lays them out (system prompt,
+role-prefixed turns, IMAGE_TOKENS for the image), and LengthFilter writes
+the lengths to a sidecar next to the samples file,
+<name>.lengths.jsonl, with one {"id", "type", "length", "bucket", "tokenizer"}
+entry per sample in file order. "tokenizer" is the spec the length was
+measured with, so a sidecar is only reused for the same tokenizer.
+"""
+import re
+
+from record_io import RecordWriter, iter_records, with_suffix
+
+# Image tokens LLaVA-1.5 inserts for one CLIP ViT-L/14 336px image (24 x 24 patches)
+IMAGE_TOKENS = 576
+
+# System prompt and roles of the LLaVA v1 conversation template used for training
+SYSTEM_PROMPT = ("A chat between a curious human and an artificial intelligence assistant. "
+                 "The assistant gives helpful, detailed, and polite answers to the human's questions.")
+ROLES = {'human': 'USER', 'gpt': 'ASSISTANT'}
+
+# Width of the length buckets recorded in the sidecar, in tokens
+BUCKET_SIZE = 128
+
+word_pattern = re.compile(r"\w+|[^\w\s]")
+
+
+def approx_token_count(text):
+    """Approximate a byte-pair tokenizer: one token per ~4 characters of each word or symbol."""
+    return sum((len(m) + 3) // 4 for m in word_pattern.findall(text))
+
+
+def whitespace_token_count(text):
+    return len(text.split())
+
+
+def load_token_counter(spec='approx'):
+    """Return a text -> token count function for a tokenizer spec."""
+    if spec == 'approx':
+        return approx_token_count
+    if spec == 'whitespace':
+        return whitespace_token_count
+    if spec.startswith('hf:'):
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(spec[3:], use_fast=True)
+        return lambda text: len(tokenizer(text, add_special_tokens=False).input_ids)
+    raise ValueError(f"Unknown tokenizer spec '{spec}' (expected approx, whitespace or hf:<path>)")
+
+
+def sample_length(record, count_tokens):
+    """Tokens of a training record in the LLaVA v1 layout, counting IMAGE_TOKENS for its image."""
+    length = count_tokens(SYSTEM_PROMPT)
+    for turn in record.get('conversations', []):
+        role = ROLES.get(turn.get('from'), turn.get('from'))
+        # One more token for the separator closing each turn
+        length += count_tokens(f"{role}: {turn.get('value', '').replace('<image>', '')}") + 1
+    if record.get('image'):
+        length += IMAGE_TOKENS
+    return length
+
+
+def lengths_path(path):
+    """Path of the token-length sidecar of a samples or training set file."""
+    return with_suffix(path, '.lengths', '.jsonl')
+
+
+def length_entry(record, length, bucket_size=BUCKET_SIZE, tokenizer='approx'):
+    return {"id": record.get('id'), "type": record.get('type'), "length": length, "bucket": length // bucket_size,
+            "tokenizer": tokenizer}
+
+
+def sidecar_tokenizer(lengths_file):
+    """Tokenizer spec of a sidecar's first entry, or None (empty, or written before specs were recorded)."""
+    entry = next(iter_records(lengths_file), None)
+    return entry.get('tokenizer') if entry is not None else None
+
+
+def iter_with_lengths(records, lengths_file, tokenizer=None):
+    """
+    Yield (record, sidecar entry) pairs, checking that the sidecar matches the
+    records and, when tokenizer is given, that it was measured with it.
+    """
+    entries = iter_records(lengths_file)
+    for record in records:
+        entry = next(entries, None)
+        if entry is None or entry['id'] != record.get('id'):
+            raise ValueError(f"{lengths_file} does not match its samples file; rebuild it")
+        if tokenizer is not None and entry.get('tokenizer') != tokenizer:
+            raise ValueError(f"{lengths_file} mixes lengths of tokenizers {entry.get('tokenizer')} and {tokenizer}; "
+                             f"rebuild it")
+        yield record, entry
+    if next(entries, None) is not None:
+        raise ValueError(f"{lengths_file} has more entries than its samples file; rebuild it")
+
+
+def add_length_args(parser):
+    """Add the token-length options of the sample builders to an argument parser."""
+    parser.add_argument('--lengths', action='store_true',
+                        help='Write the token length of every sample to <output>.lengths.jsonl')
+    parser.add_argument('--max_length', type=int, default=None,
+                        help='Token budget of a sample (the --model_max_length of training); longer samples are reported')
+    parser.add_argument('--drop_over_length', action='store_true', help='Drop samples over --max_length')
+    parser.add_argument('--tokenizer', default='approx', help='approx, whitespace or hf:<tokenizer path>')
+    parser.add_argument('--bucket_size', type=int, default=BUCKET_SIZE, help='Width of the sidecar length buckets')
+
+
+class LengthFilter:
+    """
+    Measure samples as they stream through. With max_length, samples over
+    the budget are dropped (drop=True, counted as 'over_length' in stats)
+    or only counted. With lengths_file, the sidecar entry of every kept
+    sample is written there.
+    """
+
+    def __init__(self, count_tokens, max_length=None, drop=False, bucket_size=BUCKET_SIZE, lengths_file=None,
+                 tokenizer='approx'):
+        self.count_tokens = count_tokens
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.drop = drop
+        self.bucket_size = bucket_size
+        self.lengths_file = lengths_file
+        self.over = 0
+        self.longest = 0
+
+    @classmethod
+    def from_args(cls, args, output_file):
+        """Build a filter from add_length_args options, or return None when none of them is used."""
+        if not args.lengths and not args.max_length:
+            return None
+        return cls(load_token_counter(args.tokenizer), args.max_length, args.drop_over_length, args.bucket_size,
+                   lengths_path(output_file) if args.lengths else None, args.tokenizer)
+
+    def __call__(self, samples, stats=None):
+        writer = RecordWriter(self.lengths_file) if self.lengths_file else None
+        try:
+            for sample in samples:
+                length = sample_length(sample, self.count_tokens)
+                self.longest = max(self.longest, length)
+                if self.max_length and length > self.max_length:
+                    self.over += 1
+                    if self.drop:
+                        if stats is not None:
+                            stats['over_length'] += 1
+                        continue
+                if writer is not None:
+                    writer.write(length_entry(sample, length, self.bucket_size, self.tokenizer))
+                yield sample
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def report(self):
+        text = f"Longest sample: {self.longest} tokens"
+        if self.max_length:
+            action = 'dropped' if self.drop else 'kept, training will truncate them'
+            text += f"; {self.over} over {self.max_length} tokens ({action})"
+        if self.lengths_file:
+            text += f"; lengths -> {self.lengths_file}"
+        return text
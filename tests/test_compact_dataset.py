@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of compact_dataset: records written in the compact format read back
+exactly as the LLaVA JSON layout they came from.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+import neg_samples  # noqa: E402
+import pos_samples  # noqa: E402
+from compact_dataset import (CompactDataset, Template, is_compact, iter_training_records,  # noqa: E402
+                             write_compact)
+from record_io import write_records  # noqa: E402
+from records import ConversationSample  # noqa: E402
+
+QUESTION = "Which organelle makes ATP?\n(a) Nucleus\n(b) Mitochondrion"
+
+
+def pos_record(qid, rationale):
+    return {
+        'id': qid,
+        'image': f'images/{qid}.png',
+        'conversations': [
+            {'from': 'human', 'value': "<image>\n" + pos_samples.prompt_template.format(question_and_choices=QUESTION)},
+            {'from': 'gpt', 'value': pos_samples.response_template.format(
+                caption="A cell {with} braces", rationale=rationale, generated_choice='(b)')},
+        ],
+        'type': '1',
+    }
+
+
+def neg_record(qid, incorrect_choice):
+    return {
+        'id': qid,
+        'image': f'images/{qid}.png',
+        'conversations': [
+            {'from': 'human', 'value': neg_samples.prompt_template.format(
+                question_text=QUESTION, incorrect_choice=incorrect_choice)},
+            {'from': 'gpt', 'value': neg_samples.response_template.format(
+                caption="A cell", explanation="The nucleus stores DNA; it does not make ATP.\n\nÜnicode ✓")},
+        ],
+        'type': '2',
+    }
+
+
+RECORDS = [
+    pos_record('biology-1', "Mitochondria are the powerhouse of the cell."),
+    neg_record('biology-1', '(a)'),
+    pos_record('biology-2', ""),
+    # A turn that fits no template is kept verbatim
+    {'id': 7, 'image': None, 'conversations': [{'from': 'human', 'value': 'free text'},
+                                               {'from': 'gpt', 'value': 'CAPTION: only'}], 'type': '1'},
+    # Records outside the layout are stored as raw JSON
+    {'id': 'extra', 'image': 'x.png', 'conversations': [], 'type': '1', 'weight': 0.5},
+    {'id': 'odd', 'conversations': [{'from': 'human', 'value': ['not', 'a', 'string']}]},
+]
+
+
+@pytest.fixture
+def compact_file(tmp_path):
+    path = str(tmp_path / 'train.stld')
+    assert write_compact(path, RECORDS) == len(RECORDS)
+    return path
+
+
+def test_round_trip(compact_file):
+    dataset = CompactDataset(compact_file)
+    assert len(dataset) == len(RECORDS)
+    assert list(dataset) == RECORDS
+    assert dataset[-1] == RECORDS[-1]
+    assert dataset[1:3] == RECORDS[1:3]
+    with pytest.raises(IndexError):
+        dataset[len(RECORDS)]
+    dataset.close()
+
+
+def test_typed_records_round_trip(tmp_path):
+    path = str(tmp_path / 'typed.stld')
+    record = ConversationSample(**RECORDS[0])
+    write_compact(path, [record])
+    assert list(iter_training_records(path)) == [RECORDS[0]]
+
+
+def test_shared_strings_are_stored_once(tmp_path):
+    path = str(tmp_path / 'many.stld')
+    write_compact(path, [pos_record(f'q-{i}', "same rationale") for i in range(200)])
+    expanded = sum(len(str(pos_record(f'q-{i}', "same rationale"))) for i in range(200))
+    assert os.path.getsize(path) < expanded / 5
+    assert CompactDataset(path)[199] == pos_record('q-199', "same rationale")
+
+
+def test_iter_training_records_reads_every_format(tmp_path, compact_file):
+    json_file, jsonl_file = str(tmp_path / 'train.json'), str(tmp_path / 'train.jsonl')
+    write_records(json_file, RECORDS, indent=4)
+    write_records(jsonl_file, RECORDS)
+    assert is_compact(compact_file) and not is_compact(json_file) and not is_compact(str(tmp_path / 'missing'))
+    for path in (compact_file, json_file, jsonl_file):
+        assert list(iter_training_records(path)) == RECORDS
+
+
+def test_template_match_and_expand():
+    template = Template('t', "A: {a}\nB: {b}!")
+    assert template.match("A: x\nB: y!") == ('x', 'y')
+    assert template.match("A: x\nB: y") is None
+    assert template.expand(['1', '2']) == "A: 1\nB: 2!"
+
+
+def test_rejects_other_files(tmp_path):
+    path = str(tmp_path / 'not_compact.stld')
+    with open(path, 'wb') as f:
+        f.write(b'XXXX' + bytes(64))
+    with pytest.raises(ValueError):
+        CompactDataset(path)
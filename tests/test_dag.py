@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of dag: the model copy node can run again over an existing copy.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from dag import ArtifactCache, execute_node, stl_loop_graph  # noqa: E402
+
+
+def test_init_refreshes_an_existing_model_copy(tmp_path):
+    root = str(tmp_path)
+    base = tmp_path / 'models' / 'llava-v1.5-7b'
+    base.mkdir(parents=True)
+    (base / 'config.json').write_text('{"v": 1}')
+    init = stl_loop_graph('d', 1, root=root)[0]
+    target = tmp_path / 'models' / 'd' / 'ours' / 'llava-v1.5-7b-lora-oursit0'
+    cache = ArtifactCache(root)
+
+    assert execute_node(init, cache, root) == 'ran'
+    assert execute_node(init, cache, root) == 'fresh'
+    # A changed base model misses the cache and copies over the existing directory
+    (base / 'config.json').write_text('{"v": 2}')
+    assert execute_node(init, cache, root) == 'ran'
+
+    assert sorted(os.listdir(target)) == ['config.json']
+    assert (target / 'config.json').read_text() == '{"v": 2}'
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of dedup: near-duplicate rationales within an image, down-weighting
+in weight mode and across iterations, and the stage metrics.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+import dedup  # noqa: E402
+from dedup import Deduplicator, dedup_files  # noqa: E402
+from record_io import iter_records, write_records  # noqa: E402
+
+CAPTION = ("A diagram of the water cycle: a lake at the bottom, the sun on the left, grey clouds above the lake, "
+           "rain falling from the clouds and arrows labelled evaporation, condensation and precipitation.")
+REASONING = ("Water evaporates from the lake, condenses into clouds and falls back as rain, "
+             "so the arrow from the clouds to the lake shows precipitation.")
+
+
+def positive(sid, image, reasoning=REASONING):
+    return {'id': sid, 'image': image, 'type': '1', 'conversations': [
+        {'from': 'human', 'value': '<image>\nQuestion: Which process is shown?'},
+        {'from': 'gpt', 'value': f"CAPTION: {CAPTION}\nREASONING: {reasoning}\nCONCLUSION: (a)"}]}
+
+
+def negative(sid, image, explanation):
+    return {'id': sid, 'image': image, 'type': '2', 'conversations': [
+        {'from': 'human', 'value': '<image>\nExplain why this answer is wrong.'},
+        {'from': 'gpt', 'value': f"CAPTION: {CAPTION}\nEXPLANATION: {explanation}"}]}
+
+
+SAMPLES = [
+    positive('p1', 'a.png'),
+    positive('p2', 'a.png', REASONING.replace('falls back', 'falls')),
+    positive('p3', 'b.png'),
+    positive('p4', 'a.png', "The sun heats the lake and the vapour rises, which the upward arrow labels."),
+]
+
+
+def run(tmp_path, samples, deduplicator, mode):
+    input_file, output_file = str(tmp_path / 'in.json'), str(tmp_path / f'out_{mode}.json')
+    write_records(input_file, samples, indent=2)
+    stats = {'near_duplicate': 0, 'seen_before': 0}
+    totals = dedup_files([input_file], [output_file], deduplicator, mode, stats)
+    return list(iter_records(output_file)), totals, stats
+
+
+def test_drop_keeps_the_first_sample_per_image(tmp_path):
+    records, totals, stats = run(tmp_path, SAMPLES, Deduplicator(), 'drop')
+    # p2 repeats p1 for the same image; p3 is the same text for another image
+    assert [r['id'] for r in records] == ['p1', 'p3', 'p4'] and totals == [3]
+    assert stats == {'near_duplicate': 1, 'seen_before': 0}
+    assert all('weight' not in r for r in records)
+
+    records, _, _ = run(tmp_path, SAMPLES, Deduplicator(scope='global'), 'drop')
+    assert [r['id'] for r in records] == ['p1', 'p4']
+
+
+def test_distractors_sharing_a_caption_are_kept(tmp_path):
+    samples = [negative('n1', 'a.png', "Condensation forms clouds, it does not move water into the lake."),
+               negative('n2', 'a.png', "Evaporation lifts water up from the lake, so it cannot be the arrow down.")]
+    records, _, _ = run(tmp_path, samples, Deduplicator(), 'drop')
+    assert [r['id'] for r in records] == ['n1', 'n2']
+    # Comparing the whole turn, the shared caption makes them near-duplicates
+    records, _, _ = run(tmp_path, samples, Deduplicator(section='all', threshold=0.5), 'drop')
+    assert [r['id'] for r in records] == ['n1']
+
+
+def test_weight_mode_keeps_every_sample(tmp_path):
+    records, totals, stats = run(tmp_path, SAMPLES, Deduplicator(), 'weight')
+    assert [(r['id'], r.get('weight', 1.0)) for r in records] == \
+        [('p1', 0.5), ('p2', 0.5), ('p3', 1.0), ('p4', 1.0)]
+    assert totals == [4] and stats['near_duplicate'] == 1
+
+
+def test_prior_index_only_down_weights(tmp_path):
+    index_file = str(tmp_path / 'index_it1.npz')
+    first = Deduplicator()
+    run(tmp_path, SAMPLES[:1], first, 'drop')
+    first.save(index_file)
+
+    deduplicator = Deduplicator(prior_weight=0.25)
+    deduplicator.load_prior(index_file)
+    records, _, stats = run(tmp_path, SAMPLES, deduplicator, 'drop')
+    assert [(r['id'], r.get('weight', 1.0)) for r in records] == [('p1', 0.25), ('p3', 1.0), ('p4', 1.0)]
+    assert stats == {'near_duplicate': 1, 'seen_before': 1}
+
+    with pytest.raises(ValueError):
+        Deduplicator(section='all').load_prior(index_file)
+
+
+def test_reruns_are_identical(tmp_path):
+    first, _, _ = run(tmp_path, SAMPLES, Deduplicator(), 'weight')
+    second, _, _ = run(tmp_path, SAMPLES, Deduplicator(), 'weight')
+    assert first == second
+
+
+@pytest.mark.parametrize('mode, skipped, info', [('drop', {'near_duplicate': 1}, {}),
+                                                 ('weight', {}, {'down_weighted': 1})])
+def test_metrics_only_skip_dropped_samples(tmp_path, monkeypatch, mode, skipped, info):
+    input_file, metrics_file = str(tmp_path / 'in.json'), str(tmp_path / 'metrics.jsonl')
+    write_records(input_file, SAMPLES, indent=2)
+    monkeypatch.setattr(sys, 'argv', ['dedup.py', '-i', input_file, '-o', str(tmp_path / 'out.json'), '--mode', mode,
+                                      '--metrics_file', metrics_file])
+    dedup.main()
+    with open(metrics_file) as f:
+        metrics = json.loads(f.readline())
+    assert metrics['skipped'] == skipped
+    assert metrics['records_in'] == 4 and metrics['records_out'] == 4 - sum(skipped.values())
+    assert all(metrics[key] == value for key, value in info.items())
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of final_training_set: the seeded external shuffle, per-file and
+per-record weights, and stratified interleaving.
+"""
+import os
+import random
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from final_training_set import ExternalShuffle, interleave, merge_and_shuffle  # noqa: E402
+
+
+def samples(prefix, count, kind='1'):
+    return [{'id': f'{prefix}-{i}', 'conversations': [{'from': 'gpt', 'value': f'v{i}'}], 'type': kind}
+            for i in range(count)]
+
+
+POS = samples('pos', 300)
+NEG = samples('neg', 100, '2')
+
+
+def shuffled(tmp_path, sources, **options):
+    options.setdefault('tmp_dir', str(tmp_path))
+    return list(merge_and_shuffle([list(records) for records in sources], **options))
+
+
+def test_output_depends_only_on_inputs_and_seed(tmp_path):
+    in_memory = shuffled(tmp_path, [POS, NEG], seed=3)
+    assert sorted(r['id'] for r in in_memory) == sorted(r['id'] for r in POS + NEG)
+    assert in_memory != POS + NEG
+    for chunk_size in (1, 7, 64):
+        assert shuffled(tmp_path, [POS, NEG], seed=3, chunk_size=chunk_size) == in_memory
+    assert shuffled(tmp_path, [POS, NEG], seed=4) != in_memory
+    # Spilled runs are removed once merged
+    assert os.listdir(tmp_path) == []
+
+
+def test_external_shuffle_round_trips_records(tmp_path):
+    shuffle = ExternalShuffle(random.Random(0), chunk_size=10, tmp_dir=str(tmp_path))
+    records = [{'id': i, 'text': 'ünicode\t"quoted"\n'} for i in range(95)]
+    for record in records:
+        shuffle.add(record)
+    assert shuffle.count == 95
+    out = list(shuffle)
+    assert sorted(out, key=lambda r: r['id']) == records
+    assert len(os.listdir(tmp_path)) == 0
+
+
+def test_file_weights(tmp_path):
+    out = Counter(r['id'].split('-')[0] for r in shuffled(tmp_path, [POS, NEG], weights=[0.5, 2.0], seed=1))
+    assert out['neg'] == 200
+    assert 120 <= out['pos'] <= 180
+    assert 'pos' not in {r['id'].split('-')[0] for r in shuffled(tmp_path, [POS, NEG], weights=[0, 1])}
+
+
+def test_record_weights_multiply_and_are_removed(tmp_path):
+    weighted = [dict(record, weight=0.0 if i % 2 else 1.0) for i, record in enumerate(POS)]
+    out = shuffled(tmp_path, [weighted], weights=[2.0], seed=5)
+    assert len(out) == 300
+    assert all('weight' not in record for record in out)
+    assert Counter(r['id'] for r in out) == Counter({r['id']: 2 for r in POS[::2]})
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 16])
+def test_stratified_output_keeps_the_mix_in_every_prefix(tmp_path, chunk_size):
+    out = shuffled(tmp_path, [POS, NEG], stratify=True, seed=2, chunk_size=chunk_size)
+    assert len(out) == 400
+    for end in range(40, 401, 40):
+        assert Counter(r['type'] for r in out[:end])['2'] == end // 4
+
+
+def test_strata_are_ordered_by_name(tmp_path):
+    # Equally sized strata take turns in name order, whichever was seen first
+    neg, pos = samples('neg', 4, '2'), samples('pos', 4)
+    out = shuffled(tmp_path, [neg, pos], stratify=True, seed=9)
+    assert [r['type'] for r in out] == ['1', '2'] * 4
+    # Records without a type form a stratum named None
+    untyped = [{'id': f'u-{i}', 'conversations': []} for i in range(4)]
+    out = shuffled(tmp_path, [untyped, neg, pos], stratify=True, seed=9)
+    assert [r.get('type') for r in out[:3]] == ['1', '2', None]
+
+
+def test_interleave_spreads_streams_proportionally():
+    out = list(interleave([(2, iter('ab')), (6, iter('123456')), (0, iter(''))]))
+    assert sorted(out) == sorted('ab123456')
+    assert out.index('a') in (1, 2) and out.index('b') in (5, 6)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of incremental.incremental_extract: a resumed run parses only new or
+changed responses and leaves outputs identical to a full extraction.
+"""
+import json
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from extraction import extract_responses, write_extractions  # noqa: E402
+from incremental import incremental_extract, load_checkpoint  # noqa: E402
+from record_io import iter_records  # noqa: E402
+
+PROMPT = "Question: Which animal is shown?\n(a) cat\n(b) dog"
+
+
+def response(qid, letter='(a)', usable=True):
+    reasoning = f"whiskers of {qid}" if usable else ''
+    return {'question_id': qid, 'prompt': PROMPT,
+            'text': f"CAPTION: an animal\nREASONING: {reasoning}\nCONCLUSION: {letter}"}
+
+
+def write_lines(path, records, mode='w', partial=None):
+    with open(path, mode, encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        if partial is not None:
+            f.write(json.dumps(partial)[:20])
+
+
+def full_run(input_file, tmp_path):
+    """Outputs of a non-incremental extraction over the complete lines of input_file."""
+    extracted, skipped = str(tmp_path / 'full.jsonl'), str(tmp_path / 'full_skipped.jsonl')
+    with open(input_file, encoding='utf-8') as f:
+        lines = [line for line in f if line.endswith('\n')]
+    write_extractions(extract_responses(json.loads(line) for line in lines), extracted, skipped)
+    return list(iter_records(extracted)), list(iter_records(skipped))
+
+
+class Run:
+    def __init__(self, tmp_path, extension='.jsonl'):
+        self.tmp_path = tmp_path
+        self.input_file = str(tmp_path / 'responses.jsonl')
+        self.extracted = str(tmp_path / ('extracted' + extension))
+        self.skipped = str(tmp_path / ('skipped' + extension))
+
+    def __call__(self, salt=None, workers=1):
+        self.stats = Counter()
+        return incremental_extract(self.input_file, extract_responses, self.extracted, self.skipped,
+                                   workers=workers, stats=self.stats, salt=salt)
+
+    def outputs(self):
+        return list(iter_records(self.extracted)), list(iter_records(self.skipped))
+
+    def matches_full_run(self):
+        return self.outputs() == full_run(self.input_file, self.tmp_path)
+
+
+@pytest.fixture(params=['.jsonl', '.json'])
+def run(tmp_path, request):
+    run = Run(tmp_path, request.param)
+    write_lines(run.input_file, [response('q1'), response('q2', usable=False), response('q3', '(b)')])
+    return run
+
+
+def test_first_run_matches_a_full_extraction(run):
+    assert run() == (3, 2, 1)
+    assert run.stats == Counter({'missing_rationale': 1})
+    assert run.matches_full_run()
+    assert run.outputs()[1] == [{'question_id': 'q2', 'reason': 'missing_rationale', 'row': 1}]
+
+
+def test_unchanged_input_parses_nothing(run):
+    run()
+    before = run.outputs()
+    assert run() == (0, 2, 1)
+    assert run.outputs() == before
+
+
+def test_appended_lines_only_are_parsed(run):
+    run()
+    write_lines(run.input_file, [response('q4', usable=False), response('q5')], mode='a')
+    assert run() == (2, 3, 2)
+    assert load_checkpoint(run.extracted + '.ckpt')['rows'] == 5
+    assert run.matches_full_run()
+    # The reference of the new skipped response points at its row in the whole file
+    assert run.outputs()[1][-1]['row'] == 3
+
+
+def test_partial_last_line_waits_for_its_newline(run):
+    run()
+    write_lines(run.input_file, [response('q4')], mode='a', partial=response('q5'))
+    assert run() == (1, 3, 1)
+    assert 'q5' not in {record['question_id'] for record in run.outputs()[0]}
+
+    # The writer finishes the line
+    with open(run.input_file, encoding='utf-8') as f:
+        text = f.read()
+    with open(run.input_file, 'w', encoding='utf-8') as f:
+        f.write(text[:text.rindex('\n') + 1] + json.dumps(response('q5')) + '\n')
+    assert run() == (1, 4, 1)
+    assert run.matches_full_run()
+
+
+def test_rewritten_file_reparses_changed_records_only(run):
+    run()
+    # model_vqa.py restarted: same ids, q2 now usable and q1 changed its answer
+    write_lines(run.input_file, [response('q1', '(b)'), response('q2'), response('q3', '(b)')])
+    assert run() == (2, 3, 0)
+    assert run.matches_full_run()
+    assert run.outputs()[0][0]['generated_choice'] == '(b)'
+
+
+def test_reappearing_id_replaces_its_extraction(run):
+    run()
+    write_lines(run.input_file, [response('q1', '(b)')], mode='a')
+    assert run() == (1, 2, 1)
+    extracted = run.outputs()[0]
+    assert [record['question_id'] for record in extracted] == ['q1', 'q3']
+    assert extracted[0]['generated_choice'] == '(b)'
+
+
+def test_salt_change_discards_the_checkpoint(run):
+    run(salt='a')
+    assert run(salt='a')[0] == 0
+    assert run(salt='b')[0] == 3
+    assert run.matches_full_run()
+
+
+def test_sharded_resume(run):
+    run(workers=2)
+    write_lines(run.input_file, [response(f'q{i}', usable=i % 3 != 0) for i in range(4, 40)], mode='a')
+    assert run(workers=2)[0] == 36
+    assert run.matches_full_run()
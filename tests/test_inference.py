@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of inference: model ids written to the answers and the placeholders
+of command backends.
+"""
+import json
+import os
+import shlex
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from inference import InferenceClient, SubprocessBackend, load_backend  # noqa: E402
+
+PROMPTS = [
+    {'question_id': 'q1', 'image': 'a.png', 'text': "Question: Which?\n(a) x\n(b) y"},
+    {'question_id': 'q2', 'image': 'b.png', 'text': "Question: Which?\n(a) x\n(b) y\n(c) z"},
+]
+
+# Answers every question with its argv, in the model_vqa.py layout
+ECHO_VQA = '''
+import json, sys
+questions, answers = sys.argv[1], sys.argv[2]
+with open(questions) as f, open(answers, "w") as out:
+    for line in f:
+        q = json.loads(line)
+        out.write(json.dumps({"question_id": q["question_id"], "prompt": q["text"],
+                              "text": json.dumps(sys.argv[3:])}) + "\\n")
+'''
+
+
+def echo_command(tmp_path, *extra):
+    script = tmp_path / 'echo_vqa.py'
+    script.write_text(ECHO_VQA)
+    return ' '.join([shlex.quote(sys.executable), shlex.quote(str(script)), '{question_file}', '{answers_file}',
+                     *extra])
+
+
+def test_model_id_comes_from_the_backend():
+    assert [a['model_id'] for a in InferenceClient(load_backend('fake')).iter_answers(PROMPTS)] == ['fake'] * 2
+    backend = load_backend('fake', 'm1')
+    assert next(InferenceClient(backend).iter_answers(PROMPTS))['model_id'] == 'm1'
+    # An explicit model id wins over the backend's
+    assert next(InferenceClient(backend, model_id='m2').iter_answers(PROMPTS))['model_id'] == 'm2'
+
+
+def test_command_backend_is_not_labelled_fake(tmp_path):
+    backend = load_backend('cmd:' + echo_command(tmp_path))
+    answers = list(InferenceClient(backend).iter_answers(PROMPTS))
+    assert [answer['model_id'] for answer in answers] == ['model', 'model']
+
+
+def test_command_keeps_literal_braces(tmp_path):
+    backend = SubprocessBackend(echo_command(tmp_path, shlex.quote('{"max_new_tokens": 8}'), '{unknown}',
+                                             '--temperature={temperature}'))
+    outputs = backend.generate(PROMPTS, temperature=0.7)
+    assert [json.loads(text) for text in outputs] == [['{"max_new_tokens": 8}', '{unknown}', '--temperature=0.7']] * 2
+
+
+def test_params_without_placeholder_are_reported_once(tmp_path, capsys):
+    backend = SubprocessBackend(echo_command(tmp_path))
+    client = InferenceClient(backend, batch_size=1, params={'temperature': 0.2})
+    answers = list(client.iter_answers(PROMPTS))
+    assert [json.loads(answer['text']) for answer in answers] == [[], []]
+    assert capsys.readouterr().out.count("Warning: the command has no placeholder for temperature") == 1
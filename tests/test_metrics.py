@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of metrics: iteration discovery next to incremental sidecars, and
+the vectorized report against per-question counting.
+"""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from metrics import LetterCodes, domain_report, find_iteration_files  # noqa: E402
+from record_io import write_records  # noqa: E402
+
+QUESTIONS = [
+    {'question_id': 'd-1', 'category': 'x', 'text': "(a) 1\n(b) 2"},
+    {'question_id': 'd-2', 'category': 'x', 'text': "(a) 1\n(b) 2"},
+    {'question_id': 'd-3', 'category': 'y', 'text': "(a) 1\n(b) 2"},
+    {'question_id': 'd-4', 'category': 'y', 'text': "(a) 1\n(b) 2"},
+]
+GOLD = {'d-1': '(a)', 'd-2': '(b)', 'd-3': '(a)'}
+
+
+def extraction(qid, letter):
+    return {'question_id': qid, 'caption': 'c', 'rationale': 'r', 'generated_choice': letter}
+
+
+@pytest.fixture
+def root(tmp_path):
+    ours = tmp_path / 'd' / 'ours'
+    ours.mkdir(parents=True)
+    data = tmp_path / 'data'
+    data.mkdir()
+    write_records(str(data / 'questions_test_d.jsonl'), QUESTIONS)
+    return tmp_path
+
+
+def test_sidecars_are_not_iterations(root):
+    ours = root / 'd' / 'ours'
+    write_records(str(ours / 'extracted_test_it1.jsonl'), [extraction('d-1', '(a)')])
+    write_records(str(ours / 'extracted_test_it2.json.gz'), [extraction('d-1', '(b)')], indent=2)
+    for name in ('extracted_test_it1.jsonl.ckpt', 'extracted_test_it2.json.gz.tmp', 'extracted_test_it3.json.bak',
+                 'extracted_train_it1.json', 'extracted_test_itx.json'):
+        (ours / name).write_text('{"records": {}}')
+    assert find_iteration_files(str(root), 'd') == [(1, str(ours / 'extracted_test_it1.jsonl')),
+                                                     (2, str(ours / 'extracted_test_it2.json.gz'))]
+
+
+def test_one_file_per_iteration(root):
+    ours = root / 'd' / 'ours'
+    old, new = str(ours / 'extracted_test_it1.json'), str(ours / 'extracted_test_it1.jsonl.gz')
+    write_records(old, [extraction('d-1', '(b)')], indent=2)
+    write_records(new, [extraction('d-1', '(a)')])
+    now = time.time()
+    os.utime(old, (now - 60, now - 60))
+    assert find_iteration_files(str(root), 'd') == [(1, new)]
+
+
+def test_report_next_to_an_incremental_checkpoint(root):
+    ours = root / 'd' / 'ours'
+    write_records(str(ours / 'extracted_test_it1.jsonl'),
+                  [extraction('d-1', '(a)'), extraction('d-2', '(a)'), extraction('d-4', '(b)')])
+    write_records(str(ours / 'extracted_test_it2.jsonl'),
+                  [extraction('d-1', '(a)'), extraction('d-2', '(b)'), extraction('d-3', '(b)')])
+    with open(ours / 'extracted_test_it2.jsonl.ckpt', 'w') as f:
+        json.dump({'version': 2, 'records': {'d-1': ['h', 'extracted', 0]}}, f)
+
+    report = domain_report('d', str(root), str(root / 'data'), 'test', GOLD, LetterCodes())
+    assert report['iterations'] == [1, 2]
+    # d-4 has no gold letter and is ignored
+    assert report['correct'] == [1, 2]
+    assert report['answered'] == [2, 3]
+    assert report['accuracy'] == [50.0, 66.67]
+    assert report['skip_rate'] == [33.33, 0.0]
+    assert report['category_accuracy'] == {'x': [50.0, 100.0], 'y': [None, 0.0]}
+    # Rows from, columns to: correct, incorrect, skipped
+    assert report['flips'] == {'it1->it2': [[1, 0, 0], [1, 0, 0], [0, 1, 0]]}
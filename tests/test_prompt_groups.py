@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of prompt_groups: grouped prompt files and their manifests, written
+through the external sort with any chunk size.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from prompt_groups import manifest_path, shared_prefix_length, write_grouped_prompts  # noqa: E402
+from record_io import iter_records  # noqa: E402
+
+PREAMBLE = "You are an expert.\nAnswer the question.\n"
+
+
+def prompt(qid, image, choice=None):
+    text = PREAMBLE + f"Question: about {image}?\n(a) x\n(b) y\n"
+    if choice:
+        text += f"Explain why this answer is wrong: {choice}\nResponse:\n"
+    return {'question_id': qid, 'image': image, 'text': text}
+
+
+PROMPTS = [
+    prompt('q1', 'img1.png', '(a)'),
+    prompt('q2', 'img2.png'),
+    prompt('q1', 'img1.png', '(b)'),
+    prompt('q3', 'img3.png'),
+    prompt('q4', 'img2.png'),
+    prompt('q1', 'img1.png', '(c)'),
+]
+GROUPED = [PROMPTS[0], PROMPTS[2], PROMPTS[5], PROMPTS[1], PROMPTS[4], PROMPTS[3]]
+
+
+@pytest.mark.parametrize('chunk_size', [100, 2, 1])
+def test_grouped_file_and_manifest(tmp_path, chunk_size):
+    output_file = str(tmp_path / 'prompts.jsonl')
+    assert write_grouped_prompts(iter(PROMPTS), output_file, chunk_size=chunk_size, tmp_dir=str(tmp_path)) == 6
+    assert list(iter_records(output_file)) == GROUPED
+    # Spilled runs are removed
+    assert sorted(os.listdir(tmp_path)) == ['prompts.groups.jsonl', 'prompts.jsonl']
+
+    manifest = list(iter_records(manifest_path(output_file)))
+    assert [(group['group'], group['image']) for group in manifest] == \
+        [(0, 'img1.png'), (1, 'img2.png'), (2, 'img3.png')]
+    assert [[r['row'] for r in group['records']] for group in manifest] == [[0, 1, 2], [3, 4], [5]]
+    for group in manifest:
+        for entry in group['records']:
+            text = GROUPED[entry['row']]['text']
+            assert text[:entry['suffix_offset']] == group['prefix']
+            assert text[entry['suffix_offset']:]
+    # The distractors of q1 share everything up to their last line, a single record the file-wide preamble
+    assert manifest[0]['prefix'] == PROMPTS[0]['text'][:PROMPTS[0]['text'].index('Explain')]
+    assert manifest[2]['prefix'] == PREAMBLE
+
+
+def test_one_record_per_image_keeps_the_input_order(tmp_path):
+    prompts = [prompt(f'q{i}', f'img{i}.png') for i in range(5)]
+    output_file = str(tmp_path / 'prompts.jsonl')
+    write_grouped_prompts(prompts, output_file, chunk_size=2, tmp_dir=str(tmp_path))
+    assert list(iter_records(output_file)) == prompts
+
+
+def test_empty_input(tmp_path):
+    output_file = str(tmp_path / 'prompts.jsonl')
+    assert write_grouped_prompts([], output_file) == 0
+    assert list(iter_records(output_file)) == [] and list(iter_records(manifest_path(output_file))) == []
+
+
+def test_shared_prefix_stops_at_a_line_and_leaves_a_suffix():
+    assert shared_prefix_length(["a\nb\nc", "a\nb\nd"]) == 4
+    assert shared_prefix_length(["a\nb\n", "a\nb\n"]) == 2
+    assert shared_prefix_length(["abc", "abd"]) == 0
+    assert shared_prefix_length([]) == 0
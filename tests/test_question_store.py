@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of question_store: lookups through the compiled index match the
+questions JSONL, and the index is rebuilt when the source changes.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from question_store import (QuestionStore, build_question_store, open_question_store,  # noqa: E402
+                            parse_choices)
+
+QUESTIONS = [
+    {'question_id': 'biology-1', 'image': 'images/b1.png', 'category': 'biology',
+     'text': "Question: Which organelle makes ATP?\n(a) Nucleus\n(b) Mitochondrion\n(c) Ribosome"},
+    {'question_id': 'physics-2', 'image': 'images/p2.png', 'text': "Question: Is it heavy?\n(a) Yes\n(b) No",
+     'domain': 'physics', 'answer': '(b)'},
+    {'question_id': 'math-3', 'text': "Question: Pick one.\n(a) 1\n(b) 2", 'category': None},
+    # The id must be hashed as a string, whatever its JSON type
+    {'question_id': 42, 'text': "No choices here", 'image': 'x.png'},
+    # Same id as the first record: the last one wins
+    {'question_id': 'biology-1', 'image': 'images/b1_v2.png', 'category': 'biology',
+     'text': "Question: Which organelle makes ATP?\n(a) Mitochondrion\n(b) Golgi"},
+]
+
+
+def write_questions(path, questions):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in questions:
+            f.write(json.dumps(record) + '\n')
+        f.write('not json\n')
+
+
+@pytest.fixture
+def questions_file(tmp_path):
+    path = str(tmp_path / 'questions_test.jsonl')
+    write_questions(path, QUESTIONS)
+    return path
+
+
+def test_lookups_match_the_source(questions_file):
+    store = QuestionStore(build_question_store(questions_file))
+    assert len(store) == 4
+    assert list(store) == ['biology-1', 'physics-2', 'math-3', '42']
+
+    assert dict(store['biology-1']) == QUESTIONS[4]
+    # Extra fields round-trip, missing and null fields are left out
+    assert dict(store['physics-2']) == QUESTIONS[1]
+    assert dict(store['math-3']) == {'question_id': 'math-3', 'text': QUESTIONS[2]['text']}
+    assert store[42]['image'] == 'x.png'
+    assert store.get('biology-2') is None
+    assert 'physics-2' in store and 'chemistry-9' not in store
+    with pytest.raises(KeyError):
+        store['chemistry-9']
+    store.close()
+
+
+def test_choices(questions_file):
+    store = QuestionStore(build_question_store(questions_file))
+    assert store.choices('biology-1') == [('(a)', 'Mitochondrion'), ('(b)', 'Golgi')]
+    assert store.choices('physics-2') == parse_choices(QUESTIONS[1]['text'])
+    assert store.choices('42') == []
+    assert store.choices('unknown') == []
+    store.close()
+
+
+def test_open_rebuilds_a_stale_index(questions_file):
+    store = open_question_store(questions_file)
+    assert os.path.exists(questions_file + '.qidx')
+    assert open_question_store(questions_file) is store
+
+    write_questions(questions_file, QUESTIONS + [{'question_id': 'new-1', 'text': "(a) x"}])
+    # Make sure the change is visible even on filesystems with coarse mtimes
+    stat = os.stat(questions_file)
+    os.utime(questions_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    rebuilt = open_question_store(questions_file)
+    assert rebuilt is not store
+    assert 'new-1' in rebuilt and len(rebuilt) == 5
+
+
+def test_open_replaces_a_corrupt_index(questions_file):
+    with open(questions_file + '.qidx', 'wb') as f:
+        f.write(b'garbage' * 10)
+    store = open_question_store(questions_file)
+    assert store['physics-2']['answer'] == '(b)'
+
+
+def test_many_ids_probe_correctly(tmp_path):
+    path = str(tmp_path / 'questions_many.jsonl')
+    questions = [{'question_id': f'q-{i}', 'text': f"(a) {i}\n(b) {i + 1}"} for i in range(2000)]
+    write_questions(path, questions)
+    store = QuestionStore(build_question_store(path))
+    assert all(store[f'q-{i}']['text'] == questions[i]['text'] for i in range(2000))
+    assert store.choices('q-1999') == [('(a)', '1999'), ('(b)', '2000')]
+    assert 'q-2000' not in store
+    store.close()
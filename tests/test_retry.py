@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of retry: merging retried responses into an extraction, keeping
+them when the extraction runs again with --retry_files, and resolving
+skipped references.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+import extraction  # noqa: E402
+import extraction_neg  # noqa: E402
+import retry  # noqa: E402
+from record_io import iter_records, write_records  # noqa: E402
+from records import is_skipped_ref  # noqa: E402
+from retry import (has_references, merge_retries, resolve_skipped, sampling_variants, select_prompts,  # noqa: E402
+                   write_retry_prompts)
+
+PROMPT = "Question: Which animal is shown?\n(a) cat\n(b) dog"
+NEG_PROMPT = PROMPT + "\nThe correct choice is (a).\nExplain why this answer is wrong: {}"
+
+
+def pos(qid, usable=True, letter='(a)', prompt=PROMPT):
+    reasoning = 'whiskers' if usable else '0' * 80
+    return {'question_id': qid, 'prompt': prompt,
+            'text': f"CAPTION: a cat\nREASONING: {reasoning}\nCONCLUSION: {letter}"}
+
+
+def neg(qid, choice, usable=True):
+    explanation = f'it is not {choice}' if usable else ''
+    return {'question_id': qid, 'prompt': NEG_PROMPT.format(choice),
+            'text': f"CAPTION: a cat\nEXPLANATION: {explanation}"}
+
+
+@pytest.fixture
+def extracted_run(tmp_path):
+    """A positive extraction run with q2 and q4 skipped, written as references."""
+    paths = {name: str(tmp_path / f'{name}.json') for name in ('extracted', 'skipped')}
+    paths['responses'] = str(tmp_path / 'responses.jsonl')
+    write_records(paths['responses'], [pos('q1'), pos('q2', False), pos('q3'), pos('q4', False)])
+    extraction.process_files(paths['responses'], paths['extracted'], paths['skipped'])
+    return paths
+
+
+def test_merge_appends_the_first_usable_retry(extracted_run, tmp_path):
+    retries = [pos('q2', False), pos('q2', letter='(b)'), pos('q2', letter='(a)'), pos('q9'), pos('q1', letter='(b)')]
+    recovered, still = merge_retries(retries, extracted_run['extracted'], extracted_run['skipped'],
+                                     extraction.extract_responses, responses_file=extracted_run['responses'])
+    assert (recovered, still) == (1, 1)
+    extracted = list(iter_records(extracted_run['extracted']))
+    assert [(r['question_id'], r['generated_choice']) for r in extracted] == \
+        [('q1', '(a)'), ('q3', '(a)'), ('q2', '(b)')]
+    # The skipped file keeps the reference of the prompt that still failed
+    assert list(iter_records(extracted_run['skipped'])) == [{'question_id': 'q4', 'reason': 'zero_threshold', 'row': 3}]
+
+
+def test_extraction_rerun_keeps_the_retries(extracted_run, tmp_path):
+    retry_file = str(tmp_path / 'response_retry_pos_it1.jsonl')
+    write_records(retry_file, [pos('q4', letter='(b)'), pos('q2', False)])
+    extraction.process_files(extracted_run['responses'], extracted_run['extracted'], extracted_run['skipped'],
+                             retry_files=[retry_file])
+    extracted = list(iter_records(extracted_run['extracted']))
+    # Recovered responses take the place of the skipped ones, in input order
+    assert [(r['question_id'], r['generated_choice']) for r in extracted] == \
+        [('q1', '(a)'), ('q3', '(a)'), ('q4', '(b)')]
+    assert [r['question_id'] for r in iter_records(extracted_run['skipped'])] == ['q2']
+
+
+def test_incremental_rerun_picks_up_new_retries(extracted_run, tmp_path):
+    retry_file = str(tmp_path / 'response_retry_pos_it1.jsonl')
+    write_records(retry_file, [pos('q2')])
+    args = (extracted_run['responses'], extracted_run['extracted'], extracted_run['skipped'])
+    extraction.process_files(*args, incremental=True, retry_files=[retry_file])
+    assert [r['question_id'] for r in iter_records(extracted_run['skipped'])] == ['q4']
+
+    write_records(retry_file, [pos('q2'), pos('q4')])
+    extraction.process_files(*args, incremental=True, retry_files=[retry_file])
+    assert [r['question_id'] for r in iter_records(extracted_run['extracted'])] == ['q1', 'q2', 'q3', 'q4']
+    assert list(iter_records(extracted_run['skipped'])) == []
+
+
+def test_negative_retries_match_their_distractor(tmp_path):
+    responses, extracted, skipped = (str(tmp_path / name) for name in ('n.jsonl', 'n_ext.json', 'n_skip.json'))
+    write_records(responses, [neg('q1', '(b)', False), neg('q1', '(c)', False)])
+    retry_file = str(tmp_path / 'response_retry_neg_it1.jsonl')
+    write_records(retry_file, [neg('q1', '(c)')])
+    extraction_neg.process_files(responses, extracted, skipped, retry_files=[retry_file])
+    assert [r['incorrect_choice'] for r in iter_records(extracted)] == ['(c)']
+    assert [r['row'] for r in iter_records(skipped)] == [0]
+
+
+def test_retry_prompts_per_sampling_variant(extracted_run, tmp_path):
+    prompts_file, output_file = str(tmp_path / 'prompts.jsonl'), str(tmp_path / 'retry_prompts.jsonl')
+    write_records(prompts_file, [{'question_id': f'q{i}', 'image': f'{i}.png', 'text': PROMPT} for i in range(1, 5)])
+    total, missing = write_retry_prompts(extracted_run['skipped'], prompts_file, output_file, [0.7, 1.0], 0.9,
+                                         extracted_run['responses'])
+    assert (total, missing) == (4, 0)
+    assert [(r['question_id'], r['sampling']) for r in iter_records(output_file)] == [
+        ('q2', {'temperature': 0.7, 'top_p': 0.9}), ('q4', {'temperature': 0.7, 'top_p': 0.9}),
+        ('q2', {'temperature': 1.0, 'top_p': 0.9}), ('q4', {'temperature': 1.0, 'top_p': 0.9})]
+    assert sampling_variants() == [{}]
+
+
+def test_select_prompts_ignores_the_preamble():
+    skipped = [pos('q1', prompt="You are...\n" + PROMPT), pos('q2'), neg('q3', '(b)')]
+    prompts = [{'question_id': 'q1', 'text': "You are an expert.\n" + PROMPT},
+               {'question_id': 'q3', 'text': NEG_PROMPT.format('(c)')}]
+    selected, missing = select_prompts(skipped, prompts)
+    # q3 asks about another distractor than the only prompt of that id
+    assert [r['question_id'] for r in selected] == ['q1'] and missing == 2
+
+
+def test_references_resolve_to_their_responses(extracted_run):
+    skipped = list(iter_records(extracted_run['skipped']))
+    assert all(is_skipped_ref(record) for record in skipped)
+    assert has_references(extracted_run['skipped'])
+    resolved = resolve_skipped(skipped, extracted_run['responses'])
+    assert [(r['question_id'], r['text']) for r in resolved] == \
+        [('q2', pos('q2', False)['text']), ('q4', pos('q4', False)['text'])]
+
+
+def test_full_skipped_responses_need_no_response_file(tmp_path):
+    responses, extracted, skipped = (str(tmp_path / name) for name in ('r.jsonl', 'e.json', 's.json'))
+    write_records(responses, [pos('q1', False)])
+    extraction.process_files(responses, extracted, skipped, full_skipped=True)
+    assert not has_references(skipped)
+    assert resolve_skipped(list(iter_records(skipped))) == [pos('q1', False)]
+
+
+def test_references_need_the_right_response_file(extracted_run, tmp_path):
+    skipped = list(iter_records(extracted_run['skipped']))
+    with pytest.raises(ValueError, match='references'):
+        resolve_skipped(skipped)
+
+    shifted = str(tmp_path / 'shifted.jsonl')
+    write_records(shifted, [pos('q0')] + list(iter_records(extracted_run['responses'])))
+    with pytest.raises(ValueError, match='answers question q1, not q2'):
+        resolve_skipped(skipped, shifted)
+
+    short = str(tmp_path / 'short.jsonl')
+    write_records(short, list(iter_records(extracted_run['responses']))[:2])
+    with pytest.raises(ValueError, match='1 references point past'):
+        resolve_skipped(skipped, short)
+
+
+def test_cli_requires_the_response_file(extracted_run, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['retry.py', 'prompts', '-s', extracted_run['skipped'], '-p', 'unused.jsonl',
+                                      '-o', str(tmp_path / 'out.jsonl')])
+    with pytest.raises(SystemExit):
+        retry.main()
+    assert '--responses_file must name the response file' in capsys.readouterr().err
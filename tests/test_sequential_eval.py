@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of sequential_eval run end to end through backends that serialize
+the question records: an HTTP server and a command run per batch.
+"""
+import json
+import os
+import shlex
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+import sequential_eval  # noqa: E402
+from inference import FakeBackend, make_server  # noqa: E402
+from record_io import iter_records, write_records  # noqa: E402
+
+STL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl')
+
+# A model_vqa.py stand-in answering a question file with the fake backend
+FAKE_VQA = '''
+import json, sys
+sys.path.insert(0, {stl_dir!r})
+from inference import FakeBackend
+from record_io import iter_records, write_records
+questions = list(iter_records(sys.argv[1]))
+texts = FakeBackend("cmd-model").generate(questions)
+write_records(sys.argv[2], [{{"question_id": q["question_id"], "prompt": q["text"], "text": t}}
+                            for q, t in zip(questions, texts)])
+'''
+
+
+@pytest.fixture
+def questions(tmp_path):
+    questions_file = str(tmp_path / 'formatted_questions_test_d.jsonl')
+    write_records(questions_file, [
+        {'question_id': f'd-{i}', 'image': f'{i}.png', 'category': 'xy'[i % 2],
+         'text': "Question: Which one?\n(a) one\n(b) two\n(c) three"} for i in range(40)])
+    answers_file = str(tmp_path / 'correct_answers_test.json')
+    with open(answers_file, 'w') as f:
+        json.dump({f'd-{i}': '(a)' for i in range(40)}, f)
+    return questions_file, answers_file
+
+
+@pytest.fixture
+def http_backend():
+    server = make_server(FakeBackend('http-model'), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+
+def run_sequential_eval(tmp_path, questions, backend, *extra):
+    out = {name: str(tmp_path / f'{name}.json') for name in ('answers', 'extracted', 'skipped', 'summary')}
+    out['answers'] = str(tmp_path / 'answers.jsonl')
+    argv = ['sequential_eval.py', '-q', questions[0], '-a', questions[1], '--backend', backend,
+            '--answers_file', out['answers'], '--extracted_file', out['extracted'],
+            '--skipped_file', out['skipped'], '--summary_file', out['summary'], '--batch_size', '8', *extra]
+    old_argv, sys.argv = sys.argv, argv
+    try:
+        sequential_eval.main()
+    finally:
+        sys.argv = old_argv
+    with open(out['summary']) as f:
+        return json.load(f), out
+
+
+def test_http_backend(tmp_path, questions, http_backend):
+    summary, out = run_sequential_eval(tmp_path, questions, http_backend, '--full')
+    assert summary['answered'] == summary['extracted'] == 40
+    assert summary['stop_reason'] == 'complete'
+    answers = list(iter_records(out['answers']))
+    # The model id is the backend's default, not a made-up one
+    assert {answer['model_id'] for answer in answers} == {'model'}
+    # The same answers as the fake backend in process, whose choices depend on its model id only
+    expected = FakeBackend('http-model').generate(list(iter_records(questions[0])))
+    assert sorted(answer['text'] for answer in answers) == sorted(expected)
+
+
+def test_command_backend_stops_early(tmp_path, questions):
+    script = tmp_path / 'fake_vqa.py'
+    script.write_text(FAKE_VQA.format(stl_dir=STL_DIR))
+    command = f"cmd:{shlex.quote(sys.executable)} {shlex.quote(str(script))} {{question_file}} {{answers_file}}"
+    summary, out = run_sequential_eval(tmp_path, questions, command, '--min_samples', '16', '--half_width', '50',
+                                       '--model_id', 'it1')
+    assert summary['stop_reason'] == 'precise'
+    assert summary['answered'] == 16 and summary['population'] == 40
+    assert {answer['model_id'] for answer in iter_records(out['answers'])} == {'it1'}
+    assert len(list(iter_records(out['extracted']))) == 16
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+CPU tests of response_parser.StreamingParser, fed token streams the way the
+stopping criterion of an inference loop feeds it.
+"""
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl'))
+
+from response_parser import (ABORT, DONE, NEG_LAYOUT, RUNNING, StreamingParser, feed_stream,  # noqa: E402
+                             is_degenerate, parse_neg_response, parse_pos_response)
+
+PROMPT = ("Question: Which animal is shown?\n"
+          "(a) cat\n"
+          "(b) dog\n"
+          "(c) bird")
+NEG_PROMPT = PROMPT + "\nThe correct choice is (a).\nExplain why this answer is wrong: (b)"
+
+POS_RESPONSES = [
+    "CAPTION: A small cat sits on a mat.\nREASONING: The animal has whiskers and pointed ears.\n"
+    "CONCLUSION: (a) cat, because of the whiskers.",
+    # Sections out of order: the letter comes before the caption and reasoning
+    "CONCLUSION: (a) guess\nCAPTION: a cat\nREASONING: because",
+    "CONCLUSION: (a) guess\nCAPTION: a cat\nREASONING: because\nCONCLUSION: (b) on reflection",
+    # Reasoning opened but not closed when the letter appears
+    "REASONING: whiskers CONCLUSION: (a)\nCAPTION: a cat\nREASONING: again",
+    "caption: lower-case markers\nreasoning: still parsed\nconclusion: the answer is (c) bird",
+    "CAPTION: a cat\nREASONING: whiskers\nCONCLUSION: the animal is a cat",
+    "CAPTION: a cat\nCONCLUSION: (a)\nREASONING: late reasoning",
+    "CAPTION: only a caption",
+]
+
+
+def char_pieces(text):
+    return list(text)
+
+
+def token_pieces(text):
+    # Sub-word sized pieces with their leading blank, like decoded LLaMA tokens
+    return re.findall(r"\s*\S{1,3}|\s+$", text)
+
+
+def line_pieces(text):
+    return text.splitlines(keepends=True)
+
+
+SPLITS = [char_pieces, token_pieces, line_pieces]
+
+
+@pytest.mark.parametrize('split', SPLITS)
+@pytest.mark.parametrize('response', POS_RESPONSES)
+def test_done_never_changes_the_extraction(response, split):
+    text, state = feed_stream(StreamingParser(), split(response))
+    assert response.startswith(text)
+    if state == DONE:
+        assert parse_pos_response(text, PROMPT) == parse_pos_response(response, PROMPT)
+    else:
+        assert state == RUNNING and text == response
+
+
+def test_stops_right_after_the_conclusion_letter():
+    response = POS_RESPONSES[0]
+    parser = StreamingParser()
+    text, state = feed_stream(parser, token_pieces(response))
+    assert (state, parser.reason) == (DONE, 'conclusion')
+    assert text.endswith('(a)')
+    assert parse_pos_response(text, PROMPT) == ('A small cat sits on a mat.',
+                                                'The animal has whiskers and pointed ears.', '(a)')
+
+
+@pytest.mark.parametrize('split', SPLITS)
+def test_settled_text_is_cut_after_the_letter(split):
+    from inference import settled_text
+
+    response = POS_RESPONSES[0]
+    parser = StreamingParser()
+    text, state = feed_stream(parser, split(response))
+    assert state == DONE and text[:parser.end].endswith('(a)')
+    # The generated text may run past the step the parser stopped at
+    settled = settled_text(response + " trailing tokens", parser)
+    assert settled == response[:response.index('(a)') + 3]
+    assert parse_pos_response(settled, PROMPT) == parse_pos_response(response, PROMPT)
+
+
+def test_settled_text_keeps_unfinished_responses():
+    from inference import settled_text
+
+    parser = StreamingParser()
+    feed_stream(parser, token_pieces(POS_RESPONSES[1]))
+    assert parser.end is None
+    assert settled_text(" " + POS_RESPONSES[1] + "\n", parser) == POS_RESPONSES[1]
+
+    aborted = "CAPTION: a cat\nREASONING: " + "0" * 200
+    parser = StreamingParser()
+    feed_stream(parser, token_pieces(aborted))
+    assert parser.state == ABORT and parser.end == len(parser.text)
+    assert settled_text(aborted, parser) == aborted
+
+
+def test_conclusion_before_the_other_sections_is_not_done():
+    response = "CONCLUSION: (a) guess\nCAPTION: a cat\nREASONING: because"
+    text, state = feed_stream(StreamingParser(), char_pieces(response))
+    assert state == RUNNING
+    assert text == response
+    assert parse_pos_response(text, PROMPT) == ('a cat', 'because', '(a)')
+
+
+def test_marker_split_across_pieces():
+    pieces = ["CAPTION: a cat\nREASON", "ING: whiskers\nCONCLU", "SION: (", "a)"]
+    parser = StreamingParser()
+    states = [parser.feed(piece) for piece in pieces]
+    assert states == [RUNNING, RUNNING, RUNNING, DONE]
+
+
+def test_zero_run_aborts_a_response_extraction_would_skip():
+    response = "CAPTION: a cat\nREASONING: " + "0" * 200 + "\nCONCLUSION: (a)"
+    parser = StreamingParser()
+    text, state = feed_stream(parser, token_pieces(response))
+    assert (state, parser.reason) == (ABORT, 'zero_threshold')
+    assert len(text) < len(response)
+    assert is_degenerate(parse_pos_response(response, PROMPT)[1])
+
+
+def test_zeros_in_the_caption_do_not_abort():
+    response = "CAPTION: " + "0" * 200 + "\nREASONING: whiskers\nCONCLUSION: (a)"
+    text, state = feed_stream(StreamingParser(), token_pieces(response))
+    assert state == DONE
+    assert parse_pos_response(text, PROMPT) == parse_pos_response(response, PROMPT)
+
+
+def test_repetition_aborts():
+    response = "CAPTION: a cat\nREASONING: " + "the cat is a cat and " * 40
+    parser = StreamingParser()
+    _, state = feed_stream(parser, token_pieces(response))
+    assert (state, parser.reason) == (ABORT, 'repetition')
+
+
+def test_repetition_check_can_be_disabled():
+    response = "CAPTION: a cat\nREASONING: " + "the cat is a cat and " * 40
+    _, state = feed_stream(StreamingParser(repeat_window=0), token_pieces(response))
+    assert state == RUNNING
+
+
+def test_feed_after_stop_keeps_the_state():
+    parser = StreamingParser()
+    feed_stream(parser, token_pieces(POS_RESPONSES[0]))
+    text = parser.text
+    assert parser.feed(" more text") == DONE
+    assert parser.text == text
+
+
+@pytest.mark.parametrize('split', SPLITS)
+def test_negative_layout_only_aborts(split):
+    response = "CAPTION: a cat\nEXPLANATION: a dog barks and this animal does not (b)."
+    text, state = feed_stream(StreamingParser(NEG_LAYOUT), split(response))
+    assert (state, text) == (RUNNING, response)
+    assert parse_neg_response(text, NEG_PROMPT) == ('a cat', 'a dog barks and this animal does not (b).',
+                                                    '(a)', '(b)')
+
+    degenerate = "CAPTION: a cat\nEXPLANATION: " + "0" * 100
+    parser = StreamingParser(NEG_LAYOUT)
+    _, state = feed_stream(parser, split(degenerate))
+    assert (state, parser.reason) == (ABORT, 'zero_threshold')
+
+
+def test_stopping_criteria_with_a_decoding_tokenizer():
+    pytest.importorskip('transformers')
+    from inference import parser_stopping_criteria
+
+    vocab = token_pieces(POS_RESPONSES[0]) + token_pieces(POS_RESPONSES[1])
+
+    class Tokenizer:
+        def decode(self, ids, skip_special_tokens=True):
+            return ''.join(vocab[i] for i in ids)
+
+    first = list(range(len(token_pieces(POS_RESPONSES[0]))))
+    second = list(range(len(first), len(vocab)))
+    criteria = parser_stopping_criteria(Tokenizer(), batch_size=2)
+    stopped_at = None
+    for step in range(1, max(len(first), len(second)) + 1):
+        if criteria([first[:step], second[:step]], None):
+            stopped_at = step
+            break
+    # The second sequence never settles, so the batch runs to the end
+    assert stopped_at is None
+    assert criteria.parsers[0].state == DONE
+    assert criteria.parsers[1].state == RUNNING